@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量执行
+固定数量的 worker 依次领取条目执行，结果按完成顺序逐条返回，单个条目失败不影响其他条目
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def map_unordered(
+    func: Callable[[int, T], Awaitable[R]],
+    items: Sequence[T],
+    concurrency: int
+) -> AsyncIterator[Tuple[int, Optional[R], Optional[Exception]]]:
+    """以最多 concurrency 个并发执行 func(index, item)，按完成顺序产出 (index, 结果, 异常)
+
+    调用方提前结束迭代 (例如客户端断开) 时取消尚未完成的条目。
+    """
+    pending = iter(enumerate(items))
+    results: "asyncio.Queue[Tuple[int, Any, Optional[Exception]]]" = asyncio.Queue()
+
+    async def worker():
+        # 所有 worker 共用同一个迭代器，每个条目只被领取一次
+        for index, item in pending:
+            try:
+                results.put_nowait((index, await func(index, item), None))
+            except Exception as e:
+                results.put_nowait((index, None, e))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(max(1, concurrency), len(items)))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
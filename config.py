@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+环境变量读取工具
+两个服务器共用的配置解析函数
+"""
+
+import os
+import re
+from typing import List, Optional
+
+
+def env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    """读取字符串环境变量，空字符串视为未设置"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip()
+
+
+def env_int(name: str, default: int) -> int:
+    """读取整数环境变量，格式错误时回退到默认值"""
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """读取浮点数环境变量，格式错误时回退到默认值"""
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    """读取布尔环境变量 (1/true/yes/on 为真)"""
+    value = env_str(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def env_list(name: str) -> List[str]:
+    """读取逗号或空白分隔的列表环境变量"""
+    value = env_str(name)
+    if value is None:
+        return []
+    return [item for item in re.split(r"[,\s]+", value) if item]
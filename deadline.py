@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求截止时间
+调用方指定的截止时间保存在上下文中，上游请求和图像下载的超时不超过剩余时间；
+超过截止时间时取消进行中的工作
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Optional, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+# 单次调用允许的最长截止时间 (秒)
+MAX_DEADLINE = 3600.0
+
+# 截止时间已过的判断容差，超时定时器可能略早触发 (秒)
+_TOLERANCE = 0.01
+
+# 当前请求的截止时间 (time.monotonic)，未指定时为 None
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    """超过调用方指定的截止时间"""
+
+
+def parse_deadline(value: Any) -> Optional[float]:
+    """解析调用方给出的剩余秒数，无效时返回 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not 0 < seconds <= MAX_DEADLINE:
+        return None
+    return seconds
+
+
+def remaining() -> Optional[float]:
+    """距截止时间的剩余秒数，未设置截止时间时返回 None"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= _TOLERANCE
+
+
+def clear_deadline():
+    """清除当前上下文的截止时间
+
+    用于多个调用方共享的任务：任务复制了发起者的上下文，截止时间应由各调用方在等待结果时各自执行。
+    """
+    _deadline.set(None)
+
+
+def _enter(seconds: Optional[float]):
+    """在当前上下文设置截止时间，已有更早的截止时间时保持不变"""
+    if seconds is None:
+        return None
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and current <= deadline:
+        return None
+    return _deadline.set(deadline)
+
+
+def request_timeout(timeout: httpx.Timeout) -> httpx.Timeout:
+    """按剩余时间收紧各阶段超时，未设置截止时间时原样返回"""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.001)
+
+    def clamp(value: Optional[float]) -> float:
+        return left if value is None else min(value, left)
+
+    return httpx.Timeout(
+        connect=clamp(timeout.connect),
+        read=clamp(timeout.read),
+        write=clamp(timeout.write),
+        pool=clamp(timeout.pool),
+    )
+
+
+async def run_with_deadline(awaitable: Awaitable[T], seconds: Optional[float] = None) -> T:
+    """在截止时间内执行 awaitable，超时时取消并抛出 DeadlineExceededError
+
+    seconds 与上下文中已有的截止时间取较早者；因截止时间收紧的超时等错误也按超过截止时间报告。
+    """
+    token = _enter(seconds)
+    try:
+        left = remaining()
+        if left is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, max(left, 0.0))
+        except asyncio.TimeoutError:
+            if expired():
+                raise DeadlineExceededError("已超过请求截止时间")
+            raise
+        except Exception as e:
+            if expired():
+                raise DeadlineExceededError(f"已超过请求截止时间: {e}") from e
+            raise
+    finally:
+        if token is not None:
+            _deadline.reset(token)
+
+
+async def iter_with_deadline(items: AsyncIterator[T], seconds: Optional[float] = None) -> AsyncIterator[T]:
+    """在截止时间内逐项迭代，超时时关闭迭代器并抛出 DeadlineExceededError
+
+    截止时间设置在迭代方 (流式响应任务) 的上下文中，迭代结束后不再使用，因此不恢复。
+    """
+    _enter(seconds)
+    try:
+        while True:
+            try:
+                item = await run_with_deadline(items.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        aclose = getattr(items, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+派生图像
+按需生成已保存图像的缩略图和 WebP/JPEG 转码，结果保存在原图旁边，原图被淘汰时一并删除。
+图像处理依赖可选的 Pillow，在进程池中执行
+"""
+
+import asyncio
+import importlib.util
+import io
+import os
+from typing import TYPE_CHECKING, Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from file_io import spawn_process_pool, write_file_atomic
+from image_store import ImageStore, derivative_path
+from logs import get_logger
+from singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+logger = get_logger("derivatives")
+
+FORMATS = {
+    "png": ".png",
+    "webp": ".webp",
+    "jpeg": ".jpeg",
+}
+_FORMAT_ALIASES = {"jpg": "jpeg"}
+
+MAX_DIMENSION = 4096
+DEFAULT_QUALITY = 80
+
+# 可以指定派生图的参数名
+PARAMS = ("width", "height", "format", "quality")
+
+
+class DerivativeUnavailableError(Exception):
+    """未安装 Pillow，无法生成派生图"""
+
+
+class DerivativeSpec(NamedTuple):
+    """派生图参数，width/height 为 0 表示该方向不限制"""
+
+    width: int
+    height: int
+    format: str
+    quality: int
+
+    @property
+    def tag(self) -> str:
+        """派生图文件名中的参数部分"""
+        return f"w{self.width}h{self.height}q{self.quality}"
+
+    @property
+    def ext(self) -> str:
+        return FORMATS[self.format]
+
+
+def _int_param(params: Mapping[str, Any], name: str, default: int, low: int, high: int) -> int:
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        raise ValueError(f"无效的 {name} 参数: {value}")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"无效的 {name} 参数: {value}")
+    if not low <= number <= high:
+        raise ValueError(f"{name} 参数必须在 {low}-{high} 之间")
+    return number
+
+
+def parse_spec(params: Mapping[str, Any], default_format: str = "png") -> Optional[DerivativeSpec]:
+    """从查询参数或工具参数解析派生图参数，没有任何派生参数时返回 None，参数无效时抛出 ValueError"""
+    if all(params.get(name) in (None, "") for name in PARAMS):
+        return None
+    fmt = str(params.get("format") or default_format).lower()
+    fmt = _FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in FORMATS:
+        raise ValueError(f"无效的 format 参数: {fmt}，可选值: {', '.join(FORMATS)}")
+    return DerivativeSpec(
+        width=_int_param(params, "width", 0, 1, MAX_DIMENSION),
+        height=_int_param(params, "height", 0, 1, MAX_DIMENSION),
+        format=fmt,
+        quality=_int_param(params, "quality", DEFAULT_QUALITY, 1, 100),
+    )
+
+
+def pillow_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def render_derivative(source: str, target: str, width: int, height: int, fmt: str, quality: int) -> int:
+    """缩放并转码图像，原子写入目标文件，返回写入的字节数 (在子进程中执行)
+
+    缩放保持宽高比，只缩小不放大。
+    """
+    from PIL import Image
+
+    with Image.open(source) as image:
+        image.load()
+        if width or height:
+            image.thumbnail((width or image.width, height or image.height), Image.LANCZOS)
+        if fmt == "jpeg" and image.mode != "RGB":
+            # JPEG 不支持透明通道，合成到白色背景上
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        options: Dict[str, Any] = {"optimize": True} if fmt == "png" else {"quality": quality}
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.upper(), **options)
+    return write_file_atomic(target, buffer.getvalue())
+
+
+class DerivativeService:
+    """按需生成并缓存派生图
+
+    相同派生图的并发请求只生成一次；生成在按需创建的进程池中进行，不占用事件循环和 I/O 线程。
+    """
+
+    def __init__(self, store: ImageStore, processes: int = 2):
+        self.store = store
+        self.processes = max(1, processes)
+        self.available = pillow_available()
+        self._pool: Optional["ProcessPoolExecutor"] = None
+        self._flight = SingleFlight()
+
+        self.generated = 0
+        self.hits = 0
+
+    async def get(self, image_id: str, spec: DerivativeSpec) -> Tuple[str, os.stat_result]:
+        """返回派生图的 (路径, stat 结果)，不存在时生成"""
+        if not self.available:
+            raise DerivativeUnavailableError("生成缩略图和格式转换需要安装 Pillow (pip install Pillow)")
+
+        digest, source = await self.store.locate_object(image_id)
+        target = derivative_path(source, digest, spec.tag, spec.ext)
+        try:
+            stat = await self.store.file_io.run(os.stat, target)
+            self.hits += 1
+            return target, stat
+        except FileNotFoundError:
+            pass
+
+        async def generate() -> os.stat_result:
+            loop = asyncio.get_running_loop()
+            size = await loop.run_in_executor(
+                self._executor(), render_derivative,
+                source, target, spec.width, spec.height, spec.format, spec.quality
+            )
+            await self.store.add_derived_size(digest, size)
+            self.generated += 1
+            logger.debug("🖼️ 已生成派生图: %s", target)
+            return await self.store.file_io.run(os.stat, target)
+
+        stat, _ = await self._flight.do(target, generate)
+        return target, stat
+
+    def _executor(self) -> "ProcessPoolExecutor":
+        if self._pool is None:
+            self._pool = spawn_process_pool(self.processes)
+        return self._pool
+
+    def shutdown(self):
+        """关闭进程池"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "generated": self.generated,
+            "hits": self.hits,
+            "inflight": self._flight.stats()["inflight"],
+        }
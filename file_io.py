@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图像文件读写
+原子写入的文件操作，以及不阻塞事件循环的线程池 (可选进程池) 执行器
+"""
+
+import asyncio
+import os
+import tempfile
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Optional
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+def spawn_process_pool(max_workers: int) -> "ProcessPoolExecutor":
+    """创建使用 spawn 启动子进程的进程池，避免继承监听套接字和信号处理器
+
+    multiprocessing 在首次创建进程池时才导入，不计入启动时间。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def open_temp_file(path: str) -> BinaryIO:
+    """在目标文件所在目录创建临时文件，配合 commit_temp_file 实现原子写入"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".part"
+    )
+    # mkstemp 创建的文件只有属主可读，改为普通文件的权限
+    os.chmod(temp_path, 0o644)
+    os.close(fd)
+    # 用路径重新打开，使 f.name 为临时文件路径
+    return open(temp_path, "wb")
+
+
+def commit_temp_file(f: BinaryIO, path: str):
+    """关闭临时文件并重命名为目标文件，读者不会看到写了一半的文件"""
+    f.close()
+    os.replace(f.name, path)
+
+
+def discard_temp_file(f: BinaryIO):
+    """关闭并删除临时文件"""
+    f.close()
+    try:
+        os.remove(f.name)
+    except OSError:
+        pass
+
+
+def write_file_atomic(path: str, data: bytes) -> int:
+    """原子写入整个文件"""
+    f = open_temp_file(path)
+    try:
+        f.write(data)
+    except BaseException:
+        discard_temp_file(f)
+        raise
+    commit_temp_file(f, path)
+    return len(data)
+
+
+class FileIOExecutor:
+    """图像解码与写入的执行器
+
+    普通任务使用有界线程池；配置了进程数时，单次数量达到阈值的批量解码使用进程池。
+    """
+
+    def __init__(self, threads: int = 4, processes: int = 0, process_min_batch: int = 4):
+        self.threads = max(1, threads)
+        self.processes = max(0, processes)
+        self.process_min_batch = max(1, process_min_batch)
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional["ProcessPoolExecutor"] = None
+
+    def _executor(self, batch_size: int = 1) -> Executor:
+        if self.processes and batch_size >= self.process_min_batch:
+            if self._process_pool is None:
+                self._process_pool = spawn_process_pool(self.processes)
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="image-io"
+            )
+        return self._thread_pool
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """在线程池中执行阻塞的文件操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(), func, *args)
+
+    async def run_batch(self, func: Callable[..., Any], batch_size: int, *args) -> Any:
+        """执行批量中的一项 CPU 密集任务 (如 base64 解码)，batch_size 用于决定是否使用进程池
+
+        使用进程池时 func 和参数必须可以 pickle。
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(batch_size), func, *args)
+
+    def shutdown(self):
+        """关闭线程池和进程池"""
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对冲请求
+第一次上游请求超过同类请求的历史延迟分位数仍未返回时，再发出一个相同的请求，
+取先成功的结果并取消另一个；对冲次数受预算限制
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, TypeVar
+
+from logs import get_logger
+
+logger = get_logger("hedging")
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """按请求类型记录最近的成功延迟"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = max(1, window)
+        self.min_samples = max(1, min_samples)
+        self._samples: Dict[Hashable, Deque[float]] = {}
+
+    def record(self, key: Hashable, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, key: Hashable, q: float) -> Optional[float]:
+        """最近延迟的 q 分位数，样本不足时返回 None"""
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class HedgeBudget:
+    """对冲预算：每个请求存入 ratio 个令牌，每次对冲消耗一个，长期对冲比例不超过 ratio"""
+
+    def __init__(self, ratio: float, capacity: float = 10.0):
+        self.ratio = max(0.0, ratio)
+        self.capacity = max(1.0, capacity)
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Hedger:
+    """对冲执行器
+
+    只有同类请求积累了足够的延迟样本才会对冲；延迟阈值不低于 min_delay。
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.9,
+        budget: float = 0.05,
+        min_delay: float = 1.0,
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.percentile = min(max(percentile, 0.5), 0.999)
+        self.min_delay = max(0.0, min_delay)
+        self.latency = LatencyTracker(window, min_samples)
+        self.budget = HedgeBudget(budget)
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    def delay(self, key: Hashable) -> Optional[float]:
+        """发出对冲请求前等待的秒数，样本不足时返回 None (不对冲)"""
+        threshold = self.latency.percentile(key, self.percentile)
+        if threshold is None:
+            return None
+        return max(self.min_delay, threshold)
+
+    async def run(self, key: Hashable, attempt: Callable[[], Awaitable[T]]) -> T:
+        """执行 attempt，超过阈值仍未完成且预算允许时并行再执行一次，返回先成功的结果
+
+        两次都失败时抛出第一次的异常；返回前取消仍在进行的另一次。
+        """
+        self.requests += 1
+        self.budget.deposit()
+        delay = self.delay(key)
+
+        started: List[float] = [time.monotonic()]
+        tasks: List["asyncio.Future[T]"] = [asyncio.ensure_future(attempt())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self.budget.withdraw():
+                        self.hedged += 1
+                        logger.debug("🪞 第一次请求 %.1f 秒未返回，发出对冲请求", delay)
+                        started.append(time.monotonic())
+                        tasks.append(asyncio.ensure_future(attempt()))
+                    else:
+                        self.budget_exhausted += 1
+
+            pending = set(tasks)
+            while pending:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先第一次请求
+                for index, task in enumerate(tasks):
+                    if task.done() and not task.cancelled() and task.exception() is None:
+                        now = time.monotonic()
+                        self.latency.record(key, now - started[index])
+                        if index > 0:
+                            self.hedge_wins += 1
+                            # 被取消的第一次请求至少耗时这么久，计入样本避免阈值只反映快请求
+                            self.latency.record(key, now - started[0])
+                        return task.result()
+            # 全部失败
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "percentile": self.percentile,
+            "budget": self.budget.ratio,
+            "budget_tokens": round(self.budget.tokens, 2),
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted,
+        }
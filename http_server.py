@@ -7,47 +7,344 @@ AIHubMix Image HTTP MCP Server
 """
 
 import asyncio
-import json
 import os
+import re
 import sys
 import io
-import base64
-from datetime import datetime
-from typing import Any, Dict, List, Optional
-import httpx
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 import uvicorn
 
-class AIHubMixImageHTTPMCPServer:
+from config import env_int, env_float
+from deadline import DeadlineExceededError, iter_with_deadline, parse_deadline, run_with_deadline
+from derivatives import DerivativeUnavailableError, parse_spec
+from image_service import RESPONSE_MODES, AIHubMixImageService
+from image_store import ImageNotFoundError, make_etag, mime_type
+from jobs import JobManager, JobQueueFullError, SharedJobManager
+from logs import get_logger, new_request_id, setup_logging, shutdown_logging
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from result_cache import CacheMissError
+from shared_state import SharedStateStore
+from sse import format_sse_event
+from startup import event_loop_name, run
+from upstream import create_limiter
+from tool_registry import CAPABILITIES, SERVER_VERSION, ToolArgumentError
+
+logger = get_logger("http")
+
+# 接受客户端传入的 X-Request-ID 的格式
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# 单个字节范围请求
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# 读取图像文件范围时每次读取的块大小
+FILE_CHUNK_SIZE = 64 * 1024
+
+# 调用方愿意等待的最长秒数
+DEADLINE_HEADER = "X-Request-Deadline"
+
+
+def _json_bytes(body: bytes) -> Response:
+    """直接返回预先序列化的 JSON，跳过 FastAPI 的响应编码"""
+    return Response(content=body, media_type="application/json")
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """解析单个字节范围，返回 [start, end] (含两端)
+
+    多范围或格式不支持时返回 None (按完整文件响应)，范围不可满足时抛出 ValueError。
+    """
+    match = _RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N: 最后 N 个字节
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match 是否匹配 (弱比较)"""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _request_deadline(request: Request, body: Optional[Dict[str, Any]] = None) -> Optional[float]:
+    """X-Request-Deadline 头与请求体 deadline 字段中较早的截止时间 (剩余秒数)"""
+    candidates = [parse_deadline(request.headers.get(DEADLINE_HEADER))]
+    if body is not None:
+        candidates.append(parse_deadline(body.get("deadline")))
+    candidates = [seconds for seconds in candidates if seconds is not None]
+    return min(candidates) if candidates else None
+
+
+class CorrelationIdMiddleware:
+    """为每个请求设置关联 id，沿用合法的 X-Request-ID 并在响应头中返回
+
+    使用纯 ASGI 中间件：@app.middleware("http") 会替换 receive，处理请求时检测不到客户端断开连接。
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = Headers(scope=scope).get("X-Request-ID", "")
+        rid = new_request_id(incoming if _REQUEST_ID_PATTERN.match(incoming) else None)
+        
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = rid
+            await send(message)
+        
+        await self.app(scope, receive, send_with_id)
+
+
+async def _wait_disconnected(request: Request):
+    """等待客户端断开连接
+
+    直接读取 ASGI receive 上的 http.disconnect：request.is_disconnected() 在 anyio CancelScope 中执行，
+    会吞掉取消，请求先完成时无法结束等待。请求体此时已读完，receive 只会在断开时返回。
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class AIHubMixImageHTTPMCPServer(AIHubMixImageService):
     """AIHubMix 图像生成 HTTP MCP 服务器"""
     
     def __init__(self):
-        self.api_key = os.getenv('AIHUBMIX_API_KEY')
-        self.base_url = os.getenv('AIHUBMIX_BASE_URL', 'https://aihubmix.com/v1')
-        self.model = os.getenv('AIHUBMIX_MODEL', 'gpt-image-1')
-        self.server_name = os.getenv('MCP_SERVER_NAME', 'aihubmix-image-mcp-server')
-        
-        # 图像保存目录
-        self.image_save_dir = os.path.join(os.path.dirname(__file__), 'images')
-        
-        # 验证配置
-        if not self.api_key:
-            raise ValueError("AIHUBMIX_API_KEY 环境变量未设置")
-        
-        print(f"🚀 {self.server_name} HTTP 服务器启动中...")
-        print(f"📡 API 基础 URL: {self.base_url}")
-        print(f"🎨 默认模型: {self.model}")
-        print(f"💾 图像保存目录: {self.image_save_dir}")
+        super().__init__(default_base_url='https://aihubmix.com/v1')
+        
+        logger.info("🚀 %s HTTP 服务器启动中...", self.server_name)
+        logger.info("📡 API 基础 URL: %s", ", ".join(self.upstream.base_urls))
+        logger.info("🔑 上游条目数: %d", len(self.upstream.endpoints))
+        logger.info("🎨 默认模型: %s", self.model)
+        logger.info("💾 图像保存目录: %s", self.image_save_dir)
+        
+        # 多进程部署：限流令牌桶和任务表放在所有 worker 共用的 SQLite 中
+        self.workers = max(1, env_int('WORKERS', 1))
+        self.shared_state: Optional[SharedStateStore] = None
+        if self.workers > 1:
+            self.shared_state = SharedStateStore(
+                os.path.join(self.image_save_dir, '.shared_state.sqlite3')
+            )
+            self.limiter = create_limiter(self.shared_state, self.workers)
+            self.upstream.use_shared_store(self.shared_state)
+            # 多个 worker 共用同一个图像存储，只由一个 worker 执行清理
+            self.janitor.shared_store = self.shared_state
+        
+        # 异步任务：固定大小的 worker 池 + 有界队列
+        job_options = dict(
+            workers=env_int('AIHUBMIX_JOB_WORKERS', 4),
+            queue_size=env_int('AIHUBMIX_JOB_QUEUE_SIZE', 100),
+            ttl=env_float('AIHUBMIX_JOB_TTL', 3600.0),
+        )
+        if self.shared_state is not None:
+            self.jobs = SharedJobManager(self.shared_state, **job_options)
+        else:
+            self.jobs = JobManager(**job_options)
+        self.jobs_retry_after = env_int('AIHUBMIX_JOB_RETRY_AFTER', 5)
+        
+        registry = self.metrics.registry
+        registry.gauge_func(
+            "aihubmix_jobs_queued", "排队中的异步任务数", lambda: self.jobs.stats()["queued"]
+        )
+        registry.gauge_func(
+            "aihubmix_jobs_running", "执行中的异步任务数", lambda: self.jobs.stats()["running"]
+        )
+        registry.counter_func(
+            "aihubmix_jobs_rejected_total", "因队列已满被拒绝的异步任务数", lambda: self.jobs.rejected
+        )
     
-    async def start(self, host="0.0.0.0", port=8000):
-        """启动 HTTP MCP 服务器"""
+    def _generation_kwargs(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """从直接调用端点的请求体中提取生成参数"""
+        return {
+            "prompt": request.get("prompt"),
+            "model": request.get("model", self.model),
+            "size": request.get("size", "1024x1024"),
+            "n": request.get("n", 1),
+            "filename": request.get("filename", "generated_image"),
+            "cache": request.get("cache"),
+            "fanout": request.get("fanout"),
+        }
+    
+    def _response_mode(self, request: Dict[str, Any]) -> str:
+        """直接调用端点的返回方式: full 或 refs"""
+        mode = request.get("response", self.default_response_mode)
+        if mode not in RESPONSE_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"无效的 response 参数: {mode}，可选值: {', '.join(RESPONSE_MODES)}"
+            )
+        return mode
+    
+    async def _image_response(self, request: Request, image_id: str) -> Response:
+        """返回已保存的图像，支持 ETag/If-None-Match 和单个字节范围
+
+        查询参数 width/height/format/quality 指定派生图 (缩略图、WebP/JPEG 转码)。
+        """
+        try:
+            spec = parse_spec(request.query_params)
+            if spec is None:
+                path, stat = await self.image_store.locate(image_id)
+            else:
+                path, stat = await self.derivatives.get(image_id, spec)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except ImageNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except DerivativeUnavailableError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        
+        etag = make_etag(stat)
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "no-cache",
+        }
+        media_type = mime_type(path)
+        
+        if _etag_matches(request.headers.get("If-None-Match", ""), etag):
+            return Response(status_code=304, headers=headers)
+        
+        byte_range = None
+        range_header = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        # If-Range 与当前 ETag 不一致时忽略 Range，返回完整文件
+        if range_header and (if_range is None or if_range == etag):
+            try:
+                byte_range = _parse_range(range_header, stat.st_size)
+            except ValueError:
+                return Response(
+                    status_code=416,
+                    headers={**headers, "Content-Range": f"bytes */{stat.st_size}"}
+                )
+        
+        if byte_range is None:
+            # 完整文件交给 FileResponse，服务器支持时使用 sendfile
+            return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+        
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        body = b"" if request.method == "HEAD" else self._iter_file_range(path, start, end - start + 1)
+        return StreamingResponse(body, status_code=206, media_type=media_type, headers=headers)
+    
+    async def _iter_file_range(self, path: str, start: int, length: int):
+        """在执行器中分块读取文件的一段"""
+        f = await self.file_io.run(open, path, "rb")
+        try:
+            await self.file_io.run(f.seek, start)
+            while length > 0:
+                chunk = await self.file_io.run(f.read, min(FILE_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            await self.file_io.run(f.close)
+    
+    async def _run_until_disconnect(
+        self,
+        request: Request,
+        awaitable,
+        deadline: Optional[float] = None
+    ) -> Any:
+        """执行请求处理，客户端断开连接时取消，释放上游名额并停止保存图像
+
+        超过截止时间时抛出 DeadlineExceededError。
+        """
+        work = asyncio.ensure_future(run_with_deadline(awaitable, deadline))
+        watcher = asyncio.ensure_future(_wait_disconnected(request))
+        try:
+            await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not work.done():
+                work.cancel()
+            await asyncio.gather(watcher, work, return_exceptions=True)
+        if work.cancelled():
+            self.cancelled_requests.inc(reason="disconnect")
+            logger.info("🔌 客户端已断开连接，已取消进行中的请求")
+            # 客户端已经收不到响应
+            return Response(status_code=499)
+        return work.result()
+    
+    async def _run_mcp_call(self, request: Request, body: Dict[str, Any], handler) -> Any:
+        """执行 MCP 调用，超过 X-Request-Deadline 时返回 JSON-RPC 错误"""
+        try:
+            return await self._run_until_disconnect(request, handler, _request_deadline(request))
+        except DeadlineExceededError as e:
+            self.cancelled_requests.inc(reason="deadline")
+            return {
+                "jsonrpc": "2.0",
+                "id": body.get("id"),
+                "error": {
+                    "code": -32603,
+                    "message": str(e)
+                }
+            }
+    
+    def _validate_request(self, request: Dict[str, Any], tool: str = "generate_image"):
+        """在调用上游之前按工具 inputSchema 校验直接调用端点的请求体"""
+        try:
+            self.tools.validate_arguments(tool, request)
+        except ToolArgumentError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    async def _run_generation_job(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """执行一个异步任务，结果中不保留上游原始数据以节省内存"""
+        result = await self._generate_image_with_aihubmix(**kwargs)
+        return {key: value for key, value in result.items() if key != "data"}
+    
+    async def _shutdown(self):
+        """释放共享资源，包括跨进程共享状态的连接"""
+        await super()._shutdown()
+        if self.shared_state is not None:
+            self.shared_state.close()
+    
+    def create_app(self) -> FastAPI:
+        """构建 FastAPI 应用，共享资源在应用启动阶段创建，单进程和多进程模式共用"""
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            # 创建共享资源，API 连接测试在后台进行，结果见 /ready
+            await self._startup()
+            await self.jobs.start(self._run_generation_job)
+            logger.info("✅ %s HTTP 服务器已启动 (进程 %d)", self.server_name, os.getpid())
+            self._mark_started()
+            # uvicorn 收到信号退出时会重新抛出该信号，共享资源需要在应用关闭阶段释放
+            try:
+                yield
+            finally:
+                await self.jobs.stop()
+                await self._shutdown()
+        
         app = FastAPI(
             title=self.server_name,
             description="AIHubMix Image Generation MCP Server",
-            version="1.0.0"
+            version="1.0.0",
+            lifespan=lifespan
         )
         
         # 添加CORS中间件
@@ -59,95 +356,33 @@ class AIHubMixImageHTTPMCPServer:
             allow_headers=["*"],
         )
         
-        # 测试 API 连接
-        await self._test_connection()
+        app.add_middleware(CorrelationIdMiddleware)
         
         @app.get("/")
         async def root():
             return {
                 "name": self.server_name,
-                "version": "1.0.0",
+                "version": SERVER_VERSION,
                 "description": "AIHubMix Image Generation MCP Server",
-                "capabilities": {
-                    "tools": {},
-                    "resources": {},
-                    "prompts": {},
-                    "sampling": {}
-                }
+                "capabilities": CAPABILITIES
             }
         
         @app.post("/mcp")
-        async def mcp_endpoint(request: Dict[str, Any]):
+        async def mcp_endpoint(request: Dict[str, Any], http_request: Request):
             """通用MCP协议端点"""
             method = request.get("method")
             request_id = request.get("id")
             
             if method == "initialize":
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "result": {
-                        "protocolVersion": "2024-11-05",
-                        "capabilities": {
-                            "tools": {},
-                            "resources": {},
-                            "prompts": {},
-                            "sampling": {}
-                        },
-                        "serverInfo": {
-                            "name": self.server_name,
-                            "version": "1.0.0"
-                        }
-                    }
-                }
+                return _json_bytes(self.tools.initialize_response(request_id))
             elif method == "tools/list":
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "result": {
-                        "tools": [
-                            {
-                                "name": "generate_image",
-                                "description": "使用 AIHubMix API 生成图像",
-                                "inputSchema": {
-                                    "type": "object",
-                                    "properties": {
-                                        "prompt": {
-                                            "type": "string",
-                                            "description": "图像描述提示词"
-                                        },
-                                        "model": {
-                                            "type": "string",
-                                            "description": "使用的模型 (gpt-image-1)",
-                                            "default": self.model
-                                        },
-                                        "size": {
-                                            "type": "string",
-                                            "description": "图像尺寸",
-                                            "enum": ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"],
-                                            "default": "1024x1024"
-                                        },
-                                        "n": {
-                                            "type": "integer",
-                                            "description": "生成图像数量 (1-10)",
-                                            "minimum": 1,
-                                            "maximum": 10,
-                                            "default": 1
-                                        },
-                                        "filename": {
-                                            "type": "string",
-                                            "description": "输出文件名 (不含扩展名)",
-                                            "default": "generated_image"
-                                        }
-                                    },
-                                    "required": ["prompt"]
-                                }
-                            }
-                        ]
-                    }
-                }
+                return _json_bytes(self.tools.tools_list_response(request_id))
             elif method == "tools/call":
-                return await self._handle_generate_image(request)
+                return await self._run_mcp_call(http_request, request, self._handle_tool_call(request))
+            elif method == "resources/list":
+                return await self._handle_resources_list(request)
+            elif method == "resources/read":
+                return await self._run_mcp_call(http_request, request, self._handle_resources_read(request))
             else:
                 return {
                     "jsonrpc": "2.0",
@@ -161,409 +396,240 @@ class AIHubMixImageHTTPMCPServer:
         @app.post("/mcp/initialize")
         async def mcp_initialize(request: Dict[str, Any]):
             """MCP 初始化端点"""
-            return {
-                "jsonrpc": "2.0",
-                "id": request.get("id"),
-                "result": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {},
-                        "resources": {},
-                        "prompts": {},
-                        "sampling": {}
-                    },
-                    "serverInfo": {
-                        "name": self.server_name,
-                        "version": "1.0.0"
-                    }
-                }
-            }
+            return _json_bytes(self.tools.initialize_response(request.get("id")))
         
         @app.get("/mcp/initialize")
         async def mcp_initialize_get():
             """MCP 初始化端点 (GET)"""
-            return {
-                "jsonrpc": "2.0",
-                "id": 1,
-                "result": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {},
-                        "resources": {},
-                        "prompts": {},
-                        "sampling": {}
-                    },
-                    "serverInfo": {
-                        "name": self.server_name,
-                        "version": "1.0.0"
-                    }
-                }
-            }
+            return _json_bytes(self.tools.initialize_response(1))
         
         @app.post("/mcp/tools/list")
         async def mcp_tools_list(request: Dict[str, Any]):
             """MCP 工具列表端点"""
-            return {
-                "jsonrpc": "2.0",
-                "id": request.get("id"),
-                "result": {
-                    "tools": [
-                        {
-                            "name": "generate_image",
-                            "description": "使用 AIHubMix API 生成图像",
-                            "inputSchema": {
-                                "type": "object",
-                                "properties": {
-                                    "prompt": {
-                                        "type": "string",
-                                        "description": "图像描述提示词"
-                                    },
-                                    "model": {
-                                        "type": "string",
-                                        "description": "使用的模型 (gpt-image-1)",
-                                        "default": self.model
-                                    },
-                                    "size": {
-                                        "type": "string",
-                                        "description": "图像尺寸",
-                                        "enum": ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"],
-                                        "default": "1024x1024"
-                                    },
-                                    "n": {
-                                        "type": "integer",
-                                        "description": "生成图像数量 (1-10)",
-                                        "minimum": 1,
-                                        "maximum": 10,
-                                        "default": 1
-                                    },
-                                    "filename": {
-                                        "type": "string",
-                                        "description": "输出文件名 (不含扩展名)",
-                                        "default": "generated_image"
-                                    }
-                                },
-                                "required": ["prompt"]
-                            }
-                        }
-                    ]
-                }
-            }
+            return _json_bytes(self.tools.tools_list_response(request.get("id")))
         
         @app.get("/mcp/tools/list")
         async def mcp_tools_list_get():
             """MCP 工具列表端点 (GET)"""
-            return {
-                "jsonrpc": "2.0",
-                "id": 1,
-                "result": {
-                    "tools": [
-                        {
-                            "name": "generate_image",
-                            "description": "使用 AIHubMix API 生成图像",
-                            "inputSchema": {
-                                "type": "object",
-                                "properties": {
-                                    "prompt": {
-                                        "type": "string",
-                                        "description": "图像描述提示词"
-                                    },
-                                    "model": {
-                                        "type": "string",
-                                        "description": "使用的模型 (gpt-image-1)",
-                                        "default": self.model
-                                    },
-                                    "size": {
-                                        "type": "string",
-                                        "description": "图像尺寸",
-                                        "enum": ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"],
-                                        "default": "1024x1024"
-                                    },
-                                    "n": {
-                                        "type": "integer",
-                                        "description": "生成图像数量 (1-10)",
-                                        "minimum": 1,
-                                        "maximum": 10,
-                                        "default": 1
-                                    },
-                                    "filename": {
-                                        "type": "string",
-                                        "description": "输出文件名 (不含扩展名)",
-                                        "default": "generated_image"
-                                    }
-                                },
-                                "required": ["prompt"]
-                            }
-                        }
-                    ]
-                }
-            }
+            return _json_bytes(self.tools.tools_list_response(1))
         
         @app.post("/mcp/tools/call")
-        async def mcp_tools_call(request: Dict[str, Any]):
+        async def mcp_tools_call(request: Dict[str, Any], http_request: Request):
             """MCP 工具调用端点"""
-            tool_name = request.get("params", {}).get("name")
-            if tool_name == "generate_image":
-                return await self._handle_generate_image(request)
-            else:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request.get("id"),
-                    "error": {
-                        "code": -32601,
-                        "message": f"未知工具: {tool_name}"
-                    }
-                }
+            return await self._run_mcp_call(http_request, request, self._handle_tool_call(request))
+        
+        @app.post("/mcp/resources/list")
+        async def mcp_resources_list(request: Dict[str, Any]):
+            """MCP 资源列表端点"""
+            return await self._handle_resources_list(request)
+        
+        @app.post("/mcp/resources/read")
+        async def mcp_resources_read(request: Dict[str, Any], http_request: Request):
+            """MCP 资源读取端点"""
+            return await self._run_mcp_call(http_request, request, self._handle_resources_read(request))
         
         @app.post("/generate-image")
-        async def generate_image_endpoint(request: Dict[str, Any]):
-            """直接图像生成端点"""
+        async def generate_image_endpoint(request: Dict[str, Any], http_request: Request):
+            """直接图像生成端点，response=refs 时只返回图像引用
+
+            客户端断开连接或超过截止时间时取消生成。
+            """
+            self._validate_request(request)
+            response_mode = self._response_mode(request)
+            
+            async def generate():
+                result = await self._generate_image_with_aihubmix(**self._generation_kwargs(request))
+                if response_mode == "refs":
+                    return await self._image_refs(result)
+                return result
+            
             try:
-                result = await self._generate_image_with_aihubmix(
-                    prompt=request.get("prompt"),
-                    model=request.get("model", self.model),
-                    size=request.get("size", "1024x1024"),
-                    n=request.get("n", 1),
-                    filename=request.get("filename", "generated_image")
+                return await self._run_until_disconnect(
+                    http_request, generate(), _request_deadline(http_request, request)
                 )
-                return result
+            except DeadlineExceededError as e:
+                self.cancelled_requests.inc(reason="deadline")
+                raise HTTPException(status_code=504, detail=str(e))
+            except CacheMissError as e:
+                raise HTTPException(status_code=404, detail=str(e))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             except Exception as e:
+                logger.warning("❌ 图像生成失败: %s", e)
                 raise HTTPException(status_code=500, detail=str(e))
         
-        @app.get("/health")
-        async def health_check():
-            """健康检查端点"""
-            return {"status": "healthy", "server": self.server_name}
-        
-        print(f"✅ {self.server_name} HTTP 服务器已启动，监听 {host}:{port}")
-        
-        # 启动服务器
-        config = uvicorn.Config(app, host=host, port=port, log_level="info")
-        server = uvicorn.Server(config)
-        await server.serve()
-    
-    async def _test_connection(self):
-        """测试 API 连接"""
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{self.base_url}/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
+        @app.post("/generate-image/stream")
+        async def generate_image_stream_endpoint(request: Dict[str, Any], http_request: Request):
+            """流式图像生成端点，以 Server-Sent Events 转发预览图和最终结果
+
+            客户端断开连接时流式响应随之取消，超过截止时间时发送 error 事件。
+            """
+            self._validate_request(request)
+            try:
+                events = self._streaming_generation(
+                    prompt=request["prompt"],
+                    model=request.get("model", self.model),
+                    size=request.get("size", "1024x1024"),
+                    n=request.get("n", 1),
+                    filename=request.get("filename", "generated_image"),
+                    partial_images=request.get("partial_images")
                 )
-                if response.status_code == 200:
-                    models = response.json()
-                    print(f"✅ API 连接成功，可用模型数量: {len(models.get('data', []))}")
-                else:
-                    print(f"⚠️ API 连接测试失败，状态码: {response.status_code}")
-        except Exception as e:
-            print(f"⚠️ API 连接测试失败: {e}")
-    
-    async def _handle_generate_image(self, request: Dict[str, Any]) -> Dict[str, Any]:
-        """处理图像生成请求"""
-        request_id = request.get("id")
-        params = request.get("params", {}).get("arguments", {})
-        
-        try:
-            # 提取参数
-            prompt = params.get("prompt")
-            model = params.get("model", self.model)
-            size = params.get("size", "1024x1024")
-            n = params.get("n", 1)
-            filename = params.get("filename", "generated_image")
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            deadline = _request_deadline(http_request, request)
             
-            if not prompt:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {
-                        "code": -32602,
-                        "message": "缺少必需参数: prompt"
-                    }
-                }
+            async def event_stream():
+                try:
+                    async for event, data in iter_with_deadline(events, deadline):
+                        yield format_sse_event(event, data)
+                except DeadlineExceededError as e:
+                    self.cancelled_requests.inc(reason="deadline")
+                    yield format_sse_event("error", {"error": str(e)})
+                except Exception as e:
+                    yield format_sse_event("error", {"error": str(e)})
             
-            # 调用 AIHubMix API
-            result = await self._generate_image_with_aihubmix(
-                prompt=prompt,
-                model=model,
-                size=size,
-                n=n,
-                filename=filename
+            return StreamingResponse(
+                event_stream(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        @app.post("/generate-images/batch")
+        async def generate_images_batch_endpoint(request: Dict[str, Any], http_request: Request):
+            """批量图像生成端点，以 Server-Sent Events 按完成顺序逐条返回结果"""
+            self._validate_request(request, "generate_images_batch")
+            items = self._iter_batch_generation(
+                request["items"],
+                model=request.get("model", self.model),
+                cache=request.get("cache"),
+                concurrency=request.get("concurrency"),
+                deadline=_request_deadline(http_request, request)
             )
             
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": result["message"]
-                        }
-                    ],
-                    "isError": False
-                }
-            }
+            async def event_stream():
+                succeeded = failed = 0
+                try:
+                    async for item in items:
+                        if item["status"] == "succeeded":
+                            succeeded += 1
+                        else:
+                            failed += 1
+                        yield format_sse_event("item", item)
+                    yield format_sse_event("done", {
+                        "total": succeeded + failed, "succeeded": succeeded, "failed": failed
+                    })
+                except Exception as e:
+                    yield format_sse_event("error", {"error": str(e)})
             
-        except Exception as e:
+            return StreamingResponse(
+                event_stream(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        @app.post("/jobs", status_code=202)
+        async def create_job(request: Dict[str, Any]):
+            """提交异步图像生成任务，立即返回任务 id"""
+            self._validate_request(request)
+            try:
+                job = await self.jobs.submit(self._generation_kwargs(request))
+            except JobQueueFullError as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(self.jobs_retry_after)}
+                )
+            return {"job_id": job["id"], "status": job["status"], "status_url": f"/jobs/{job['id']}"}
+        
+        @app.get("/jobs/{job_id}")
+        async def get_job(job_id: str):
+            """查询异步任务状态和结果"""
+            job = await self.jobs.get(job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail=f"任务不存在: {job_id}")
+            return job
+        
+        @app.api_route("/images/{image_id:path}", methods=["GET", "HEAD"])
+        async def get_image(image_id: str, request: Request):
+            """读取已保存的图像"""
+            return await self._image_response(request, image_id)
+        
+        @app.get("/health")
+        async def health_check():
+            """健康检查端点"""
             return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32603,
-                    "message": f"图像生成失败: {str(e)}"
-                }
+                "status": "healthy",
+                "server": self.server_name,
+                "jobs": self.jobs.stats(),
+                **self._service_stats()
             }
-    
-    async def _generate_image_with_aihubmix(
-        self,
-        prompt: str,
-        model: str = "gpt-image-1",
-        size: str = "1024x1024",
-        n: int = 1,
-        filename: str = "generated_image"
-    ) -> Dict[str, Any]:
-        """使用 AIHubMix API 生成图像"""
-        
-        # 构建请求数据
-        request_data = {
-            "model": model,
-            "prompt": prompt,
-            "size": size,
-            "n": n
-        }
         
-        # 对于 gpt-image-1 模型，请求 base64 格式的响应
-        if model == "gpt-image-1":
-            request_data["response_format"] = "b64_json"
+        @app.get("/ready")
+        async def readiness_check():
+            """就绪检查端点，上游连接测试通过前返回 503"""
+            stats = self._readiness_stats()
+            return JSONResponse(stats, status_code=200 if self.readiness == "ready" else 503)
         
-        print(f"🎨 正在生成图像...")
-        print(f"   提示词: {prompt}")
-        print(f"   模型: {model}")
-        print(f"   尺寸: {size}")
-        print(f"   数量: {n}")
-        print(f"   响应格式: {'base64' if model == 'gpt-image-1' else 'URL'}")
+        @app.get("/metrics")
+        async def metrics():
+            """Prometheus 指标端点"""
+            return Response(self.metrics.render(), media_type=METRICS_CONTENT_TYPE)
         
-        try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/images/generations",
-                    headers={"Authorization": f"Bearer {self.api_key}"},
-                    json=request_data
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    print(f"✅ 图像生成成功!")
-                    print(f"   创建时间: {result.get('created')}")
-                    
-                    # 处理生成的图像
-                    saved_files = []
-                    if result.get('data'):
-                        for i, image_data in enumerate(result['data']):
-                            if 'url' in image_data:
-                                # 下载并保存图像
-                                saved_file = await self._download_and_save_image(
-                                    image_data['url'],
-                                    filename,
-                                    i
-                                )
-                                if saved_file:
-                                    saved_files.append(saved_file)
-                            elif 'b64_json' in image_data:
-                                # 保存 base64 图像
-                                saved_file = await self._save_base64_image(
-                                    image_data['b64_json'],
-                                    filename,
-                                    i
-                                )
-                                if saved_file:
-                                    saved_files.append(saved_file)
-                    
-                    message = f"成功生成 {len(result.get('data', []))} 张图像"
-                    if saved_files:
-                        message += f"，已保存到: {', '.join(saved_files)}"
-                    
-                    return {
-                        "message": message,
-                        "data": result,
-                        "saved_files": saved_files
-                    }
-                
-                elif response.status_code == 401:
-                    raise Exception("API 密钥无效，请检查 AIHUBMIX_API_KEY")
-                elif response.status_code == 402:
-                    raise Exception("账户余额不足，请充值")
-                elif response.status_code == 429:
-                    raise Exception("请求频率过高，请稍后重试")
-                else:
-                    raise Exception(f"API 请求失败，状态码: {response.status_code}, 响应: {response.text}")
-        
-        except httpx.TimeoutException:
-            raise Exception("请求超时，请检查网络连接")
-        except httpx.ConnectError:
-            raise Exception("无法连接到 AIHubMix API，请检查网络连接")
-        except Exception as e:
-            raise Exception(f"图像生成失败: {str(e)}")
+        return app
     
-    async def _download_and_save_image(self, url: str, filename: str, index: int = 0) -> Optional[str]:
-        """下载并保存图像"""
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    # 确保保存目录存在
-                    os.makedirs(self.image_save_dir, exist_ok=True)
-                    
-                    # 构建文件名
-                    suffix = f"_{index}" if index > 0 else ""
-                    file_path = os.path.join(self.image_save_dir, f"{filename}{suffix}.png")
-                    
-                    # 保存图片
-                    with open(file_path, "wb") as f:
-                        f.write(response.content)
-                    
-                    print(f"💾 图像已保存: {file_path}")
-                    return file_path
-                else:
-                    print(f"❌ 下载图像失败，状态码: {response.status_code}")
-                    return None
-        except Exception as e:
-            print(f"❌ 保存图像失败: {e}")
-            return None
+    async def start(self, host="0.0.0.0", port=8000):
+        """以单进程方式启动 HTTP MCP 服务器"""
+        app = self.create_app()
+        logger.info("📡 监听 %s:%s", host, port)
+        
+        # 启动服务器
+        config = uvicorn.Config(app, host=host, port=port, log_level="info")
+        server = uvicorn.Server(config)
+        await server.serve()
     
-    async def _save_base64_image(self, b64_data: str, filename: str, index: int = 0) -> Optional[str]:
-        """保存 base64 编码的图像"""
-        try:
-            import base64
-            
-            # 确保保存目录存在
-            os.makedirs(self.image_save_dir, exist_ok=True)
-            
-            # 构建文件名
-            suffix = f"_{index}" if index > 0 else ""
-            file_path = os.path.join(self.image_save_dir, f"{filename}{suffix}.png")
-            
-            # 解码并保存 base64 图像
-            image_data = base64.b64decode(b64_data)
-            with open(file_path, "wb") as f:
-                f.write(image_data)
-            
-            print(f"💾 图像已保存: {file_path}")
-            return file_path
-        except Exception as e:
-            print(f"❌ 保存 base64 图像失败: {e}")
-            return None
 
-def main():
-    # 设置控制台输出编码
+def _setup_console():
+    """设置控制台输出编码并加载配置"""
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='xmlcharrefreplace')
+    sys.stderr = io.TextIOWrapper(
+        sys.stderr.buffer, encoding='utf-8', errors='xmlcharrefreplace', line_buffering=True
+    )
     load_dotenv()
+    setup_logging()
+
+
+def create_app() -> FastAPI:
+    """应用工厂，多进程模式下每个 worker 进程调用一次"""
+    _setup_console()
+    return AIHubMixImageHTTPMCPServer().create_app()
+
+
+def main():
+    _setup_console()
     
     # 获取端口配置
     port = int(os.getenv('PORT', 8000))
     host = os.getenv('HOST', '0.0.0.0')
+    workers = max(1, env_int('WORKERS', 1))
     
-    server = AIHubMixImageHTTPMCPServer()
-    asyncio.run(server.start(host=host, port=port))
+    try:
+        if workers > 1:
+            # 每个 worker 是独立进程，通过应用工厂各自创建服务器实例
+            logger.info("🚀 以 %d 个 worker 进程启动，监听 %s:%s", workers, host, port)
+            uvicorn.run(
+                "http_server:create_app",
+                factory=True,
+                host=host,
+                port=port,
+                workers=workers,
+                log_level="info",
+                loop=event_loop_name()
+            )
+        else:
+            server = AIHubMixImageHTTPMCPServer()
+            run(server.start(host=host, port=port))
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AIHubMix 图像生成服务
+stdio 与 HTTP 两个 MCP 服务器共用的上游调用与图像保存逻辑
+"""
+
+import asyncio
+import base64
+import json
+import math
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from batch import map_unordered
+from config import env_bool, env_float, env_int, env_str
+from deadline import (
+    DeadlineExceededError,
+    clear_deadline,
+    iter_with_deadline,
+    parse_deadline,
+    remaining,
+    request_timeout,
+    run_with_deadline,
+)
+from derivatives import DerivativeService, DerivativeSpec, DerivativeUnavailableError, parse_spec
+from file_io import FileIOExecutor
+from hedging import Hedger
+from image_store import ImageNotFoundError, ImageStore, ObjectWriter, parse_resource_uri, resource_uri
+from janitor import StorageJanitor
+from logs import PromptRef, get_logger
+from metrics import ServiceMetrics, set_request_labels
+from result_cache import CACHE_MODES, CacheMissError, ResultCache, make_request_key
+from singleflight import SingleFlight
+from sse import iter_sse_events
+from startup import startup_elapsed
+from stream_decode import B64JsonStreamDecoder
+from tool_registry import ToolArgumentError, ToolRegistry
+from upstream_pool import AUTH_EJECT_STATUS, UpstreamEndpoint, create_upstream_pool
+from upstream import (
+    RETRYABLE_TRANSPORT_ERRORS,
+    UpstreamError,
+    build_timeout,
+    create_http_client,
+    create_limiter,
+    create_retry_policy,
+    parse_retry_after,
+)
+
+# 流式下载每次写入的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 生成结果的返回方式: full 包含上游原始数据, refs 只返回已保存图像的引用
+RESPONSE_MODES = ("full", "refs")
+
+# resources/list 每页的条目数
+RESOURCES_PAGE_SIZE = 100
+
+logger = get_logger("service")
+
+
+class DownloadError(Exception):
+    """图像下载失败"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class AIHubMixImageService:
+    """AIHubMix 图像生成服务基类"""
+
+    def __init__(self, default_base_url: str, api_prefix: str = ""):
+        # 上游地址池：多个 API 密钥与基础 URL，按负载和剩余额度分配请求
+        self.upstream = create_upstream_pool(default_base_url, api_prefix)
+        self.model = os.getenv('AIHUBMIX_MODEL', 'gpt-image-1')
+        self.server_name = os.getenv('MCP_SERVER_NAME', 'aihubmix-image-mcp-server')
+
+        # 图像保存目录
+        self.image_save_dir = os.path.join(os.path.dirname(__file__), 'images')
+
+        # 共享的上游客户端，在 start 中创建
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.download_timeout = build_timeout(read=env_float('AIHUBMIX_DOWNLOAD_READ_TIMEOUT', 30.0))
+        self.download_concurrency = max(1, env_int('AIHUBMIX_DOWNLOAD_CONCURRENCY', 4))
+        self.download_retries = max(0, env_int('AIHUBMIX_DOWNLOAD_RETRIES', 2))
+        self.download_retry_backoff = env_float('AIHUBMIX_DOWNLOAD_RETRY_BACKOFF', 0.5)
+        self._download_slots: Optional[asyncio.Semaphore] = None
+
+        # 生成接口的客户端限流与重试
+        self.limiter = create_limiter()
+        self.retry_policy = create_retry_policy()
+        self.probe_timeout = build_timeout(read=env_float('AIHUBMIX_PROBE_READ_TIMEOUT', 10.0))
+
+        # 上游连接测试在后台进行，不阻塞启动；结果决定就绪状态: starting / ready / unavailable
+        self.readiness = "starting"
+        self.warmup_connections = max(1, env_int('AIHUBMIX_WARMUP_CONNECTIONS', 2))
+        self.warmup_retry_interval = max(1.0, env_float('AIHUBMIX_WARMUP_RETRY_INTERVAL', 30.0))
+        self.warmup_seconds: Optional[float] = None
+        self.startup_seconds: Optional[float] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+
+        # 对冲请求 (默认关闭)：超过同类请求的延迟分位数仍未返回时再发出一次
+        self.hedger: Optional[Hedger] = None
+        if env_bool('AIHUBMIX_HEDGE_ENABLED', False):
+            self.hedger = Hedger(
+                percentile=env_float('AIHUBMIX_HEDGE_PERCENTILE', 0.9),
+                budget=env_float('AIHUBMIX_HEDGE_BUDGET', 0.05),
+                min_delay=env_float('AIHUBMIX_HEDGE_MIN_DELAY', 1.0),
+                min_samples=env_int('AIHUBMIX_HEDGE_MIN_SAMPLES', 20),
+            )
+
+        # 结果缓存 (默认关闭)
+        self.result_cache: Optional[ResultCache] = None
+        if env_bool('AIHUBMIX_CACHE_ENABLED', False):
+            self.result_cache = ResultCache(
+                self.image_save_dir,
+                ttl=env_float('AIHUBMIX_CACHE_TTL', 86400.0),
+                max_entries=env_int('AIHUBMIX_CACHE_MAX_ENTRIES', 10000),
+                memory_entries=env_int('AIHUBMIX_CACHE_MEMORY_ENTRIES', 256),
+            )
+        self.default_cache_mode = env_str('AIHUBMIX_CACHE_MODE', 'prefer')
+
+        # 解码与写盘执行器
+        self.file_io = FileIOExecutor(
+            threads=env_int('AIHUBMIX_IO_THREADS', 4),
+            processes=env_int('AIHUBMIX_DECODE_PROCESSES', 0),
+            process_min_batch=env_int('AIHUBMIX_PROCESS_MIN_BATCH', 4),
+        )
+
+        # 内容寻址的图像存储，filename 只作为别名
+        self.image_store = ImageStore(self.image_save_dir, self.file_io)
+        self.default_response_mode = env_str('AIHUBMIX_RESPONSE_MODE', 'full')
+
+        # 按需生成的缩略图和格式转换 (需要 Pillow)
+        self.derivatives = DerivativeService(
+            self.image_store, processes=env_int('AIHUBMIX_DERIVATIVE_PROCESSES', 2)
+        )
+
+        # 按最长保存时间和总大小上限淘汰图像 (默认不限制)
+        self.janitor = StorageJanitor(
+            self.image_store,
+            max_bytes=env_int('AIHUBMIX_STORAGE_MAX_MB', 0) * 1024 * 1024,
+            max_age=env_float('AIHUBMIX_STORAGE_MAX_AGE', 0.0),
+            interval=env_float('AIHUBMIX_STORAGE_JANITOR_INTERVAL', 300.0),
+            batch_size=env_int('AIHUBMIX_STORAGE_JANITOR_BATCH', 500),
+        )
+
+        # b64_json 响应流式解码 (默认关闭，开启后响应 data 中的 b64_json 为 null)
+        self.stream_decode = env_bool('AIHUBMIX_STREAM_DECODE', False)
+
+        # n>1 时拆分为多个并行上游请求，每个请求的图像数量 (0 表示不拆分)
+        self.default_fanout = max(0, env_int('AIHUBMIX_FANOUT_CHUNK', 0))
+
+        # 流式生成时请求的预览图数量
+        self.default_partial_images = env_int('AIHUBMIX_PARTIAL_IMAGES', 2)
+
+        # 批量生成时同时执行的条目数
+        self.batch_concurrency = max(1, env_int('AIHUBMIX_BATCH_CONCURRENCY', 4))
+
+        # 合并相同的并发生成请求
+        self.singleflight: Optional[SingleFlight] = None
+        if env_bool('AIHUBMIX_COALESCE', True):
+            self.singleflight = SingleFlight()
+
+        # MCP 工具及不变的协议响应
+        self.tools = ToolRegistry(self.server_name, self.model)
+
+        # 运行指标，每个服务器实例一个注册表
+        self.metrics = ServiceMetrics()
+        self._register_metrics()
+        self.batch_items = self.metrics.registry.counter(
+            "aihubmix_batch_items_total", "批量生成完成的条目数", ["status"]
+        )
+        self.cancelled_requests = self.metrics.registry.counter(
+            "aihubmix_cancelled_requests_total", "被取消的请求数 (客户端断开、取消通知或超过截止时间)", ["reason"]
+        )
+
+        # 验证配置
+        if self.default_cache_mode not in CACHE_MODES:
+            raise ValueError(f"AIHUBMIX_CACHE_MODE 必须是 {', '.join(CACHE_MODES)} 之一")
+        if self.default_response_mode not in RESPONSE_MODES:
+            raise ValueError(f"AIHUBMIX_RESPONSE_MODE 必须是 {', '.join(RESPONSE_MODES)} 之一")
+
+    async def _startup(self):
+        """创建服务器生命周期内共享的资源"""
+        if self.http_client is None:
+            self.http_client = create_http_client()
+        self._download_slots = asyncio.Semaphore(self.download_concurrency)
+        self.janitor.start()
+        self._warmup_task = asyncio.ensure_future(self._warmup())
+
+    def _mark_started(self):
+        """记录从进程启动到开始处理请求的耗时"""
+        self.startup_seconds = startup_elapsed()
+        logger.info("⏱️ 启动用时 %.3f 秒", self.startup_seconds)
+
+    async def _shutdown(self):
+        """释放共享资源"""
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+            await asyncio.gather(self._warmup_task, return_exceptions=True)
+            self._warmup_task = None
+        await self.janitor.stop()
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+        if self.result_cache is not None:
+            self.result_cache.close()
+        self.derivatives.shutdown()
+        self.image_store.close()
+        self.file_io.shutdown()
+
+    def _register_metrics(self):
+        """注册抓取时从已有统计读取的指标"""
+        registry = self.metrics.registry
+        registry.gauge_func(
+            "aihubmix_upstream_inflight", "正在进行的上游生成请求数", lambda: self.limiter.active
+        )
+        registry.gauge_func(
+            "aihubmix_upstream_queued", "等待限流名额的上游生成请求数", lambda: self.limiter.waiting
+        )
+        registry.gauge_func(
+            "aihubmix_ready", "上游连接测试是否已通过", lambda: 1 if self.readiness == "ready" else 0
+        )
+        registry.gauge_func(
+            "aihubmix_startup_seconds", "从进程启动到开始处理请求的秒数", lambda: self.startup_seconds
+        )
+        # 地址池各条目的负载与健康状态，按条目名称打标签
+        pool = self.upstream
+
+        def per_entry(field: str):
+            return lambda: {(entry["name"],): entry[field] for entry in pool.stats()}
+
+        registry.gauge_func(
+            "aihubmix_upstream_entry_outstanding", "各上游条目未完成的请求数",
+            per_entry("outstanding"), labelnames=("entry",)
+        )
+        registry.gauge_func(
+            "aihubmix_upstream_entry_budget", "各上游条目剩余限流额度比例",
+            per_entry("budget"), labelnames=("entry",)
+        )
+        registry.gauge_func(
+            "aihubmix_upstream_entry_ejected", "上游条目是否被摘除",
+            per_entry("ejected"), labelnames=("entry",)
+        )
+        registry.counter_func(
+            "aihubmix_upstream_entry_requests_total", "发往各上游条目的请求数",
+            per_entry("requests"), labelnames=("entry",)
+        )
+        registry.counter_func(
+            "aihubmix_upstream_entry_failures_total", "各上游条目的失败次数",
+            per_entry("failures"), labelnames=("entry",)
+        )
+        if self.result_cache is not None:
+            cache = self.result_cache
+            registry.counter_func("aihubmix_cache_hits_total", "结果缓存命中次数", lambda: cache.hits)
+            registry.counter_func("aihubmix_cache_misses_total", "结果缓存未命中次数", lambda: cache.misses)
+            registry.counter_func("aihubmix_cache_evictions_total", "结果缓存淘汰条目数", lambda: cache.evictions)
+        if self.janitor.enabled:
+            janitor = self.janitor
+            registry.gauge_func("aihubmix_image_store_bytes", "图像存储的总字节数", lambda: janitor.total_bytes)
+            registry.gauge_func("aihubmix_image_store_objects", "图像存储的对象数", lambda: janitor.objects)
+            registry.counter_func(
+                "aihubmix_image_store_evicted_total", "超出大小上限被淘汰的图像数", lambda: janitor.evicted
+            )
+            registry.counter_func(
+                "aihubmix_image_store_expired_total", "超过保存时间被淘汰的图像数", lambda: janitor.expired
+            )
+            registry.counter_func(
+                "aihubmix_image_store_reclaimed_bytes_total", "淘汰图像回收的字节数", lambda: janitor.reclaimed_bytes
+            )
+        derivatives = self.derivatives
+        registry.counter_func(
+            "aihubmix_derivatives_generated_total", "生成的派生图数", lambda: derivatives.generated
+        )
+        registry.counter_func(
+            "aihubmix_derivative_hits_total", "直接使用已缓存派生图的次数", lambda: derivatives.hits
+        )
+        if self.hedger is not None:
+            hedger = self.hedger
+            registry.counter_func("aihubmix_hedges_total", "发出的对冲请求数", lambda: hedger.hedged)
+            registry.counter_func(
+                "aihubmix_hedge_wins_total", "对冲请求先于第一次请求成功的次数", lambda: hedger.hedge_wins
+            )
+            registry.counter_func(
+                "aihubmix_hedge_budget_exhausted_total", "因预算不足未发出对冲请求的次数",
+                lambda: hedger.budget_exhausted
+            )
+        if self.singleflight is not None:
+            flight = self.singleflight
+            registry.counter_func(
+                "aihubmix_coalesce_leaders_total", "实际发往上游的生成请求数", lambda: flight.leaders
+            )
+            registry.counter_func(
+                "aihubmix_coalesced_requests_total", "合并到进行中请求的生成请求数", lambda: flight.coalesced
+            )
+
+    def _service_stats(self) -> Dict[str, Any]:
+        """运行统计，供健康检查等接口展示"""
+        stats: Dict[str, Any] = {
+            "readiness": self._readiness_stats(),
+            "upstream": self.limiter.stats(),
+            "upstream_pool": self.upstream.stats(),
+        }
+        if self.result_cache is not None:
+            stats["cache"] = self.result_cache.stats()
+        if self.singleflight is not None:
+            stats["coalescing"] = self.singleflight.stats()
+        if self.hedger is not None:
+            stats["hedging"] = self.hedger.stats()
+        if self.janitor.enabled:
+            stats["storage"] = self.janitor.stats()
+        stats["derivatives"] = self.derivatives.stats()
+        return stats
+
+    def _readiness_stats(self) -> Dict[str, Any]:
+        return {
+            "status": self.readiness,
+            "startup_seconds": None if self.startup_seconds is None else round(self.startup_seconds, 3),
+            "warmup_seconds": None if self.warmup_seconds is None else round(self.warmup_seconds, 3),
+        }
+
+    async def _warmup(self):
+        """后台测试上游连接，至少一个条目可用时进入就绪状态，否则按间隔重试"""
+        started = time.monotonic()
+        while True:
+            if await self._test_connection() > 0:
+                self.readiness = "ready"
+                self.warmup_seconds = time.monotonic() - started
+                logger.info("✅ 上游连接测试通过，用时 %.2f 秒", self.warmup_seconds)
+                return
+            self.readiness = "unavailable"
+            logger.warning("⚠️ 没有可用的上游条目，%.0f 秒后重新测试", self.warmup_retry_interval)
+            await asyncio.sleep(self.warmup_retry_interval)
+
+    async def _test_connection(self) -> int:
+        """并行测试每个上游条目的 API 连接，认证失败的条目直接摘除，返回连接成功的条目数
+
+        同时预先建立连接：每个基础 URL 至少并行发出 warmup_connections 个请求，
+        首批生成请求不必各自等待建立连接。
+        """
+        async def probe(entry: UpstreamEndpoint) -> bool:
+            try:
+                response = await self.http_client.get(
+                    entry.url("/models"),
+                    headers=entry.headers,
+                    timeout=self.probe_timeout
+                )
+                if response.status_code == 200:
+                    models = response.json()
+                    logger.info(
+                        "✅ API 连接成功 (%s)，可用模型数量: %d", entry.name, len(models.get('data', []))
+                    )
+                    return True
+                elif response.status_code in AUTH_EJECT_STATUS:
+                    self.upstream.eject(
+                        entry, self.upstream.auth_eject_seconds, f"连接测试状态码: {response.status_code}"
+                    )
+                else:
+                    logger.warning("⚠️ API 连接测试失败 (%s)，状态码: %s", entry.name, response.status_code)
+            except Exception as e:
+                logger.warning("⚠️ API 连接测试失败 (%s): %r", entry.name, e)
+            return False
+
+        async def preconnect(entry: UpstreamEndpoint):
+            # 只为建立连接，结果由 probe 报告
+            try:
+                await self.http_client.get(entry.url("/models"), headers=entry.headers, timeout=self.probe_timeout)
+            except Exception:
+                pass
+
+        extra = []
+        for base_url in self.upstream.base_urls:
+            entries = [entry for entry in self.upstream.endpoints if entry.base_url == base_url]
+            extra.extend(preconnect(entries[0]) for _ in range(self.warmup_connections - len(entries)))
+
+        results = await asyncio.gather(*(probe(entry) for entry in self.upstream.endpoints), *extra)
+        return sum(1 for ok in results if ok)
+
+    async def _handle_tool_call(
+        self,
+        request: Dict[str, Any],
+        notify: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+    ) -> Dict[str, Any]:
+        """处理 tools/call 请求，按工具名分发"""
+        tool_name = (request.get("params") or {}).get("name")
+        if not self.tools.has_tool(tool_name):
+            return {
+                "jsonrpc": "2.0",
+                "id": request.get("id"),
+                "error": {
+                    "code": -32601,
+                    "message": f"未知工具: {tool_name}"
+                }
+            }
+        if tool_name == "generate_images_batch":
+            # 批量生成自行处理截止时间，已完成的条目照常返回
+            return await self._handle_generate_images_batch(request, notify=notify)
+
+        # deadline 参数: 调用方愿意等待的秒数，超过后取消上游调用和图像保存
+        arguments = (request.get("params") or {}).get("arguments")
+        deadline = parse_deadline(arguments.get("deadline")) if isinstance(arguments, dict) else None
+        try:
+            return await run_with_deadline(self._handle_generate_image(request, notify=notify), deadline)
+        except DeadlineExceededError as e:
+            self.cancelled_requests.inc(reason="deadline")
+            logger.warning("⏱️ 工具调用超过截止时间: %s", tool_name)
+            return {
+                "jsonrpc": "2.0",
+                "id": request.get("id"),
+                "error": {
+                    "code": -32603,
+                    "message": str(e)
+                }
+            }
+
+    async def _handle_generate_image(
+        self,
+        request: Dict[str, Any],
+        notify: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+    ) -> Dict[str, Any]:
+        """处理图像生成请求
+
+        notify: 发送 MCP 通知的回调，流式生成时用于发送进度通知
+        """
+        request_id = request.get("id")
+        params = request.get("params", {}).get("arguments", {})
+        progress_token = (request.get("params", {}).get("_meta") or {}).get("progressToken")
+
+        # 在调用上游之前按 inputSchema 校验参数
+        try:
+            self.tools.validate_arguments("generate_image", params)
+        except ToolArgumentError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32602,
+                    "message": str(e)
+                }
+            }
+
+        try:
+            # 提取参数
+            prompt = params.get("prompt")
+            model = params.get("model", self.model)
+            size = params.get("size", "1024x1024")
+            n = params.get("n", 1)
+            filename = params.get("filename", "generated_image")
+            cache = params.get("cache")
+            fanout = params.get("fanout")
+            partial_images = params.get("partial_images")
+            preview = params.get("preview")
+
+            if partial_images is not None:
+                async def on_partial(frame: Dict[str, Any]):
+                    # 客户端提供了 progressToken 时才发送进度通知
+                    if notify is None or progress_token is None:
+                        return
+                    await notify({
+                        "jsonrpc": "2.0",
+                        "method": "notifications/progress",
+                        "params": {
+                            "progressToken": progress_token,
+                            "progress": frame["index"] + 1,
+                            "total": partial_images + 1,
+                            "message": f"已收到第 {frame['index'] + 1} 张预览图"
+                        }
+                    })
+
+                # 流式生成，预览图以进度通知的形式告知客户端
+                result = await self._generate_image_streaming(
+                    prompt=prompt,
+                    model=model,
+                    size=size,
+                    n=n,
+                    filename=filename,
+                    partial_images=partial_images,
+                    on_partial=on_partial
+                )
+            else:
+                # 调用 AIHubMix API
+                result = await self._generate_image_with_aihubmix(
+                    prompt=prompt,
+                    model=model,
+                    size=size,
+                    n=n,
+                    filename=filename,
+                    cache=cache,
+                    fanout=fanout
+                )
+
+            content = [
+                {
+                    "type": "text",
+                    "text": result["message"]
+                }
+            ]
+            if result["saved_files"]:
+                # 图像内容通过 resources/read 按需读取
+                uris = [resource_uri(self.image_store.image_id(path)) for path in result["saved_files"]]
+                content.append({
+                    "type": "text",
+                    "text": f"图像资源: {', '.join(uris)}"
+                })
+                if preview is not None:
+                    spec = DerivativeSpec(preview, preview, params.get("preview_format", "webp"), 80)
+                    content.extend(await self._preview_content(result["saved_files"], spec))
+
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "result": {
+                    "content": content,
+                    "isError": False
+                }
+            }
+
+        except (DeadlineExceededError, asyncio.CancelledError):
+            # 由 _handle_tool_call 按截止时间报告并计数，取消则原样传播
+            raise
+        except ToolArgumentError as e:
+            # 只有在参数组合上才能发现的错误 (如 partial_images 与 n>1 同时使用)
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32602,
+                    "message": str(e)
+                }
+            }
+        except Exception as e:
+            logger.warning("❌ 图像生成失败: %s", e)
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32603,
+                    "message": f"图像生成失败: {str(e)}"
+                }
+            }
+
+    async def _handle_generate_images_batch(
+        self,
+        request: Dict[str, Any],
+        notify: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+    ) -> Dict[str, Any]:
+        """处理批量生成请求，每个条目完成时发送一条进度通知，单个条目失败不影响其他条目"""
+        request_id = request.get("id")
+        params = request.get("params", {}).get("arguments", {})
+        progress_token = (request.get("params", {}).get("_meta") or {}).get("progressToken")
+
+        try:
+            self.tools.validate_arguments("generate_images_batch", params)
+        except ToolArgumentError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32602,
+                    "message": str(e)
+                }
+            }
+
+        items = params["items"]
+        results: List[Dict[str, Any]] = []
+        async for item in self._iter_batch_generation(
+            items,
+            model=params.get("model", self.model),
+            cache=params.get("cache"),
+            concurrency=params.get("concurrency"),
+            deadline=parse_deadline(params.get("deadline"))
+        ):
+            results.append(item)
+            # 客户端提供了 progressToken 时才发送进度通知
+            if notify is not None and progress_token is not None:
+                await notify({
+                    "jsonrpc": "2.0",
+                    "method": "notifications/progress",
+                    "params": {
+                        "progressToken": progress_token,
+                        "progress": len(results),
+                        "total": len(items),
+                        "message": self._batch_item_text(item)
+                    }
+                })
+
+        results.sort(key=lambda item: item["index"])
+        succeeded = sum(1 for item in results if item["status"] == "succeeded")
+        summary = f"批量生成完成: 成功 {succeeded} 个，失败 {len(results) - succeeded} 个"
+        return {
+            "jsonrpc": "2.0",
+            "id": request_id,
+            "result": {
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "\n".join([summary] + [self._batch_item_text(item) for item in results])
+                    }
+                ],
+                # 只有全部条目都失败时才作为错误返回
+                "isError": succeeded == 0
+            }
+        }
+
+    def _batch_item_text(self, item: Dict[str, Any]) -> str:
+        """批量生成中单个条目结果的文字描述"""
+        if item["status"] != "succeeded":
+            return f"[{item['index']}] ❌ {item['filename']}: {item['error']}"
+        uris = [resource_uri(image["id"]) for image in item["images"] if image["status"] == "saved"]
+        return f"[{item['index']}] ✅ {item['filename']}: {', '.join(uris) or item['message']}"
+
+    async def _iter_batch_generation(
+        self,
+        items: List[Dict[str, Any]],
+        model: str,
+        cache: Optional[str] = None,
+        concurrency: Optional[int] = None,
+        deadline: Optional[float] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """并发执行批量生成，按完成顺序逐条产出结果
+
+        每个条目的结果只包含图像引用；条目失败时产出 status=failed 和错误信息。
+        超过截止时间时取消未完成的条目，并把它们作为失败条目产出。
+        """
+        async def generate(index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+            result = await self._generate_image_with_aihubmix(
+                prompt=item["prompt"],
+                model=model,
+                size=item.get("size", "1024x1024"),
+                n=item.get("n", 1),
+                filename=item["filename"],
+                cache=cache
+            )
+            return await self._image_refs(result)
+
+        # 未指定文件名的条目按序号命名，避免别名互相覆盖
+        items = [{**item, "filename": item.get("filename") or f"batch_{i}"} for i, item in enumerate(items)]
+        logger.info("📦 开始批量生成: %d 个条目", len(items))
+        unfinished = set(range(len(items)))
+        results = map_unordered(generate, items, concurrency or self.batch_concurrency)
+        try:
+            async for index, refs, error in iter_with_deadline(results, deadline):
+                unfinished.discard(index)
+                filename = items[index]["filename"]
+                if error is not None:
+                    logger.warning("❌ 批量生成条目 %d 失败: %s", index, error)
+                    self.batch_items.inc(status="failed")
+                    yield {"index": index, "status": "failed", "filename": filename, "error": str(error)}
+                else:
+                    self.batch_items.inc(status="succeeded")
+                    yield {"index": index, "status": "succeeded", "filename": filename, **refs}
+        except DeadlineExceededError as e:
+            logger.warning("⏱️ 批量生成超过截止时间，取消 %d 个未完成的条目", len(unfinished))
+            self.cancelled_requests.inc(reason="deadline")
+            for index in sorted(unfinished):
+                self.batch_items.inc(status="failed")
+                yield {"index": index, "status": "failed", "filename": items[index]["filename"], "error": str(e)}
+
+    async def _handle_resources_list(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """处理 resources/list 请求，列出已保存的图像"""
+        request_id = request.get("id")
+        cursor = (request.get("params") or {}).get("cursor")
+        try:
+            offset = int(cursor) if cursor is not None else 0
+            if offset < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32602,
+                    "message": f"无效的 cursor: {cursor}"
+                }
+            }
+
+        entries, next_offset = await self.image_store.list(offset, RESOURCES_PAGE_SIZE)
+        result: Dict[str, Any] = {
+            "resources": [
+                {
+                    "uri": resource_uri(entry["id"]),
+                    "name": entry["name"],
+                    "mimeType": entry["mime_type"],
+                    "size": entry["size"]
+                }
+                for entry in entries
+            ]
+        }
+        if next_offset is not None:
+            result["nextCursor"] = str(next_offset)
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    async def _handle_resources_read(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """处理 resources/read 请求，以 base64 返回图像内容"""
+        request_id = request.get("id")
+        uri = (request.get("params") or {}).get("uri")
+        try:
+            image_id, query = parse_resource_uri(uri)
+            # URI 查询参数 (width/height/format/quality) 指定派生图
+            spec = parse_spec(query)
+            if spec is None:
+                data, mime = await self.image_store.read(image_id)
+            else:
+                path, _ = await self.derivatives.get(image_id, spec)
+                data, mime = await self.image_store.read_path(path, image_id)
+        except ImageNotFoundError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32002,
+                    "message": str(e),
+                    "data": {"uri": uri}
+                }
+            }
+        except ValueError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32602,
+                    "message": str(e)
+                }
+            }
+        except DerivativeUnavailableError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": -32603,
+                    "message": str(e)
+                }
+            }
+
+        blob = await self.file_io.run(_encode_base64, data)
+        return {
+            "jsonrpc": "2.0",
+            "id": request_id,
+            "result": {
+                "contents": [
+                    {
+                        "uri": uri,
+                        "mimeType": mime,
+                        "blob": blob
+                    }
+                ]
+            }
+        }
+
+    async def _preview_content(self, saved_files: List[str], spec: DerivativeSpec) -> List[Dict[str, Any]]:
+        """为已保存的图像生成缩略图，作为 MCP image 内容返回"""
+        async def preview(path: str) -> Dict[str, Any]:
+            image_id = self.image_store.image_id(path)
+            derived, _ = await self.derivatives.get(image_id, spec)
+            data, mime = await self.image_store.read_path(derived, image_id)
+            return {
+                "type": "image",
+                "data": await self.file_io.run(_encode_base64, data),
+                "mimeType": mime
+            }
+
+        try:
+            return list(await asyncio.gather(*(preview(path) for path in saved_files)))
+        except (DerivativeUnavailableError, ImageNotFoundError, OSError) as e:
+            # 预览图只是附加内容，失败时不影响生成结果
+            logger.warning("⚠️ 生成预览图失败: %s", e)
+            return [{"type": "text", "text": f"预览图不可用: {e}"}]
+
+    async def _image_refs(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """把生成结果转换为只含图像引用的形式，不包含上游原始数据"""
+        images = result.get("images")
+        if images is None:
+            # 缓存命中的结果只有文件列表
+            images = [
+                {"index": i, "status": "saved", "path": path}
+                for i, path in enumerate(result["saved_files"])
+            ]
+
+        async def describe(image: Dict[str, Any]) -> Dict[str, Any]:
+            if image["status"] != "saved":
+                return image
+            try:
+                return {**image, **await self.image_store.describe(image["path"])}
+            except OSError as e:
+                # 文件在返回前被删除
+                return {"index": image["index"], "status": "failed", "error": str(e)}
+
+        refs = {key: value for key, value in result.items() if key not in ("data", "images")}
+        refs["images"] = list(await asyncio.gather(*(describe(image) for image in images)))
+        return refs
+
+    async def _generate_image_with_aihubmix(
+        self,
+        prompt: str,
+        model: str = "gpt-image-1",
+        size: str = "1024x1024",
+        n: int = 1,
+        filename: str = "generated_image",
+        cache: Optional[str] = None,
+        fanout: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """使用 AIHubMix API 生成图像
+
+        cache: bypass 跳过缓存查找, prefer 优先返回缓存, only 只返回缓存
+        fanout: 拆分后每个上游请求的图像数量，0 表示不拆分，未指定时使用 AIHUBMIX_FANOUT_CHUNK
+        """
+
+        # 查找结果缓存
+        cache_mode = self._resolve_cache_mode(cache)
+        fanout = self._resolve_fanout(fanout)
+        request_key = make_request_key(model, prompt, size, n)
+        if cache_mode != "bypass":
+            cached = await self.result_cache.get(request_key) if self.result_cache else None
+            if cached is not None:
+                logger.debug("♻️ 命中结果缓存: %.12s", request_key)
+                # 缓存命中也算访问，避免被清理任务优先淘汰
+                await self.image_store.touch(cached["saved_files"])
+                return {
+                    "message": cached["message"],
+                    "data": None,
+                    "saved_files": cached["saved_files"],
+                    "cached": True
+                }
+            if cache_mode == "only":
+                raise CacheMissError("未命中结果缓存 (cache=only)")
+
+        async def generate():
+            result = await self._request_generation(prompt, model, size, n, filename, fanout)
+
+            # 所有图像都保存成功时写入缓存
+            if self.result_cache is not None and len(result["saved_files"]) == n:
+                await self.result_cache.put(request_key, result["saved_files"], result["message"])
+            return result
+
+        if self.singleflight is None:
+            return await generate()
+
+        async def shared_generate():
+            # 共享任务不受发起者截止时间的约束，每个等待者各自按截止时间停止等待
+            clear_deadline()
+            return await generate()
+
+        # 相同请求正在进行时等待同一个上游调用
+        result, shared = await run_with_deadline(self.singleflight.do(request_key, shared_generate))
+        if shared:
+            logger.debug("🔗 合并到进行中的相同请求: %.12s", request_key)
+            return {**result, "coalesced": True}
+        return result
+
+    def _resolve_cache_mode(self, cache: Optional[str]) -> str:
+        """确定本次调用的缓存模式"""
+        mode = cache or self.default_cache_mode
+        if mode not in CACHE_MODES:
+            raise ValueError(f"无效的 cache 参数: {mode}，可选值: {', '.join(CACHE_MODES)}")
+        if self.result_cache is None and mode == "prefer":
+            return "bypass"
+        return mode
+
+    def _resolve_fanout(self, fanout: Optional[int]) -> int:
+        """确定本次调用拆分后每个上游请求的图像数量"""
+        if fanout is None:
+            return self.default_fanout
+        if isinstance(fanout, bool) or not isinstance(fanout, int) or fanout < 0:
+            raise ValueError(f"无效的 fanout 参数: {fanout}，必须是非负整数")
+        return fanout
+
+    async def _request_generation(
+        self,
+        prompt: str,
+        model: str,
+        size: str,
+        n: int,
+        filename: str,
+        fanout: int = 0
+    ) -> Dict[str, Any]:
+        """调用上游生成接口并保存图像"""
+
+        # 构建请求数据
+        request_data = {
+            "model": model,
+            "prompt": prompt,
+            "size": size,
+            "n": n
+        }
+
+        # 对于 gpt-image-1 模型，请求 base64 格式的响应
+        if model == "gpt-image-1":
+            request_data["response_format"] = "b64_json"
+
+        set_request_labels(model, size, n)
+
+        logger.debug(
+            "🎨 正在生成图像: 模型=%s 尺寸=%s 数量=%d 响应格式=%s 提示词=%s",
+            model, size, n, request_data.get("response_format", "url"), PromptRef(prompt)
+        )
+
+        try:
+            if fanout and n > fanout:
+                result, images = await self._fan_out_generation(request_data, filename, fanout)
+            else:
+                result, images = await self._call_generation_with_retry(request_data, filename)
+
+            logger.debug("✅ 图像生成成功，创建时间: %s", result.get('created'))
+
+            message, saved_files = self._summarize_images(len(result.get('data') or []), images)
+            return {
+                "message": message,
+                "data": result,
+                "saved_files": saved_files,
+                "images": images
+            }
+
+        except httpx.TimeoutException:
+            raise Exception("请求超时，请检查网络连接")
+        except httpx.ConnectError:
+            raise Exception("无法连接到 AIHubMix API，请检查网络连接")
+        except Exception as e:
+            raise Exception(f"图像生成失败: {str(e)}")
+
+    def _summarize_images(self, generated: int, images: List[Dict[str, Any]]) -> Tuple[str, List[str]]:
+        """根据每张图像的保存结果生成结果消息，返回 (消息, 已保存的文件)"""
+        saved_files = [image["path"] for image in images if image["status"] == "saved"]
+        failed = [image for image in images if image["status"] == "failed"]
+
+        message = f"成功生成 {generated} 张图像"
+        if saved_files:
+            message += f"，已保存到: {', '.join(saved_files)}"
+        if failed:
+            details = "; ".join(f"第 {image['index'] + 1} 张: {image['error']}" for image in failed)
+            message += f"；{len(failed)} 张图像失败 ({details})"
+        return message, saved_files
+
+    def _streaming_generation(
+        self,
+        prompt: str,
+        model: str = "gpt-image-1",
+        size: str = "1024x1024",
+        n: int = 1,
+        filename: str = "generated_image",
+        partial_images: Optional[int] = None
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """校验参数并返回流式生成的事件迭代器
+
+        参数错误在这里直接抛出 ToolArgumentError，调用方可以在开始推送事件前拒绝请求。
+        """
+        if partial_images is None:
+            partial_images = self.default_partial_images
+        if n != 1:
+            raise ToolArgumentError("流式生成只支持 n=1")
+        if isinstance(partial_images, bool) or not isinstance(partial_images, int) or not 0 <= partial_images <= 3:
+            raise ToolArgumentError(f"无效的 partial_images 参数: {partial_images}，必须是 0-3 的整数")
+        return self._iter_streaming_generation(prompt, model, size, filename, partial_images)
+
+    async def _generate_image_streaming(
+        self,
+        prompt: str,
+        model: str = "gpt-image-1",
+        size: str = "1024x1024",
+        n: int = 1,
+        filename: str = "generated_image",
+        partial_images: Optional[int] = None,
+        on_partial: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+    ) -> Dict[str, Any]:
+        """流式生成图像并返回最终结果，每收到一张预览图调用一次 on_partial"""
+        result = None
+        events = self._streaming_generation(prompt, model, size, n, filename, partial_images)
+        async for event, data in events:
+            if event == "partial_image":
+                if on_partial is not None:
+                    await on_partial(data)
+            elif event == "completed":
+                result = data
+        return result
+
+    async def _iter_streaming_generation(
+        self,
+        prompt: str,
+        model: str,
+        size: str,
+        filename: str,
+        partial_images: int
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """以 stream 模式调用生成接口，依次产生 partial_image 和 completed 事件
+
+        预览图原样转发，不写入磁盘；最终图像仍通过 _save_base64_image 保存。
+        流式请求一旦开始就无法安全重放，因此不经过重试逻辑，也不参与缓存查找和请求合并。
+        """
+        request_data = {
+            "model": model,
+            "prompt": prompt,
+            "size": size,
+            "n": 1,
+            "stream": True,
+            "partial_images": partial_images
+        }
+
+        set_request_labels(model, size, 1)
+
+        logger.debug(
+            "🎨 正在流式生成图像: 模型=%s 尺寸=%s 预览图数量=%d 提示词=%s",
+            model, size, partial_images, PromptRef(prompt)
+        )
+
+        final = None
+        received = 0
+        try:
+            # 整个流期间占用一个上游名额
+            async with self.limiter.slot(), self.upstream.lease() as entry:
+                start = time.perf_counter()
+                async with self.http_client.stream(
+                    "POST",
+                    entry.url("/images/generations"),
+                    headers=entry.headers,
+                    json=request_data,
+                    timeout=request_timeout(self.http_client.timeout)
+                ) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                    self._check_response(response, entry)
+
+                    async for event, data in iter_sse_events(response.aiter_lines()):
+                        payload = json.loads(data)
+                        kind = payload.get("type") or event or ""
+                        if kind.endswith("partial_image"):
+                            received += 1
+                            yield "partial_image", {
+                                "index": payload.get("partial_image_index", received - 1),
+                                "b64_json": payload.get("b64_json")
+                            }
+                        elif kind.endswith("completed"):
+                            final = payload
+                        elif kind == "error" or "error" in payload:
+                            error = payload.get("error")
+                            detail = error.get("message") if isinstance(error, dict) else error
+                            raise UpstreamError(f"上游流式生成失败: {detail or data}", response.status_code)
+                self.metrics.observe(self.metrics.upstream_seconds, time.perf_counter() - start)
+        except httpx.TimeoutException:
+            raise Exception("请求超时，请检查网络连接")
+        except httpx.ConnectError:
+            raise Exception("无法连接到 AIHubMix API，请检查网络连接")
+        except Exception as e:
+            raise Exception(f"图像生成失败: {str(e)}")
+
+        if final is None or not final.get("b64_json"):
+            raise Exception("图像生成失败: 上游流在返回最终图像前结束")
+
+        logger.debug("✅ 图像生成成功，共收到 %d 张预览图", received)
+
+        try:
+            path = await self._save_base64_image(final["b64_json"], filename, 0)
+            images = [{"index": 0, "status": "saved", "path": path, "name": self._image_alias(filename)}]
+        except Exception as e:
+            images = [{"index": 0, "status": "failed", "error": str(e)}]
+        final["b64_json"] = None
+
+        message, saved_files = self._summarize_images(1, images)
+        if self.result_cache is not None and saved_files:
+            await self.result_cache.put(make_request_key(model, prompt, size, 1), saved_files, message)
+
+        yield "completed", {
+            "message": message,
+            "data": final,
+            "saved_files": saved_files,
+            "images": images,
+            "partial_images": received
+        }
+
+    async def _fan_out_generation(
+        self,
+        request_data: Dict[str, Any],
+        filename: str,
+        chunk: int
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """把 n 张图像拆分为多个并行上游请求，返回成功的部分和每张图像的错误
+
+        各请求经过同一个限流器，完成后立即保存各自的图像；全部失败时抛出第一个错误。
+        """
+        n = request_data["n"]
+        chunks = [(start, min(chunk, n - start)) for start in range(0, n, chunk)]
+        logger.debug("🔀 拆分为 %d 个并行请求，每个最多 %d 张", len(chunks), chunk)
+
+        outcomes = await asyncio.gather(*(
+            self._call_generation_with_retry({**request_data, "n": count}, filename, start)
+            for start, count in chunks
+        ), return_exceptions=True)
+
+        merged: Dict[str, Any] = {"created": None, "data": []}
+        images: List[Dict[str, Any]] = []
+        errors = []
+        for (start, count), outcome in zip(chunks, outcomes):
+            if isinstance(outcome, asyncio.CancelledError):
+                raise outcome
+            if isinstance(outcome, BaseException):
+                errors.append(outcome)
+                logger.warning("❌ 第 %d-%d 张图像生成失败: %r", start + 1, start + count, outcome)
+                images.extend(
+                    {"index": start + i, "status": "failed", "error": str(outcome) or repr(outcome)}
+                    for i in range(count)
+                )
+                continue
+            result, chunk_images = outcome
+            merged["created"] = max(merged["created"] or 0, result.get("created") or 0) or None
+            merged["data"].extend(result.get("data") or [])
+            images.extend(chunk_images)
+
+        if len(errors) == len(chunks):
+            raise errors[0]
+        images.sort(key=lambda image: image["index"])
+        return merged, images
+
+    async def _call_generation_with_retry(
+        self,
+        request_data: Dict[str, Any],
+        filename: str,
+        index_offset: int = 0
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """经过限流器调用生成接口，429/5xx 和连接错误按退避策略重试
+
+        重试不会超过重试总截止时间，也不会超过调用方指定的截止时间。
+        """
+        loop = asyncio.get_running_loop()
+        left = remaining()
+        deadline = loop.time() + min(self.retry_policy.deadline, left if left is not None else math.inf)
+        attempt = 0
+        # 换用其他条目的次数，每个条目最多换到一次；摘除时间很短时不会无限循环
+        switches = 0
+        while True:
+            attempt += 1
+            try:
+                return await self._attempt_generation(request_data, filename, index_offset)
+            except UpstreamError as e:
+                if (
+                    e.status_code in AUTH_EJECT_STATUS
+                    and self.upstream.available() > 0
+                    and switches < len(self.upstream.endpoints)
+                    and loop.time() < deadline
+                ):
+                    # 出错的条目已被摘除，立即换用其他条目，不计入重试次数
+                    logger.warning("⚠️ %s，换用其他上游条目", e)
+                    switches += 1
+                    attempt -= 1
+                    continue
+                if not e.retryable:
+                    raise
+                error, retry_after = e, e.retry_after
+            except RETRYABLE_TRANSPORT_ERRORS as e:
+                error, retry_after = e, None
+
+            delay = self.retry_policy.delay(attempt, retry_after)
+            if attempt >= self.retry_policy.max_attempts or loop.time() + delay > deadline:
+                raise error
+            logger.warning(
+                "⚠️ 上游请求失败，%.1f 秒后重试 (%d/%d): %r",
+                delay, attempt, self.retry_policy.max_attempts - 1, error
+            )
+            await asyncio.sleep(delay)
+
+    async def _attempt_generation(
+        self,
+        request_data: Dict[str, Any],
+        filename: str,
+        index_offset: int = 0
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """一次生成尝试并保存图像，只有上游请求本身占用限流名额
+
+        开启对冲时只对冲上游请求，按 (model, size, n) 的历史延迟决定是否再并行发出一次，
+        图像只按胜出的响应保存一次。
+        index_offset: 拆分请求时本批图像在整个请求中的起始序号
+        """
+        if self.stream_decode and request_data.get("response_format") == "b64_json":
+            # 边接收边解码，内存占用不随图像数量和尺寸增长；接收时已写盘，不对冲
+            async with self.limiter.slot(), self.upstream.lease() as entry:
+                with self.metrics.time(self.metrics.upstream_seconds):
+                    return await self._stream_generation(request_data, filename, index_offset, entry)
+
+        if self.hedger is None:
+            result = await self._post_generation(request_data)
+        else:
+            key = (request_data.get("model"), request_data.get("size"), request_data.get("n"))
+            result = await self.hedger.run(key, lambda: self._post_generation(request_data))
+        return result, await self._save_images(result, filename, index_offset)
+
+    async def _post_generation(self, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        """调用一次生成接口，返回解析后的响应"""
+        async with self.limiter.slot(), self.upstream.lease() as entry:
+            with self.metrics.time(self.metrics.upstream_seconds):
+                response = await self.http_client.post(
+                    entry.url("/images/generations"),
+                    headers=entry.headers,
+                    json=request_data,
+                    timeout=request_timeout(self.http_client.timeout)
+                )
+            self._check_response(response, entry)
+            with self.metrics.time(self.metrics.parse_seconds):
+                return response.json()
+
+    def _check_response(self, response: httpx.Response, entry: UpstreamEndpoint):
+        """把上游错误状态码转换为异常，401/402 不可重试 (地址池中还有其他条目时换用其他条目)"""
+        status = response.status_code
+        self.metrics.upstream_responses.inc(status=str(status))
+        self.upstream.record_headers(entry, response.headers)
+        if status == 200:
+            return
+        elif status == 401:
+            raise UpstreamError("API 密钥无效，请检查 AIHUBMIX_API_KEY", status)
+        elif status == 402:
+            raise UpstreamError("账户余额不足，请充值", status)
+        elif status == 429:
+            raise UpstreamError(
+                "请求频率过高，请稍后重试", status, retryable=True,
+                retry_after=parse_retry_after(response.headers.get("Retry-After"))
+            )
+        else:
+            raise UpstreamError(
+                f"API 请求失败，状态码: {status}, 响应: {response.text}", status,
+                retryable=status >= 500,
+                retry_after=parse_retry_after(response.headers.get("Retry-After"))
+            )
+
+    async def _save_images(
+        self,
+        result: Dict[str, Any],
+        filename: str,
+        index_offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """并行保存完整响应中的所有图像，返回每张图像的保存结果"""
+        images = result.get('data') or []
+        indexes = []
+        tasks = []
+        for i, image_data in enumerate(images, start=index_offset):
+            if 'url' in image_data:
+                # 下载并保存图像
+                tasks.append(self._download_and_save_image(image_data['url'], filename, i))
+            elif 'b64_json' in image_data:
+                # 保存 base64 图像
+                tasks.append(self._save_base64_image(
+                    image_data['b64_json'], filename, i, batch_size=len(images)
+                ))
+            else:
+                continue
+            indexes.append(i)
+
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        records = []
+        for i, outcome in zip(indexes, outcomes):
+            if isinstance(outcome, BaseException):
+                records.append({"index": i, "status": "failed", "error": str(outcome)})
+            else:
+                records.append({
+                    "index": i, "status": "saved", "path": outcome, "name": self._image_alias(filename, i)
+                })
+        return records
+
+    async def _stream_generation(
+        self,
+        request_data: Dict[str, Any],
+        filename: str,
+        index_offset: int,
+        entry: UpstreamEndpoint
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """流式读取 b64_json 响应，把每张图像分块解码写入目标文件"""
+        async with self.http_client.stream(
+            "POST",
+            entry.url("/images/generations"),
+            headers=entry.headers,
+            json=request_data,
+            timeout=request_timeout(self.http_client.timeout)
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+            self._check_response(response, entry)
+
+            decoder = B64JsonStreamDecoder()
+            writers: Dict[int, ObjectWriter] = {}
+            images = []
+            # 图像在响应中依次出现，解码耗时计入当前正在接收的图像
+            decode_time = write_time = 0.0
+            try:
+                async for chunk in response.aiter_bytes():
+                    start = time.perf_counter()
+                    events = decoder.feed(chunk)
+                    decode_time += time.perf_counter() - start
+                    for index, data, done in events:
+                        index += index_offset
+                        start = time.perf_counter()
+                        if index not in writers:
+                            writers[index] = await self.image_store.open_writer()
+                        writer = writers[index]
+                        if data:
+                            await self.file_io.run(writer.write, data)
+                            self.metrics.bytes_written.inc(len(data))
+                        if done:
+                            del writers[index]
+                            file_path = await self.image_store.commit(writer, self._image_alias(filename, index))
+                        write_time += time.perf_counter() - start
+                        if done:
+                            self.metrics.observe(self.metrics.decode_seconds, decode_time)
+                            self.metrics.observe(self.metrics.write_seconds, write_time)
+                            decode_time = write_time = 0.0
+                            logger.debug("💾 图像已保存: %s", file_path)
+                            images.append({
+                                "index": index, "status": "saved", "path": file_path,
+                                "name": self._image_alias(filename, index)
+                            })
+                result = decoder.finish()
+            finally:
+                # 清理未写完的临时文件
+                for writer in writers.values():
+                    await self.image_store.discard(writer)
+
+        return result, images
+
+    async def _download_and_save_image(self, url: str, filename: str, index: int = 0) -> str:
+        """下载并保存图像，失败时按配置重试，最终失败抛出异常"""
+        alias = self._image_alias(filename, index)
+        attempts = self.download_retries + 1
+
+        for attempt in range(attempts):
+            try:
+                async with self._download_slots:
+                    file_path = await self._download_to_store(url, alias)
+                logger.debug("💾 图像已保存: %s", file_path)
+                return file_path
+            except DownloadError as e:
+                backoff = self.download_retry_backoff * (2 ** attempt)
+                left = remaining()
+                # 等待后已超过调用方的截止时间时不再重试
+                if not e.retryable or attempt + 1 >= attempts or (left is not None and backoff >= left):
+                    logger.warning("❌ 下载图像失败: %s", e)
+                    raise
+                logger.info("⚠️ 下载图像失败，准备重试 (%d/%d): %s", attempt + 1, self.download_retries, e)
+            await asyncio.sleep(backoff)
+
+    async def _download_to_store(self, url: str, alias: str) -> str:
+        """流式下载图像，分块写入图像存储，返回保存路径"""
+        try:
+            async with self.http_client.stream(
+                "GET", url, timeout=request_timeout(self.download_timeout)
+            ) as response:
+                if response.status_code != 200:
+                    raise DownloadError(
+                        f"状态码: {response.status_code}",
+                        retryable=response.status_code == 429 or response.status_code >= 500
+                    )
+
+                writer = await self.image_store.open_writer()
+                write_time = 0.0
+                try:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        start = time.perf_counter()
+                        await self.file_io.run(writer.write, chunk)
+                        write_time += time.perf_counter() - start
+                except BaseException:
+                    await self.image_store.discard(writer)
+                    raise
+                start = time.perf_counter()
+                file_path = await self.image_store.commit(writer, alias)
+                self.metrics.observe(self.metrics.write_seconds, write_time + time.perf_counter() - start)
+                self.metrics.bytes_written.inc(writer.size)
+                return file_path
+        except httpx.TransportError as e:
+            raise DownloadError(f"网络错误: {e!r}", retryable=True)
+        except OSError as e:
+            raise DownloadError(f"写入文件失败: {e}", retryable=False)
+
+    async def _save_base64_image(
+        self,
+        b64_data: str,
+        filename: str,
+        index: int = 0,
+        batch_size: int = 1
+    ) -> str:
+        """保存 base64 编码的图像，解码和写入在执行器中完成"""
+        try:
+            file_path, size, decode_time, write_time = await self.image_store.put_base64(
+                b64_data, self._image_alias(filename, index), batch_size
+            )
+        except Exception as e:
+            logger.warning("❌ 保存 base64 图像失败: %s", e)
+            raise
+
+        self.metrics.observe(self.metrics.decode_seconds, decode_time)
+        self.metrics.observe(self.metrics.write_seconds, write_time)
+        self.metrics.bytes_written.inc(size)
+
+        logger.debug("💾 图像已保存: %s", file_path)
+        return file_path
+
+    def _image_alias(self, filename: str, index: int = 0) -> str:
+        """图像在存储中的别名，与旧版本的文件名一致"""
+        suffix = f"_{index}" if index > 0 else ""
+        return f"{filename}{suffix}.png"
+
+
+def _encode_base64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
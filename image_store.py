@@ -0,0 +1,635 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内容寻址的图像存储
+图像按内容的 SHA-256 命名并分片保存在 images/objects/ab/cd/<sha256>.png，相同内容只保存一份；
+调用方指定的 filename 作为别名记录在 SQLite 索引中，不再决定磁盘上的文件名。
+HTTP 的 /images/{id} 和 MCP 的 resources/read 通过图像 id (SHA-256) 或别名读取图像。
+"""
+
+import asyncio
+import binascii
+import hashlib
+import os
+import posixpath
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, quote, unquote
+
+from file_io import FileIOExecutor, discard_temp_file, open_temp_file
+
+MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+DEFAULT_EXT = ".png"
+
+# 对象目录，位于 images/ 下
+OBJECTS_DIR = "objects"
+
+# MCP 资源 URI 前缀
+RESOURCE_URI_PREFIX = "aihubmix://images/"
+
+# 计算哈希时每次读取的块大小
+HASH_CHUNK_SIZE = 256 * 1024
+
+# 访问时间的更新间隔 (秒)，避免每次读取都写数据库
+ACCESS_UPDATE_INTERVAL = 60.0
+
+# 核对分片时不清除这段时间内登记的索引条目，避免误删其他 worker 刚提交的对象 (秒)
+RECONCILE_GRACE = 60.0
+
+_SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ImageNotFoundError(Exception):
+    """图像 id 无效或文件不存在"""
+
+
+def resource_uri(image_id: str) -> str:
+    """图像 id 对应的 MCP 资源 URI"""
+    return RESOURCE_URI_PREFIX + quote(image_id)
+
+
+def parse_resource_uri(uri: str) -> Tuple[str, Dict[str, str]]:
+    """从 MCP 资源 URI 中取出 (图像 id, 查询参数)，查询参数用于指定派生图"""
+    if not isinstance(uri, str) or not uri.startswith(RESOURCE_URI_PREFIX):
+        raise ImageNotFoundError(f"未知资源: {uri}")
+    path, _, query = uri[len(RESOURCE_URI_PREFIX):].partition("?")
+    return unquote(path), dict(parse_qsl(query))
+
+
+def mime_type(path: str) -> str:
+    """按扩展名确定 MIME 类型"""
+    return MIME_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+
+def make_etag(stat: os.stat_result) -> str:
+    """由修改时间和大小生成 ETag，文件被覆盖后随之变化"""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def object_path(root: str, digest: str, ext: str = DEFAULT_EXT) -> str:
+    """对象的保存路径，按哈希前两级分片，每级 256 个目录"""
+    return os.path.join(root, OBJECTS_DIR, digest[:2], digest[2:4], digest + ext)
+
+
+class ObjectWriter:
+    """分块写入一个对象：边写边计算哈希，提交时按内容命名
+
+    所有方法都是阻塞的文件操作，需要在执行器中调用。
+    """
+
+    def __init__(self, root: str, ext: str = DEFAULT_EXT):
+        self.root = root
+        self.ext = ext
+        self.size = 0
+        self._digest = hashlib.sha256()
+        # 临时文件与对象在同一文件系统，提交时可以原子重命名
+        self._file = open_temp_file(os.path.join(root, OBJECTS_DIR, "incoming" + ext))
+
+    def write(self, data: bytes):
+        self._digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self) -> Tuple[str, str]:
+        """关闭临时文件并移动到内容地址，返回 (SHA-256, 路径)；相同内容已存在时直接丢弃"""
+        self._file.close()
+        digest = self._digest.hexdigest()
+        path = object_path(self.root, digest, self.ext)
+        if os.path.exists(path):
+            os.remove(self._file.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._file.name, path)
+        return digest, path
+
+    def discard(self):
+        """删除未写完的临时文件"""
+        discard_temp_file(self._file)
+
+
+def derivative_path(source: str, digest: str, tag: str, ext: str) -> str:
+    """派生图 (缩略图、转码) 的路径，与原图在同一目录，原图被淘汰时一并删除"""
+    return os.path.join(os.path.dirname(source), f"{digest}.{tag}{ext}")
+
+
+def _remove_derivatives(path: str, digest: str):
+    """删除原图旁边的所有派生图"""
+    directory = os.path.dirname(path)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(digest + "."):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def store_bytes(root: str, data: bytes, ext: str = DEFAULT_EXT) -> Tuple[str, str]:
+    """保存完整内容，返回 (SHA-256, 路径)"""
+    writer = ObjectWriter(root, ext)
+    try:
+        writer.write(data)
+    except BaseException:
+        writer.discard()
+        raise
+    return writer.commit()
+
+
+def decode_base64_to_store(root: str, b64_data: str, ext: str = DEFAULT_EXT) -> Tuple[str, str, int, float, float]:
+    """解码 base64 并保存为对象 (可在子进程中执行)
+
+    返回 (SHA-256, 路径, 字节数, 解码耗时, 写入耗时)，耗时单位为秒。
+    """
+    start = time.perf_counter()
+    data = binascii.a2b_base64(b64_data)
+    decoded = time.perf_counter()
+    digest, path = store_bytes(root, data, ext)
+    return digest, path, len(data), decoded - start, time.perf_counter() - decoded
+
+
+def _next_prefix(prefix: str) -> str:
+    """按字典序紧随前缀所有字符串之后的字符串，用于前缀范围查询"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class ImageStore:
+    """内容寻址的图像存储 (分片对象目录 + SQLite 别名索引)
+
+    图像 id 是内容的 SHA-256；也可以用别名 (调用方的 filename 加序号和扩展名，
+    同名时指向最新的图像) 读取。引入本存储之前直接保存在 images/ 下的文件仍可按相对路径读取，
+    清理任务启用后这些文件被迁移到对象目录，原相对路径成为别名。
+    """
+
+    def __init__(self, root: str, file_io: FileIOExecutor):
+        self.root = os.path.realpath(root)
+        self.db_path = os.path.join(self.root, ".image_store.sqlite3")
+        self.file_io = file_io
+        # SQLite 连接只在这个单线程执行器中使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-store")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    # ---- 写入 ----
+
+    async def put_base64(self, b64_data: str, name: str, batch_size: int = 1) -> Tuple[str, int, float, float]:
+        """解码并保存 base64 图像，记录别名，返回 (路径, 字节数, 解码耗时, 写入耗时)"""
+        digest, path, size, decode_time, write_time = await self.file_io.run_batch(
+            decode_base64_to_store, batch_size, self.root, b64_data
+        )
+        await self._run(self._db_add, digest, size, DEFAULT_EXT, name)
+        return path, size, decode_time, write_time
+
+    async def open_writer(self, ext: str = DEFAULT_EXT) -> ObjectWriter:
+        """开始分块写入一个对象，写入通过 file_io.run(writer.write, ...) 进行"""
+        return await self.file_io.run(ObjectWriter, self.root, ext)
+
+    async def commit(self, writer: ObjectWriter, name: str) -> str:
+        """提交分块写入的对象并记录别名，返回对象路径"""
+        digest, path = await self.file_io.run(writer.commit)
+        await self._run(self._db_add, digest, writer.size, writer.ext, name)
+        return path
+
+    async def discard(self, writer: ObjectWriter):
+        """放弃分块写入的对象"""
+        await self.file_io.run(writer.discard)
+
+    # ---- 读取 ----
+
+    def image_id(self, path: str) -> str:
+        """已保存文件的图像 id：对象为 SHA-256，旧文件为相对于 images/ 的路径"""
+        relative = os.path.relpath(os.path.realpath(path), self.root).replace(os.sep, "/")
+        if relative.startswith(OBJECTS_DIR + "/"):
+            return os.path.splitext(posixpath.basename(relative))[0]
+        return relative
+
+    async def locate(self, image_id: str) -> Tuple[str, os.stat_result]:
+        """按 id 或别名查找图像，返回 (文件路径, stat 结果)"""
+        return await self._run(self._locate, image_id)
+
+    async def locate_object(self, image_id: str) -> Tuple[str, str]:
+        """按 id 或别名查找内容寻址的对象，返回 (SHA-256, 路径)"""
+        path, _ = await self.locate(image_id)
+        digest = self.image_id(path)
+        if not _SHA256_PATTERN.match(digest):
+            raise ImageNotFoundError(f"旧版本保存的图像不支持派生图: {image_id}")
+        return digest, path
+
+    async def add_derived_size(self, digest: str, size: int):
+        """记录新生成的派生图大小，计入存储总大小"""
+        await self._run(self._db_add_derived_size, digest, size)
+
+    async def touch(self, paths: List[str]):
+        """记录对象被访问 (如结果缓存命中)，用于按最近访问时间淘汰"""
+        digests = [self.image_id(path) for path in paths]
+        await self._run(self._db_touch, [d for d in digests if _SHA256_PATTERN.match(d)])
+
+    async def describe(self, path: str) -> Dict[str, Any]:
+        """已保存图像的引用: id、路径、大小、SHA-256 和 MIME 类型"""
+        image_id = self.image_id(path)
+        stat = await self.file_io.run(os.stat, path)
+        digest = image_id if _SHA256_PATTERN.match(image_id) else await self.file_io.run(_sha256_file, path)
+        return {
+            "id": image_id,
+            "path": path,
+            "size": stat.st_size,
+            "sha256": digest,
+            "mime_type": mime_type(path),
+            "url": f"/images/{quote(image_id)}",
+            "uri": resource_uri(image_id),
+        }
+
+    async def read(self, image_id: str) -> Tuple[bytes, str]:
+        """读取整个图像文件，返回 (内容, MIME 类型)"""
+        path, _ = await self.locate(image_id)
+        return await self.read_path(path, image_id)
+
+    async def read_path(self, path: str, image_id: str) -> Tuple[bytes, str]:
+        """读取已定位的图像文件 (原图或派生图)，返回 (内容, MIME 类型)"""
+        try:
+            data = await self.file_io.run(_read_file, path)
+        except OSError:
+            raise ImageNotFoundError(f"图像不存在: {image_id}")
+        return data, mime_type(path)
+
+    async def list(self, offset: int = 0, limit: int = 100) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """按保存时间从新到旧列出图像别名，返回 (本页条目, 下一页偏移)"""
+        rows = await self._run(self._db_list, offset, limit + 1)
+        next_offset = offset + limit if len(rows) > limit else None
+        return [
+            {"id": digest, "name": name, "size": size, "mime_type": MIME_TYPES.get(ext.lower(), "application/octet-stream")}
+            for name, digest, size, ext in rows[:limit]
+        ], next_offset
+
+    # ---- 维护 ----
+
+    async def usage(self) -> Tuple[int, int]:
+        """返回 (对象数, 总字节数)"""
+        return await self._run(self._db_usage)
+
+    async def evict(self, limit: int, accessed_before: float,
+                    need_bytes: Optional[int] = None) -> Tuple[int, int]:
+        """按最近访问时间从旧到新删除对象及其别名，返回 (删除的文件数, 回收的字节数)
+
+        只考虑 accessed_before 之前访问过的对象，每次最多 limit 个；
+        指定 need_bytes 时回收到足够的字节数即停止。
+        """
+        return await self._run(self._db_evict, limit, accessed_before, need_bytes)
+
+    async def reconcile_shard(self, shard: str, temp_max_age: float) -> Tuple[int, int]:
+        """核对一个一级分片目录与索引，返回 (补登记的对象数, 清除的失效条目数)
+
+        索引丢失或多个版本混用时，磁盘上有文件但索引中没有的对象按文件修改时间补登记，
+        索引中有记录但文件已不存在的对象从索引中删除；同时删除原图已不存在的派生图和
+        超过 temp_max_age 秒的临时文件。
+        """
+        return await self._run(self._reconcile_shard, shard, time.time() - temp_max_age)
+
+    async def migrate_legacy(self, limit: int, modified_before: float) -> int:
+        """把引入本存储之前直接保存在 images/ 下的文件移入对象目录，返回迁移的文件数
+
+        原相对路径记录为别名，按原 id 读取不受影响；文件修改时间作为保存和访问时间，
+        之后与其他对象一样计入总大小并按保存时间淘汰。只迁移 modified_before 之前修改过的文件，
+        每次最多 limit 个。
+        """
+        return await self._run(self._migrate_legacy, limit, modified_before)
+
+    async def remove_stale_temp_files(self, max_age: float) -> int:
+        """删除进程崩溃等原因遗留的临时文件，返回删除数量"""
+        return await self.file_io.run(self._remove_stale_temp_files, max_age)
+
+    def close(self):
+        """关闭数据库连接"""
+        self._executor.submit(self._db_close).result()
+        self._executor.shutdown(wait=True)
+
+    # ---- 内部实现 ----
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _locate(self, image_id: str) -> Tuple[str, os.stat_result]:
+        if not isinstance(image_id, str) or not image_id or "\x00" in image_id:
+            raise ImageNotFoundError(f"无效的图像 id: {image_id}")
+
+        # 1. 内容哈希 (可带扩展名)
+        stem, ext = os.path.splitext(image_id)
+        if _SHA256_PATTERN.match(stem) and (not ext or ext.lower() in MIME_TYPES):
+            for candidate in ([ext.lower()] if ext else MIME_TYPES):
+                path = object_path(self.root, stem, candidate)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                self._db_touch([stem])
+                return path, stat
+            raise ImageNotFoundError(f"图像不存在: {image_id}")
+
+        # 2. 别名，指向最新保存的图像
+        row = self._db().execute(
+            "SELECT a.sha256, o.ext FROM aliases a JOIN objects o ON o.sha256 = a.sha256"
+            " WHERE a.name = ? ORDER BY a.created_at DESC LIMIT 1", (image_id,)
+        ).fetchone()
+        if row is not None:
+            path = object_path(self.root, row[0], row[1])
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # 迁移旧文件时别名先于文件移动登记，此时按旧文件查找
+                stat = None
+            if stat is not None:
+                self._db_touch([row[0]])
+                return path, stat
+
+        # 3. 旧版本直接保存在 images/ 下的文件
+        path = self._resolve_legacy(image_id)
+        try:
+            return path, os.stat(path)
+        except OSError:
+            raise ImageNotFoundError(f"图像不存在: {image_id}")
+
+    def _resolve_legacy(self, image_id: str) -> str:
+        """旧文件的路径，拒绝目录之外、对象目录和不对外暴露的文件"""
+        if image_id.startswith("/"):
+            raise ImageNotFoundError(f"无效的图像 id: {image_id}")
+        parts = posixpath.normpath(image_id).split("/")
+        if parts[0] == OBJECTS_DIR or any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+            raise ImageNotFoundError(f"无效的图像 id: {image_id}")
+        if os.path.splitext(parts[-1])[1].lower() not in MIME_TYPES:
+            raise ImageNotFoundError(f"无效的图像 id: {image_id}")
+        path = os.path.realpath(os.path.join(self.root, *parts))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise ImageNotFoundError(f"无效的图像 id: {image_id}")
+        return path
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            # WAL 模式允许多个 worker 进程同时读写
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                " sha256 TEXT PRIMARY KEY,"
+                " ext TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL DEFAULT 0,"
+                " derived_size INTEGER NOT NULL DEFAULT 0)"
+            )
+            # 旧版本创建的索引缺少的列
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(objects)")]
+            if "last_access" not in columns:
+                self._conn.execute("ALTER TABLE objects ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+                self._conn.execute("UPDATE objects SET last_access = created_at")
+            if "derived_size" not in columns:
+                self._conn.execute("ALTER TABLE objects ADD COLUMN derived_size INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS aliases ("
+                " name TEXT NOT NULL,"
+                " sha256 TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS aliases_name ON aliases (name, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS aliases_created ON aliases (created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _db_add(self, digest: str, size: int, ext: str, name: str):
+        conn = self._db()
+        now = time.time()
+        # 相同内容再次写入也算一次访问
+        conn.execute(
+            "INSERT INTO objects (sha256, ext, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (sha256) DO UPDATE SET last_access = excluded.last_access",
+            (digest, ext, size, now, now),
+        )
+        conn.execute("INSERT INTO aliases (name, sha256, created_at) VALUES (?, ?, ?)", (name, digest, now))
+        conn.commit()
+
+    def _db_touch(self, digests: List[str]):
+        if not digests:
+            return
+        conn = self._db()
+        now = time.time()
+        conn.executemany(
+            "UPDATE objects SET last_access = ? WHERE sha256 = ? AND last_access < ?",
+            [(now, digest, now - ACCESS_UPDATE_INTERVAL) for digest in digests],
+        )
+        conn.commit()
+
+    def _db_add_derived_size(self, digest: str, size: int):
+        conn = self._db()
+        conn.execute("UPDATE objects SET derived_size = derived_size + ? WHERE sha256 = ?", (size, digest))
+        conn.commit()
+
+    def _db_usage(self) -> Tuple[int, int]:
+        count, total = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size + derived_size), 0) FROM objects"
+        ).fetchone()
+        return count, total
+
+    def _db_evict(self, limit: int, accessed_before: float, need_bytes: Optional[int]) -> Tuple[int, int]:
+        conn = self._db()
+        rows = conn.execute(
+            "SELECT sha256, ext, size + derived_size FROM objects WHERE last_access < ?"
+            " ORDER BY last_access ASC LIMIT ?", (accessed_before, limit)
+        ).fetchall()
+        victims = []
+        reclaimed = 0
+        for row in rows:
+            if need_bytes is not None and reclaimed >= need_bytes:
+                break
+            victims.append(row)
+            reclaimed += row[2]
+        if not victims:
+            return 0, 0
+
+        # 先删除索引再删除文件，读者不会找到指向已删除文件的别名
+        conn.executemany("DELETE FROM objects WHERE sha256 = ?", [(row[0],) for row in victims])
+        conn.executemany("DELETE FROM aliases WHERE sha256 = ?", [(row[0],) for row in victims])
+        conn.commit()
+        for digest, ext, _ in victims:
+            path = object_path(self.root, digest, ext)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            _remove_derivatives(path, digest)
+        return len(victims), reclaimed
+
+    def _reconcile_shard(self, shard: str, stale_before: float) -> Tuple[int, int]:
+        conn = self._db()
+        # 先读取索引再扫描目录：扫描期间其他 worker 提交的对象只会出现在磁盘上，按补登记处理，
+        # 不会因为索引中有而目录列表中没有被当作失效条目
+        scan_started = time.time()
+        indexed = {
+            row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT sha256, ext, created_at FROM objects WHERE sha256 >= ? AND sha256 < ?",
+                (shard, _next_prefix(shard))
+            )
+        }
+
+        on_disk: Dict[str, Tuple[str, os.stat_result]] = {}
+        derived: List[Tuple[str, str]] = []
+        shard_dir = os.path.join(self.root, OBJECTS_DIR, shard)
+        try:
+            subdirs = os.listdir(shard_dir)
+        except FileNotFoundError:
+            subdirs = []
+        for subdir in subdirs:
+            try:
+                entries = os.scandir(os.path.join(shard_dir, subdir))
+            except NotADirectoryError:
+                continue
+            with entries:
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    if _SHA256_PATTERN.match(stem) and ext in MIME_TYPES and entry.is_file():
+                        on_disk[stem] = (ext, entry.stat())
+                    elif _SHA256_PATTERN.match(entry.name[:64]) and entry.name[64:65] == ".":
+                        derived.append((entry.name[:64], entry.path))
+                    elif entry.name.endswith(".part") and entry.stat().st_mtime < stale_before:
+                        # 生成派生图时遗留的临时文件
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+
+        # 原图已不存在的派生图，删除前再确认一次原图确实不存在
+        for digest, path in derived:
+            if digest not in on_disk and not any(
+                os.path.exists(object_path(self.root, digest, ext)) for ext in MIME_TYPES
+            ):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        added = [
+            (digest, ext, stat.st_size, stat.st_mtime, stat.st_mtime)
+            for digest, (ext, stat) in on_disk.items() if digest not in indexed
+        ]
+        # 最近登记的条目可能属于其他 worker 正在提交的对象，留到下一轮再核对；
+        # 删除前重新 stat，文件仍在时保留条目和别名
+        missing = [
+            (digest,) for digest, (ext, created_at) in indexed.items()
+            if digest not in on_disk
+            and created_at < scan_started - RECONCILE_GRACE
+            and not os.path.exists(object_path(self.root, digest, ext))
+        ]
+        if added:
+            conn.executemany(
+                "INSERT OR IGNORE INTO objects (sha256, ext, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)", added
+            )
+        if missing:
+            conn.executemany("DELETE FROM objects WHERE sha256 = ?", missing)
+            conn.executemany("DELETE FROM aliases WHERE sha256 = ?", missing)
+        conn.commit()
+        return len(added), len(missing)
+
+    def _legacy_files(self):
+        """images/ 下对象目录之外的图像文件 (不含隐藏文件和目录)"""
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [
+                name for name in dirnames
+                if not name.startswith(".") and not (directory == self.root and name == OBJECTS_DIR)
+            ]
+            for name in filenames:
+                if not name.startswith(".") and os.path.splitext(name)[1].lower() in MIME_TYPES:
+                    yield os.path.join(directory, name)
+
+    def _migrate_legacy(self, limit: int, modified_before: float) -> int:
+        conn = self._db()
+        migrated = 0
+        for path in self._legacy_files():
+            if migrated >= limit:
+                break
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime >= modified_before:
+                    # 可能仍在被旧版本的进程写入
+                    continue
+                digest = _sha256_file(path)
+            except OSError:
+                continue
+            ext = os.path.splitext(path)[1].lower()
+            name = os.path.relpath(path, self.root).replace(os.sep, "/")
+            # 先登记再移动：中途退出时原文件仍在，下一轮重新迁移，多余的索引条目由分片核对清除
+            conn.execute(
+                "INSERT INTO objects (sha256, ext, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (sha256) DO UPDATE SET last_access = MAX(last_access, excluded.last_access)",
+                (digest, ext, stat.st_size, stat.st_mtime, stat.st_mtime),
+            )
+            conn.execute(
+                "INSERT INTO aliases (name, sha256, created_at) SELECT ?, ?, ?"
+                " WHERE NOT EXISTS (SELECT 1 FROM aliases WHERE name = ? AND sha256 = ?)",
+                (name, digest, stat.st_mtime, name, digest),
+            )
+            conn.commit()
+            target = object_path(self.root, digest, ext)
+            try:
+                if os.path.exists(target):
+                    os.remove(path)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(path, target)
+            except OSError:
+                continue
+            migrated += 1
+        return migrated
+
+    def _remove_stale_temp_files(self, max_age: float) -> int:
+        removed = 0
+        cutoff = time.time() - max_age
+        try:
+            entries = os.scandir(os.path.join(self.root, OBJECTS_DIR))
+        except FileNotFoundError:
+            return 0
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(".part") and entry.is_file():
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    def _db_list(self, offset: int, limit: int) -> List[Tuple[str, str, int, str]]:
+        return self._db().execute(
+            "SELECT a.name, a.sha256, o.size, o.ext FROM aliases a JOIN objects o ON o.sha256 = a.sha256"
+            " ORDER BY a.created_at DESC LIMIT ? OFFSET ?", (limit, offset)
+        ).fetchall()
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
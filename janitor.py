@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图像存储清理
+后台任务按最长保存时间和总大小上限淘汰图像，最久未访问的先淘汰；
+引入内容寻址存储之前直接保存在 images/ 下的文件先迁移到对象目录，同样受上限约束；
+每次只处理一批索引条目或一个分片目录，目录再大也不会长时间占用执行器；
+多进程部署时只有持有共享租约的 worker 执行清理
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+from image_store import ImageStore
+from logs import get_logger
+from shared_state import SharedStateStore
+
+logger = get_logger("janitor")
+
+# 最近访问过的对象不淘汰，避免删除刚写入或正在返回给调用方的文件 (秒)
+MIN_IDLE = 60.0
+
+# 遗留临时文件的最长保留时间 (秒)
+STALE_TEMP_AGE = 3600.0
+
+# 多进程部署时清理任务的共享租约名称
+LEASE_NAME = "storage_janitor"
+
+# 一级分片目录 00-ff
+_SHARDS = [f"{i:02x}" for i in range(256)]
+
+
+class StorageJanitor:
+    """图像存储的后台清理任务"""
+
+    def __init__(
+        self,
+        store: ImageStore,
+        max_bytes: int = 0,
+        max_age: float = 0.0,
+        interval: float = 300.0,
+        batch_size: int = 500,
+        shards_per_run: int = 16,
+    ):
+        self.store = store
+        self.max_bytes = max(0, max_bytes)
+        self.max_age = max(0.0, max_age)
+        self.interval = max(1.0, interval)
+        self.batch_size = max(1, batch_size)
+        self.shards_per_run = max(1, shards_per_run)
+
+        # 多进程部署时由服务器设置，worker 之间通过租约选出一个执行清理
+        self.shared_store: Optional[SharedStateStore] = None
+        self.leader = False
+
+        self._task: Optional[asyncio.Task] = None
+        self._next_shard = 0
+
+        self.runs = 0
+        self.migrated = 0
+        self.expired = 0
+        self.evicted = 0
+        self.reclaimed_bytes = 0
+        self.objects = 0
+        self.total_bytes = 0
+        self.last_run_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or self.max_age > 0
+
+    def start(self):
+        """启动后台任务，未配置任何上限时不启动"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """停止后台任务"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.leader and self.shared_store is not None:
+            # 交出租约，其他 worker 下一轮即可接管
+            await self.shared_store.run(self.shared_store.release_lease, LEASE_NAME, os.getpid())
+            self.leader = False
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self._acquire_lease():
+                    await self.run_once()
+                else:
+                    # 其他 worker 负责清理，本进程只刷新统计
+                    self.objects, self.total_bytes = await self.store.usage()
+            except Exception as e:
+                logger.warning("⚠️ 图像存储清理失败: %r", e)
+            await asyncio.sleep(self.interval)
+
+    async def _acquire_lease(self) -> bool:
+        """取得或续期清理租约，未共享状态时总是返回 True
+
+        租约有效期为三个清理间隔，持有者退出后由其他 worker 接管。
+        """
+        if self.shared_store is None:
+            return True
+        leader = await self.shared_store.run(
+            self.shared_store.acquire_lease, LEASE_NAME, os.getpid(), self.interval * 3
+        )
+        if leader and not self.leader:
+            logger.info("🧹 本进程 (%d) 负责图像存储清理", os.getpid())
+        self.leader = leader
+        return leader
+
+    async def run_once(self):
+        """执行一轮清理：核对部分分片、迁移旧文件、淘汰过期对象、按总大小上限淘汰"""
+        start = time.perf_counter()
+
+        # 轮流核对分片目录，shards_per_run 轮覆盖整个对象目录
+        for _ in range(self.shards_per_run):
+            shard = _SHARDS[self._next_shard]
+            self._next_shard = (self._next_shard + 1) % len(_SHARDS)
+            added, missing = await self.store.reconcile_shard(shard, STALE_TEMP_AGE)
+            if added or missing:
+                logger.info("🧹 分片 %s: 补登记 %d 个对象，清除 %d 个失效条目", shard, added, missing)
+        await self.store.remove_stale_temp_files(STALE_TEMP_AGE)
+
+        now = time.time()
+        await self._migrate_legacy(now - MIN_IDLE)
+        if self.max_age > 0:
+            self.expired += await self._evict(now - self.max_age)
+
+        self.objects, self.total_bytes = await self.store.usage()
+        if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+            self.evicted += await self._evict(now - MIN_IDLE, self.total_bytes - self.max_bytes)
+            self.objects, self.total_bytes = await self.store.usage()
+            if self.total_bytes > self.max_bytes:
+                logger.warning(
+                    "⚠️ 图像存储 %d 字节仍超出上限 %d 字节 (%d 秒内访问过的图像不会被淘汰)",
+                    self.total_bytes, self.max_bytes, MIN_IDLE
+                )
+
+        self.runs += 1
+        self.last_run_seconds = time.perf_counter() - start
+
+    async def _migrate_legacy(self, modified_before: float):
+        """分批把旧文件迁移到对象目录，使其计入总大小并参与淘汰"""
+        migrated = 0
+        while True:
+            count = await self.store.migrate_legacy(self.batch_size, modified_before)
+            migrated += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(0)
+        if migrated:
+            self.migrated += migrated
+            logger.info("🧹 已将 %d 个旧文件迁移到对象目录", migrated)
+
+    async def _evict(self, accessed_before: float, need_bytes: Optional[int] = None) -> int:
+        """分批淘汰，每批之间让出事件循环，返回删除的文件数"""
+        removed = 0
+        while need_bytes is None or need_bytes > 0:
+            count, reclaimed = await self.store.evict(self.batch_size, accessed_before, need_bytes)
+            if count == 0:
+                break
+            removed += count
+            self.reclaimed_bytes += reclaimed
+            if need_bytes is not None:
+                need_bytes -= reclaimed
+            await asyncio.sleep(0)
+        if removed:
+            logger.info("🧹 已淘汰 %d 张图像", removed)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """清理统计"""
+        return {
+            "enabled": self.enabled,
+            "leader": self.leader if self.shared_store is not None else True,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "objects": self.objects,
+            "total_bytes": self.total_bytes,
+            "runs": self.runs,
+            "migrated": self.migrated,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "last_run_seconds": round(self.last_run_seconds, 4),
+        }
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步图像生成任务
+固定数量的 worker 从有界队列中取任务执行，调用方通过任务 id 查询状态和结果
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from logs import get_logger, new_request_id
+from shared_state import SharedStateStore
+
+logger = get_logger("jobs")
+
+
+class JobQueueFullError(Exception):
+    """任务队列已满"""
+
+
+class JobManager:
+    """有界队列 + 固定大小 worker 池的任务管理器"""
+
+    def __init__(self, workers: int = 4, queue_size: int = 100, ttl: float = 3600.0):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.ttl = ttl
+
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._handler: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
+
+        self.submitted = 0
+        self.rejected = 0
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        """启动 worker，handler 接收任务参数并返回结果"""
+        self._handler = handler
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._worker_tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        """停止 worker，未完成的任务标记为失败"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in self._jobs.values():
+            if job["status"] in ("queued", "running"):
+                self._finish(job, error="服务器关闭，任务已取消")
+
+    async def submit(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """提交任务，队列已满时抛出 JobQueueFullError"""
+        self._purge_expired()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        try:
+            self._queue.put_nowait((job, params))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise JobQueueFullError("任务队列已满，请稍后重试")
+        self._jobs[job["id"]] = job
+        self.submitted += 1
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询任务"""
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """任务统计"""
+        counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0}
+        for job in self._jobs.values():
+            counts[job["status"]] += 1
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            **counts,
+        }
+
+    async def _worker(self):
+        while True:
+            job, params = await self._queue.get()
+            # 任务日志以任务 id 作为关联 id
+            new_request_id(job["id"])
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            try:
+                result = await self._handler(params)
+            except asyncio.CancelledError:
+                self._finish(job, error="服务器关闭，任务已取消")
+                raise
+            except Exception as e:
+                self._finish(job, error=str(e))
+            else:
+                self._finish(job, result=result)
+            finally:
+                self._queue.task_done()
+
+    def _finish(self, job: Dict[str, Any], result: Optional[Dict[str, Any]] = None,
+                error: Optional[str] = None):
+        job["status"] = "failed" if error is not None else "succeeded"
+        job["result"] = result
+        job["error"] = error
+        job["finished_at"] = time.time()
+
+    def _purge_expired(self):
+        """清理超过保留时间的已完成任务"""
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedJobManager(JobManager):
+    """任务表保存在共享存储中的任务管理器，用于多 worker 部署
+
+    任一 worker 接收的任务可以由任一 worker 执行，也可以在任一 worker 上查询。
+    本进程提交任务时立即唤醒本地 worker，其他进程提交的任务通过轮询发现。
+    stats() 中的 running/succeeded/failed 为本进程的数量，queued 为最近一次看到的全局排队数。
+    """
+
+    def __init__(self, store: SharedStateStore, workers: int = 4, queue_size: int = 100,
+                 ttl: float = 3600.0, poll_interval: float = 0.5):
+        super().__init__(workers=workers, queue_size=queue_size, ttl=ttl)
+        self.store = store
+        self.poll_interval = poll_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0}
+        self._running_ids: Dict[str, None] = {}
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        # 上次运行时异常退出的 worker 留下的任务不会再有人完成
+        if os.name != "nt":
+            owners = await self.store.run(self.store.running_job_owners)
+            dead = [pid for pid in owners if pid != os.getpid() and not _pid_alive(pid)]
+            if dead:
+                count = await self.store.run(
+                    self.store.fail_running_jobs, dead, "worker 进程已退出，任务已取消"
+                )
+                logger.warning("⚠️ %d 个任务所在的 worker 进程已退出，已标记为失败", count)
+        self._worker_tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        """停止 worker，本进程正在执行的任务标记为失败，排队任务留给其他 worker"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        await self.store.run(
+            self.store.fail_running_jobs, [os.getpid()], "服务器关闭，任务已取消"
+        )
+
+    async def submit(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """提交任务，全局排队数已满时抛出 JobQueueFullError"""
+        await self._purge_expired_shared()
+        job = await self.store.run(self.store.submit_job, uuid.uuid4().hex, params, self.queue_size)
+        if job is None:
+            self.rejected += 1
+            raise JobQueueFullError("任务队列已满，请稍后重试")
+        self.submitted += 1
+        self._counts["queued"] += 1
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.run(self.store.get_job, job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": self._counts["queued"],
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "shared": True,
+            **self._counts,
+        }
+
+    async def _worker(self):
+        pid = os.getpid()
+        while True:
+            self._wakeup.clear()
+            claimed = await self.store.run(self.store.claim_job, pid)
+            if claimed is None:
+                self._counts["queued"] = 0
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job, params, self._counts["queued"] = claimed
+            new_request_id(job["id"])
+            self._counts["running"] += 1
+            try:
+                result = await self._handler(params)
+            except asyncio.CancelledError:
+                # 由 stop() 统一标记为失败
+                raise
+            except Exception as e:
+                await self._finish_shared(job["id"], error=str(e))
+            else:
+                await self._finish_shared(job["id"], result=result)
+            finally:
+                self._counts["running"] -= 1
+
+    async def _finish_shared(self, job_id: str, result: Optional[Dict[str, Any]] = None,
+                             error: Optional[str] = None):
+        await self.store.run(self.store.finish_job, job_id, result, error)
+        self._counts["failed" if error is not None else "succeeded"] += 1
+
+    async def _purge_expired_shared(self):
+        """清理超过保留时间的已完成任务"""
+        if self.ttl <= 0:
+            return
+        await self.store.run(self.store.purge_jobs, time.time() - self.ttl)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结构化日志
+日志记录经队列交给后台线程写到 stderr 或文件，事件循环上只做一次入队；
+每条记录带有当前请求的关联 id，提示词默认脱敏
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from config import env_bool, env_str
+
+# 当前请求的关联 id，由请求入口设置
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+_ROOT = "aihubmix"
+_listener: Optional[QueueListener] = None
+_log_prompts = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """获取服务日志记录器"""
+    return logging.getLogger(f"{_ROOT}.{name}")
+
+
+def new_request_id(value: Optional[str] = None) -> str:
+    """为当前上下文设置关联 id，未指定时生成一个新的"""
+    rid = value or uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    return rid
+
+
+class PromptRef:
+    """日志中引用提示词，只在记录真正输出时才计算
+
+    默认只输出长度和摘要；MCP_LOG_PROMPTS=true 时输出原文。
+    """
+
+    __slots__ = ("prompt",)
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+
+    def __str__(self) -> str:
+        if _log_prompts:
+            return self.prompt
+        digest = hashlib.sha256(self.prompt.encode("utf-8")).hexdigest()[:8]
+        return f"<已脱敏 长度={len(self.prompt)} sha256={digest}>"
+
+
+class _ContextQueueHandler(QueueHandler):
+    """入队时只附加关联 id，格式化留给后台线程"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id.get()
+        return record
+
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+
+
+class _JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """按环境变量配置日志，重复调用无副作用"""
+    global _listener, _log_prompts
+    if _listener is not None:
+        return
+
+    _log_prompts = env_bool('MCP_LOG_PROMPTS', False)
+    level = env_str('MCP_LOG_LEVEL', 'INFO').upper()
+    log_file = os.getenv('MCP_LOG_FILE')
+
+    if log_file:
+        handler: logging.Handler = logging.FileHandler(log_file, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    if env_str('MCP_LOG_FORMAT', 'text').lower() == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter())
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger(_ROOT)
+    root.setLevel(level)
+    root.addHandler(_ContextQueueHandler(log_queue))
+    # 不交给根记录器，避免与 uvicorn 的日志配置重复输出
+    root.propagate = False
+
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    # 进程退出前写出队列中剩余的日志 (多进程模式下的 worker 没有显式的关闭入口)
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """写出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标
+轻量的 Prometheus 文本格式指标注册表，每个服务器实例使用自己的注册表
+"""
+
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+# 本地操作 (解析、解码、写盘) 的耗时分桶，单位秒
+LOCAL_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 上游请求的耗时分桶，单位秒
+UPSTREAM_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0)
+
+# 当前生成请求的 model/size/n 标签，由请求入口设置，热路径上的计时直接读取
+request_labels: ContextVar[Dict[str, str]] = ContextVar(
+    "request_labels", default={"model": "", "size": "", "n": ""}
+)
+
+
+def set_request_labels(model: str, size: str, n: int):
+    """设置当前上下文中生成请求的指标标签"""
+    request_labels.set({"model": str(model), "size": str(size), "n": str(n)})
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """带标签的指标基类"""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LOCAL_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 每组标签: [各桶计数..., 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0.0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """记录代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(cumulative)}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """抓取时才计算数值的指标，用于已有统计 (队列深度、缓存命中等)
+
+    指定 labelnames 时 func 返回 {标签值元组: 数值}。
+    """
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], Any],
+                 type_name: str = "gauge", labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+        self.type_name = type_name
+
+    def samples(self) -> List[str]:
+        value = self.func()
+        if value is None:
+            return []
+        if self.labelnames:
+            return [
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(float(v))}"
+                for key, v in value.items()
+            ]
+        return [f"{self.name} {_format_value(float(value))}"]
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已注册: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LOCAL_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_func(self, name: str, documentation: str, func: Callable[[], Any],
+                   labelnames: Sequence[str] = ()):
+        """注册抓取时计算的仪表值"""
+        self.register(CallbackMetric(name, documentation, func, "gauge", labelnames))
+
+    def counter_func(self, name: str, documentation: str, func: Callable[[], Any],
+                     labelnames: Sequence[str] = ()):
+        """注册抓取时读取的计数值"""
+        self.register(CallbackMetric(name, documentation, func, "counter", labelnames))
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_REQUEST_LABELS = ("model", "size", "n")
+
+
+class ServiceMetrics:
+    """图像生成服务的热路径指标"""
+
+    def __init__(self):
+        self.registry = Registry()
+        self.upstream_seconds = self.registry.histogram(
+            "aihubmix_upstream_request_seconds", "生成接口单次上游请求耗时",
+            _REQUEST_LABELS, UPSTREAM_BUCKETS
+        )
+        self.parse_seconds = self.registry.histogram(
+            "aihubmix_response_parse_seconds", "生成接口响应 JSON 解析耗时", _REQUEST_LABELS
+        )
+        self.decode_seconds = self.registry.histogram(
+            "aihubmix_base64_decode_seconds", "单张图像 base64 解码耗时", _REQUEST_LABELS
+        )
+        self.write_seconds = self.registry.histogram(
+            "aihubmix_disk_write_seconds", "单张图像写入磁盘耗时", _REQUEST_LABELS
+        )
+        self.upstream_responses = self.registry.counter(
+            "aihubmix_upstream_responses_total", "生成接口按状态码统计的上游响应数", ("status",)
+        )
+        self.bytes_written = self.registry.counter(
+            "aihubmix_image_bytes_written_total", "写入 images/ 的图像字节数"
+        )
+
+    def observe(self, histogram: Histogram, seconds: float):
+        """按当前请求标签记录耗时"""
+        histogram.observe(seconds, **request_labels.get())
+
+    @contextmanager
+    def time(self, histogram: Histogram) -> Iterator[None]:
+        """按当前请求标签记录代码块耗时"""
+        with histogram.time(**request_labels.get()):
+            yield
+
+    def render(self) -> str:
+        return self.registry.render()
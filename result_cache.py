@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图像生成结果缓存
+以规范化请求的哈希为键，映射到 images/ 下已保存的文件
+内存 LRU 作为前端，SQLite 索引保证重启后仍可命中
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+CACHE_MODES = ("bypass", "prefer", "only")
+
+
+class CacheMissError(Exception):
+    """cache=only 时未命中缓存"""
+
+
+def make_request_key(model: str, prompt: str, size: str, n: int) -> str:
+    """计算规范化请求的哈希"""
+    normalized = {
+        "model": str(model).strip().lower(),
+        "prompt": " ".join(str(prompt).split()),
+        "size": str(size).strip().lower(),
+        "n": int(n),
+    }
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """生成结果缓存 (内存 LRU + SQLite 磁盘索引)"""
+
+    def __init__(
+        self,
+        cache_dir: str,
+        ttl: float = 86400.0,
+        max_entries: int = 10000,
+        memory_entries: int = 256,
+    ):
+        self.db_path = os.path.join(cache_dir, ".result_cache.sqlite3")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # SQLite 连接只在这个单线程执行器中使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        self._conn: Optional[sqlite3.Connection] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---- 公共接口 ----
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查找缓存条目，过期或文件已丢失时视为未命中"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if self._is_valid(entry):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._memory.pop(key, None)
+
+        entry = await self._run(self._db_get, key)
+        if entry is not None and self._is_valid(entry):
+            self._remember(key, entry)
+            self.hits += 1
+            return entry
+
+        if entry is not None:
+            await self._run(self._db_delete, key)
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, saved_files: List[str], message: str):
+        """写入缓存条目并按 TTL 和条目数淘汰"""
+        entry = {
+            "saved_files": list(saved_files),
+            "message": message,
+            "created_at": time.time(),
+        }
+        self._remember(key, entry)
+        await self._run(self._db_put, key, entry)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        """关闭数据库连接"""
+        self._executor.submit(self._db_close).result()
+        self._executor.shutdown(wait=True)
+
+    # ---- 内部实现 ----
+
+    def _is_valid(self, entry: Dict[str, Any]) -> bool:
+        if self.ttl > 0 and time.time() - entry["created_at"] > self.ttl:
+            return False
+        return all(os.path.exists(path) for path in entry["saved_files"])
+
+    def _remember(self, key: str, entry: Dict[str, Any]):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            # WAL 模式允许多个 worker 进程同时读写同一个缓存索引
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " saved_files TEXT NOT NULL,"
+                " message TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _db_get(self, key: str) -> Optional[Dict[str, Any]]:
+        conn = self._db()
+        row = conn.execute(
+            "SELECT saved_files, message, created_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        return {
+            "saved_files": json.loads(row[0]),
+            "message": row[1],
+            "created_at": row[2],
+        }
+
+    def _db_put(self, key: str, entry: Dict[str, Any]):
+        conn = self._db()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, saved_files, message, created_at, last_access)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(entry["saved_files"], ensure_ascii=False),
+             entry["message"], entry["created_at"], now),
+        )
+
+        # 淘汰过期条目
+        if self.ttl > 0:
+            cursor = conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,))
+            self.evictions += max(cursor.rowcount, 0)
+
+        # 超出条目上限时淘汰最久未访问的条目
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            cursor = conn.execute(
+                "DELETE FROM entries WHERE key IN ("
+                " SELECT key FROM entries ORDER BY last_access ASC LIMIT ?)",
+                (overflow,),
+            )
+            self.evictions += max(cursor.rowcount, 0)
+        conn.commit()
+
+    def _db_delete(self, key: str):
+        conn = self._db()
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        conn.commit()
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
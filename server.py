@@ -8,403 +8,331 @@ AIHubMix Image MCP Server
 import asyncio
 import json
 import os
+import signal
 import sys
 import io
-import base64
-from datetime import datetime
-from typing import Any, Dict, List, Optional
-import httpx
+from typing import Any, Dict, Optional, Set, Union
 from dotenv import load_dotenv
 
-class AIHubMixImageMCPServer:
+from config import env_float, env_int
+from file_io import write_file_atomic
+from image_service import AIHubMixImageService
+from logs import get_logger, new_request_id, setup_logging, shutdown_logging
+from startup import run
+from stdio_transport import MessageTooLargeError, StdioTransport
+
+# stdin 读到 EOF 的标记
+_EOF = object()
+
+# 请求被客户端取消的标记
+_CANCELLED = object()
+
+# 可以通过 notifications/cancelled 取消的方法
+CANCELLABLE_METHODS = ("tools/call", "resources/read")
+
+logger = get_logger("stdio")
+
+
+def _error_response(request_id: Any, code: int, message: str) -> Dict[str, Any]:
+    """构建 JSON-RPC 错误响应"""
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }
+
+
+def _encode_response(response: Any) -> bytes:
+    """序列化响应，已经是字节的响应原样输出"""
+    if isinstance(response, bytes):
+        return response
+    if isinstance(response, list):
+        return b"[" + b",".join(_encode_response(item) for item in response) + b"]"
+    return json.dumps(response, ensure_ascii=False).encode("utf-8")
+
+
+class AIHubMixImageMCPServer(AIHubMixImageService):
     """AIHubMix 图像生成 MCP 服务器"""
     
-    def __init__(self):
-        self.api_key = os.getenv('AIHUBMIX_API_KEY')
-        self.base_url = os.getenv('AIHUBMIX_BASE_URL', 'http://aihubmix.com')
-        self.model = os.getenv('AIHUBMIX_MODEL', 'gpt-image-1')
-        self.server_name = os.getenv('MCP_SERVER_NAME', 'aihubmix-image-mcp-server')
+    def __init__(self, transport: StdioTransport):
+        super().__init__(default_base_url='http://aihubmix.com', api_prefix='/v1')
+        self.transport = transport
         
-        # 图像保存目录
-        self.image_save_dir = os.path.join(os.path.dirname(__file__), 'images')
+        logger.info("🚀 %s 启动中...", self.server_name)
+        logger.info("📡 API 基础 URL: %s", ", ".join(self.upstream.base_urls))
+        logger.info("🔑 上游条目数: %d", len(self.upstream.endpoints))
+        logger.info("🎨 默认模型: %s", self.model)
+        logger.info("💾 图像保存目录: %s", self.image_save_dir)
         
-        # 验证配置
-        if not self.api_key:
-            raise ValueError("AIHUBMIX_API_KEY 环境变量未设置")
+        # 并发处理配置
+        self.max_concurrency = max(1, env_int('MCP_MAX_CONCURRENCY', 8))
+        self._request_slots: Optional[asyncio.Semaphore] = None
+        self._response_queue: Optional[asyncio.Queue] = None
+        self._inflight: Dict[int, asyncio.Task] = {}
+        # 可被 notifications/cancelled 取消的请求，按 JSON-RPC id 索引
+        self._cancellable: Dict[Any, asyncio.Future] = {}
+        self._client_cancelled: Set[asyncio.Future] = set()
         
-        print(f"🚀 {self.server_name} 启动中...")
-        print(f"📡 API 基础 URL: {self.base_url}")
-        print(f"🎨 默认模型: {self.model}")
-        print(f"💾 图像保存目录: {self.image_save_dir}")
+        # 指标导出：收到 SIGUSR1 或按固定间隔写到文件 (未配置文件时输出到 stderr)
+        self.metrics_interval = env_float('MCP_METRICS_INTERVAL', 0.0)
+        self.metrics_file = os.getenv('MCP_METRICS_FILE')
+        if self.metrics_file:
+            self.metrics_file = os.path.abspath(self.metrics_file)
+        self.metrics.registry.gauge_func(
+            "aihubmix_stdio_inflight_messages", "正在处理的 stdio 消息数", lambda: len(self._inflight)
+        )
     
     async def start(self):
-        """启动 MCP 服务器"""
-        print(f"✅ {self.server_name} 已启动，等待 MCP 请求...")
+        """启动 MCP 服务器，上游连接测试在后台进行，不等待其完成"""
+        # 在事件循环内创建并发控制对象
+        self._request_slots = asyncio.Semaphore(self.max_concurrency)
+        self._response_queue = asyncio.Queue()
         
-        # 测试 API 连接
-        await self._test_connection()
+        # 创建共享资源，后台测试 API 连接
+        await self._startup()
         
-        # 主循环 - 处理 MCP 请求
-        while True:
+        try:
+            await self._serve()
+        finally:
+            await self._shutdown()
+    
+    async def _serve(self):
+        """主循环 - 读取 MCP 消息并为每条消息创建独立任务"""
+        await self.transport.open()
+        logger.info("✅ %s 已启动，等待 MCP 请求...", self.server_name)
+        self._mark_started()
+        writer_task = asyncio.create_task(self._response_writer())
+        metrics_task = self._start_metrics_export()
+        try:
+            while True:
+                try:
+                    # 读取 MCP 消息，EOF 时退出
+                    message = await self._read_request()
+                    if message is _EOF:
+                        break
+                    if message is None:
+                        continue
+                    
+                    # 分发消息，不等待其完成
+                    self._dispatch_message(message)
+                    
+                except KeyboardInterrupt:
+                    logger.info("🛑 %s 正在停止...", self.server_name)
+                    break
+        finally:
+            # 等待进行中的请求完成并写出全部响应
+            if self._inflight:
+                await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+            await self._response_queue.join()
+            writer_task.cancel()
+            if metrics_task is not None:
+                metrics_task.cancel()
+            await self.transport.close()
+    
+    def _start_metrics_export(self) -> Optional[asyncio.Task]:
+        """注册 SIGUSR1 导出指标，配置了间隔时启动定时导出任务"""
+        if hasattr(signal, "SIGUSR1"):
+            loop = asyncio.get_running_loop()
             try:
-                # 读取 MCP 请求
-                request = await self._read_request()
-                if not request:
-                    continue
-                
-                # 处理请求
-                response = await self._handle_request(request)
-                
-                # 发送响应
-                await self._send_response(response)
-                
-            except KeyboardInterrupt:
-                print(f"\n🛑 {self.server_name} 正在停止...")
-                break
-            except Exception as e:
-                print(f"❌ 处理请求时出错: {e}")
-                error_response = {
-                    "jsonrpc": "2.0",
-                    "id": request.get("id") if request else None,
-                    "error": {
-                        "code": -32603,
-                        "message": f"内部错误: {str(e)}"
-                    }
-                }
-                await self._send_response(error_response)
+                loop.add_signal_handler(
+                    signal.SIGUSR1, lambda: asyncio.ensure_future(self._dump_metrics())
+                )
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.metrics_interval > 0:
+            return asyncio.create_task(self._metrics_loop())
+        return None
     
-    async def _test_connection(self):
-        """测试 API 连接"""
+    async def _metrics_loop(self):
+        """按固定间隔导出指标"""
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            await self._dump_metrics()
+    
+    async def _dump_metrics(self):
+        """导出指标注册表，stdout 只用于协议帧，因此写到文件或 stderr"""
+        text = self.metrics.render()
+        if not self.metrics_file:
+            # 显式写到 stderr，不依赖 main() 对 sys.stdout 的重定向
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            return
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{self.base_url}/v1/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
+            await self.file_io.run(write_file_atomic, self.metrics_file, text.encode("utf-8"))
+        except OSError as e:
+            logger.error("❌ 导出指标失败: %s", e)
+    
+    def _dispatch_message(self, message: Any):
+        """为单条消息 (单个请求或批量数组) 创建处理任务"""
+        if isinstance(message, dict) and message.get("method") == "notifications/cancelled":
+            # 取消通知立即处理，不排在并发名额之后
+            self._cancel_request(message.get("params") or {})
+            return
+        task = asyncio.create_task(self._process_message(message))
+        self._inflight[id(task)] = task
+        task.add_done_callback(lambda t: self._inflight.pop(id(t), None))
+    
+    async def _process_message(self, message: Any):
+        """处理单条消息并将响应放入写出队列"""
+        if isinstance(message, list):
+            # JSON-RPC 批量请求：并发处理，响应合并为一个数组
+            if not message:
+                response = _error_response(None, -32600, "无效请求: 空的批量数组")
+            else:
+                responses = await asyncio.gather(
+                    *(self._process_request(request) for request in message)
                 )
-                if response.status_code == 200:
-                    models = response.json()
-                    print(f"✅ API 连接成功，可用模型数量: {len(models.get('data', []))}")
-                else:
-                    print(f"⚠️ API 连接测试失败，状态码: {response.status_code}")
-        except Exception as e:
-            print(f"⚠️ API 连接测试失败: {e}")
+                response = [r for r in responses if r is not None] or None
+        else:
+            response = await self._process_request(message)
+        
+        if response is not None:
+            await self._response_queue.put(response)
     
-    async def _read_request(self) -> Optional[Dict[str, Any]]:
-        """读取 MCP 请求"""
+    async def _process_request(self, request: Any) -> Optional[Union[Dict[str, Any], bytes]]:
+        """处理单个请求，通知 (没有 id) 返回 None"""
+        if not isinstance(request, dict):
+            return _error_response(None, -32600, "无效请求: 请求必须是 JSON 对象")
+        
+        # 每个请求在独立的任务中处理，关联 id 只作用于本请求
+        new_request_id()
+        logger.debug("收到请求: method=%s id=%s", request.get("method"), request.get("id"))
+        
         try:
-            line = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
-            if not line:
-                return None
-            return json.loads(line.strip())
+            if request.get("method") in CANCELLABLE_METHODS and isinstance(request.get("id"), (str, int)):
+                response = await self._run_cancellable(request)
+            else:
+                response = await self._run_request(request)
         except Exception as e:
-            print(f"❌ 读取请求失败: {e}")
+            logger.exception("❌ 处理请求时出错: %s", e)
+            response = _error_response(request.get("id"), -32603, f"内部错误: {str(e)}")
+        
+        # 客户端已放弃该请求，按 MCP 规范不再发送响应
+        if response is _CANCELLED:
+            return None
+        # 通知 (没有 id) 不需要响应
+        if "id" not in request:
             return None
+        return response
+    
+    async def _run_request(self, request: Dict[str, Any]) -> Union[Dict[str, Any], bytes]:
+        """执行单个请求，工具调用受并发上限约束，其余方法立即处理"""
+        if request.get("method") == "tools/call":
+            async with self._request_slots:
+                return await self._handle_request(request)
+        return await self._handle_request(request)
+    
+    async def _run_cancellable(self, request: Dict[str, Any]) -> Any:
+        """在独立任务中执行请求，登记后可被 notifications/cancelled 取消，取消时返回 _CANCELLED"""
+        request_key = request["id"]
+        work = asyncio.ensure_future(self._run_request(request))
+        self._cancellable[request_key] = work
+        try:
+            return await work
+        except asyncio.CancelledError:
+            if work not in self._client_cancelled:
+                raise
+            self._client_cancelled.discard(work)
+            return _CANCELLED
+        finally:
+            if self._cancellable.get(request_key) is work:
+                del self._cancellable[request_key]
+    
+    def _cancel_request(self, params: Dict[str, Any]):
+        """处理 notifications/cancelled：取消仍在进行的请求，释放上游名额并停止保存图像"""
+        request_key = params.get("requestId")
+        work = self._cancellable.pop(request_key, None) if isinstance(request_key, (str, int)) else None
+        if work is None or work.done():
+            # 请求已经完成或不存在，按规范忽略
+            return
+        logger.info("🛑 客户端取消请求 id=%s: %s", request_key, params.get("reason") or "-")
+        self.cancelled_requests.inc(reason="client")
+        self._client_cancelled.add(work)
+        work.cancel()
+    
+    async def _response_writer(self):
+        """唯一的响应写出者，保证输出行不会交错"""
+        while True:
+            response = await self._response_queue.get()
+            try:
+                await self._send_response(response)
+            finally:
+                self._response_queue.task_done()
     
-    async def _send_response(self, response: Dict[str, Any]):
-        """发送 MCP 响应"""
+    async def _read_request(self) -> Any:
+        """读取一条 MCP 消息，EOF 返回 _EOF，空行或解析失败返回 None"""
         try:
-            print(json.dumps(response, ensure_ascii=False))
-            sys.stdout.flush()
+            line = await self.transport.read_line()
+        except MessageTooLargeError as e:
+            logger.warning("❌ 读取请求失败: %s", e)
+            await self._response_queue.put(_error_response(None, -32600, f"无效请求: {e}"))
+            return None
+        
+        if line is None:
+            return _EOF
+        line = line.strip()
+        if not line:
+            return None
+        
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            logger.warning("❌ 读取请求失败: %s", e)
+            await self._response_queue.put(_error_response(None, -32700, f"解析错误: {str(e)}"))
+            return None
+    
+    async def _send_response(self, response: Any):
+        """发送 MCP 响应 (单个对象、预先序列化的字节或批量数组)"""
+        try:
+            await self.transport.write_line(_encode_response(response))
         except Exception as e:
-            print(f"❌ 发送响应失败: {e}")
+            logger.error("❌ 发送响应失败: %s", e)
     
-    async def _handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
-        """处理 MCP 请求"""
+    async def _handle_request(self, request: Dict[str, Any]) -> Union[Dict[str, Any], bytes]:
+        """处理 MCP 请求，不变的协议响应直接返回预先序列化的字节"""
         method = request.get("method")
         request_id = request.get("id")
         
         if method == "initialize":
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {},
-                        "resources": {},
-                        "prompts": {},
-                        "sampling": {}
-                    },
-                    "serverInfo": {
-                        "name": self.server_name,
-                        "version": "1.0.0"
-                    }
-                }
-            }
+            return self.tools.initialize_response(request_id)
+        
+        elif method == "notifications/cancelled":
+            # 批量数组中的取消通知
+            self._cancel_request(request.get("params") or {})
+            return None
         
         elif method == "tools/list":
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "tools": [
-                        {
-                            "name": "generate_image",
-                            "description": "使用 AIHubMix API 生成图像",
-                            "inputSchema": {
-                                "type": "object",
-                                "properties": {
-                                    "prompt": {
-                                        "type": "string",
-                                        "description": "图像描述提示词"
-                                    },
-                                    "model": {
-                                        "type": "string",
-                                        "description": "使用的模型 (gpt-image-1)",
-                                        "default": self.model
-                                    },
-                                    "size": {
-                                        "type": "string",
-                                        "description": "图像尺寸",
-                                        "enum": ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"],
-                                        "default": "1024x1024"
-                                    },
-                                    "n": {
-                                        "type": "integer",
-                                        "description": "生成图像数量 (1-10)",
-                                        "minimum": 1,
-                                        "maximum": 10,
-                                        "default": 1
-                                    },
-                                    "filename": {
-                                        "type": "string",
-                                        "description": "输出文件名 (不含扩展名)",
-                                        "default": "generated_image"
-                                    }
-                                },
-                                "required": ["prompt"]
-                            }
-                        }
-                    ]
-                }
-            }
+            return self.tools.tools_list_response(request_id)
         
         elif method == "tools/call":
-            tool_name = request.get("params", {}).get("name")
-            if tool_name == "generate_image":
-                return await self._handle_generate_image(request)
-            else:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {
-                        "code": -32601,
-                        "message": f"未知工具: {tool_name}"
-                    }
-                }
-        
-        else:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32601,
-                    "message": f"未知方法: {method}"
-                }
-                }
-    
-    async def _handle_generate_image(self, request: Dict[str, Any]) -> Dict[str, Any]:
-        """处理图像生成请求"""
-        request_id = request.get("id")
-        params = request.get("params", {}).get("arguments", {})
-        
-        try:
-            # 提取参数
-            prompt = params.get("prompt")
-            model = params.get("model", self.model)
-            size = params.get("size", "1024x1024")
-            n = params.get("n", 1)
-            filename = params.get("filename", "generated_image")
-            
-            if not prompt:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {
-                        "code": -32602,
-                        "message": "缺少必需参数: prompt"
-                    }
-                }
-            
-            # 调用 AIHubMix API
-            result = await self._generate_image_with_aihubmix(
-                prompt=prompt,
-                model=model,
-                size=size,
-                n=n,
-                filename=filename
-            )
-            
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": result["message"]
-                        }
-                    ],
-                    "isError": False
-                }
-            }
-            
-        except Exception as e:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32603,
-                    "message": f"图像生成失败: {str(e)}"
-                    }
-                }
-    
-    async def _generate_image_with_aihubmix(
-        self,
-        prompt: str,
-        model: str = "gpt-image-1",
-        size: str = "1024x1024",
-        n: int = 1,
-        filename: str = "generated_image"
-    ) -> Dict[str, Any]:
-        """使用 AIHubMix API 生成图像"""
-        
-        # 构建请求数据
-        request_data = {
-            "model": model,
-            "prompt": prompt,
-            "size": size,
-            "n": n
-        }
-        
-        # 对于 gpt-image-1 模型，请求 base64 格式的响应
-        if model == "gpt-image-1":
-            request_data["response_format"] = "b64_json"
+            # 进度通知经由响应写出队列发送，不会与响应交错
+            return await self._handle_tool_call(request, notify=self._response_queue.put)
         
-        print(f"🎨 正在生成图像...")
-        print(f"   提示词: {prompt}")
-        print(f"   模型: {model}")
-        print(f"   尺寸: {size}")
-        print(f"   数量: {n}")
-        print(f"   响应格式: {'base64' if model == 'gpt-image-1' else 'URL'}")
+        elif method == "resources/list":
+            return await self._handle_resources_list(request)
         
-        try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/v1/images/generations",
-                    headers={"Authorization": f"Bearer {self.api_key}"},
-                    json=request_data
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    print(f"✅ 图像生成成功!")
-                    print(f"   创建时间: {result.get('created')}")
-                    
-                    # 处理生成的图像
-                    saved_files = []
-                    if result.get('data'):
-                        for i, image_data in enumerate(result['data']):
-                            if 'url' in image_data:
-                                # 下载并保存图像
-                                saved_file = await self._download_and_save_image(
-                                    image_data['url'],
-                                    filename,
-                                    i
-                                )
-                                if saved_file:
-                                    saved_files.append(saved_file)
-                            elif 'b64_json' in image_data:
-                                # 保存 base64 图像
-                                saved_file = await self._save_base64_image(
-                                    image_data['b64_json'],
-                                    filename,
-                                    i
-                                )
-                                if saved_file:
-                                    saved_files.append(saved_file)
-                    
-                    message = f"成功生成 {len(result.get('data', []))} 张图像"
-                    if saved_files:
-                        message += f"，已保存到: {', '.join(saved_files)}"
-                    
-                    return {
-                        "message": message,
-                        "data": result,
-                        "saved_files": saved_files
-                    }
-                
-                elif response.status_code == 401:
-                    raise Exception("API 密钥无效，请检查 AIHUBMIX_API_KEY")
-                elif response.status_code == 402:
-                    raise Exception("账户余额不足，请充值")
-                elif response.status_code == 429:
-                    raise Exception("请求频率过高，请稍后重试")
-                else:
-                    raise Exception(f"API 请求失败，状态码: {response.status_code}, 响应: {response.text}")
+        elif method == "resources/read":
+            return await self._handle_resources_read(request)
         
-        except httpx.TimeoutException:
-            raise Exception("请求超时，请检查网络连接")
-        except httpx.ConnectError:
-            raise Exception("无法连接到 AIHubMix API，请检查网络连接")
-        except Exception as e:
-            raise Exception(f"图像生成失败: {str(e)}")
-    
-    async def _download_and_save_image(self, url: str, filename: str, index: int = 0) -> Optional[str]:
-        """下载并保存图像"""
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    # 确保保存目录存在
-                    os.makedirs(self.image_save_dir, exist_ok=True)
-                    
-                    # 构建文件名
-                    suffix = f"_{index}" if index > 0 else ""
-                    file_path = os.path.join(self.image_save_dir, f"{filename}{suffix}.png")
-                    
-                    # 保存图片
-                    with open(file_path, "wb") as f:
-                        f.write(response.content)
-                    
-                    print(f"💾 图像已保存: {file_path}")
-                    return file_path
-                else:
-                    print(f"❌ 下载图像失败，状态码: {response.status_code}")
-                    return None
-        except Exception as e:
-            print(f"❌ 保存图像失败: {e}")
-            return None
+        else:
+            return _error_response(request_id, -32601, f"未知方法: {method}")
     
-    async def _save_base64_image(self, b64_data: str, filename: str, index: int = 0) -> Optional[str]:
-        """保存 base64 编码的图像"""
-        try:
-            import base64
-            
-            # 确保保存目录存在
-            os.makedirs(self.image_save_dir, exist_ok=True)
-            
-            # 构建文件名
-            suffix = f"_{index}" if index > 0 else ""
-            file_path = os.path.join(self.image_save_dir, f"{filename}{suffix}.png")
-            
-            # 解码并保存 base64 图像
-            image_data = base64.b64decode(b64_data)
-            with open(file_path, "wb") as f:
-                f.write(image_data)
-            
-            print(f"💾 图像已保存: {file_path}")
-            return file_path
-        except Exception as e:
-            print(f"❌ 保存 base64 图像失败: {e}")
-            return None
-
 def main():
-    # 设置控制台输出编码
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='xmlcharrefreplace')
+    # stdout 只用于协议帧，诊断输出全部转到 stderr
+    transport = StdioTransport(sys.stdin.buffer, sys.stdout.buffer)
+    sys.stdout = sys.stderr = io.TextIOWrapper(
+        sys.stderr.buffer, encoding='utf-8', errors='xmlcharrefreplace', line_buffering=True
+    )
     load_dotenv()
-    server = AIHubMixImageMCPServer()
-    asyncio.run(server.start())
+    setup_logging()
+    try:
+        server = AIHubMixImageMCPServer(transport)
+        run(server.start())
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+跨进程共享状态
+多 worker 部署时，限流令牌桶、异步任务表和后台任务的租约保存在同一个本地 SQLite 数据库中，
+所有 worker 进程看到同一份状态
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+
+class SharedStateStore:
+    """基于 SQLite (WAL 模式) 的跨进程状态存储
+
+    连接只在单线程执行器中使用，数据库操作不阻塞事件循环；
+    需要读-改-写的操作使用 BEGIN IMMEDIATE 事务，保证多个进程之间的原子性。
+    """
+
+    def __init__(self, db_path: str, busy_timeout: float = 5.0):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    async def run(self, func, *args):
+        """在数据库线程中执行操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        """关闭数据库连接"""
+        self._executor.submit(self._db_close).result()
+        self._executor.shutdown(wait=True)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            # isolation_level=None: 由代码显式控制事务
+            self._conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                " name TEXT PRIMARY KEY,"
+                " tokens REAL NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " params TEXT NOT NULL,"
+                " owner INTEGER,"
+                " created_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL,"
+                " result TEXT,"
+                " error TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " name TEXT PRIMARY KEY,"
+                " owner INTEGER NOT NULL,"
+                " expires REAL NOT NULL)"
+            )
+        return self._conn
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._db())
+
+    # ---- 令牌桶 ----
+
+    def take_token(self, name: str, rate: float, capacity: float) -> Tuple[float, float]:
+        """尝试取得一个令牌，返回 (需要等待的秒数, 剩余令牌)，等待 0 秒表示已取得"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT tokens, updated FROM rate_limits WHERE name = ?", (name,)
+            ).fetchone()
+            # 多进程之间只能使用墙上时间
+            now = time.time()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                (name, tokens, now),
+            )
+        return wait, tokens
+
+    # ---- 租约 ----
+
+    def acquire_lease(self, name: str, owner: int, ttl: float) -> bool:
+        """取得或续期命名租约，其他进程持有未过期的租约时返回 False"""
+        with self._transaction() as conn:
+            now = time.time()
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+        return True
+
+    def release_lease(self, name: str, owner: int):
+        """释放本进程持有的租约，其他进程可以立即取得"""
+        self._db().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    # ---- 异步任务 ----
+
+    def submit_job(self, job_id: str, params: Dict[str, Any], queue_size: int) -> Optional[Dict[str, Any]]:
+        """插入排队任务，排队任务数已达上限时返回 None"""
+        now = time.time()
+        with self._transaction() as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= queue_size:
+                return None
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, created_at) VALUES (?, 'queued', ?, ?)",
+                (job_id, json.dumps(params, ensure_ascii=False), now),
+            )
+        return self.get_job(job_id)
+
+    def claim_job(self, owner: int) -> Optional[Tuple[Dict[str, Any], Dict[str, Any], int]]:
+        """领取最早的排队任务，返回 (任务, 参数, 剩余排队数)
+
+        先用普通读取确认有排队任务，空闲 worker 轮询时不占用写锁。
+        """
+        if self._db().execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1").fetchone() is None:
+            return None
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, params FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, started_at = ? WHERE id = ?",
+                (owner, time.time(), row[0]),
+            )
+            remaining = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        return self.get_job(row[0]), json.loads(row[1]), remaining
+
+    def finish_job(self, job_id: str, result: Optional[Dict[str, Any]], error: Optional[str]):
+        """记录任务结果"""
+        self._db().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (
+                "failed" if error is not None else "succeeded",
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error,
+                time.time(),
+                job_id,
+            ),
+        )
+
+    def fail_running_jobs(self, owners, error: str) -> int:
+        """把指定进程正在执行的任务标记为失败"""
+        owners = list(owners)
+        if not owners:
+            return 0
+        placeholders = ",".join("?" * len(owners))
+        cursor = self._db().execute(
+            f"UPDATE jobs SET status = 'failed', error = ?, finished_at = ?"
+            f" WHERE status = 'running' AND owner IN ({placeholders})",
+            (error, time.time(), *owners),
+        )
+        return max(cursor.rowcount, 0)
+
+    def running_job_owners(self):
+        """正在执行任务的进程 id"""
+        rows = self._db().execute("SELECT DISTINCT owner FROM jobs WHERE status = 'running'").fetchall()
+        return [row[0] for row in rows if row[0] is not None]
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询任务"""
+        row = self._db().execute(
+            "SELECT id, status, created_at, started_at, finished_at, result, error"
+            " FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "created_at": row[2],
+            "started_at": row[3],
+            "finished_at": row[4],
+            "result": json.loads(row[5]) if row[5] is not None else None,
+            "error": row[6],
+        }
+
+    def purge_jobs(self, cutoff: float) -> int:
+        """删除在 cutoff 之前完成的任务"""
+        cursor = self._db().execute(
+            "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,)
+        )
+        return max(cursor.rowcount, 0)
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE 事务：开始时即取得写锁，其他进程的写入会等待"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+
+
+class SharedTokenBucket:
+    """保存在共享存储中的令牌桶，所有 worker 共用同一个速率"""
+
+    def __init__(self, store: SharedStateStore, rpm: float, burst: int = 0, name: str = "generations"):
+        self.store = store
+        self.name = name
+        self.rate = rpm / 60.0
+        self.capacity = float(burst if burst > 0 else max(1, int(rpm // 6)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """取得一个令牌，必要时等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            wait, self.tokens = await self.store.run(
+                self.store.take_token, self.name, self.rate, self.capacity
+            )
+            self.updated = time.monotonic()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def available(self) -> float:
+        """按最近一次看到的剩余令牌和补充速率估算可用令牌数，不访问共享存储"""
+        if self.rate <= 0:
+            return self.tokens
+        return min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rpm": self.rate * 60.0, "tokens": round(self.tokens, 2), "shared": True}
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Server-Sent Events
+解析上游的 SSE 响应，以及把事件编码为发给调用方的 SSE 帧
+"""
+
+import json
+from typing import Any, AsyncIterator, Optional, Tuple
+
+
+async def iter_sse_events(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[Optional[str], str]]:
+    """把按行读取的 SSE 流解析为 (事件名, 数据) 序列"""
+    event: Optional[str] = None
+    data = []
+    async for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            # 空行表示一个事件结束
+            if data:
+                yield event, "\n".join(data)
+            event, data = None, []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            event = value
+        elif field == "data":
+            data.append(value)
+    if data:
+        yield event, "\n".join(data)
+
+
+def format_sse_event(event: str, data: Any) -> bytes:
+    """把事件编码为一个 SSE 帧，数据序列化为单行 JSON"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动辅助
+测量从进程启动到开始处理请求的耗时，安装了 uvloop 时使用 uvloop 事件循环
+"""
+
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+from typing import Any, Coroutine, Optional
+
+from config import env_bool
+
+
+def _process_age() -> Optional[float]:
+    """进程已运行的秒数，从 /proc 读取 (仅 Linux)，无法读取时返回 None"""
+    try:
+        with open("/proc/self/stat") as f:
+            stat = f.read()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        # 进程名可能包含空格，从最后一个 ")" 之后按字段切分，第 22 个字段是启动时刻 (时钟节拍)
+        start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# 进程启动时刻 (time.monotonic)，无法读取时以首次导入本模块的时刻代替
+PROCESS_STARTED = time.monotonic() - (_process_age() or 0.0)
+
+
+def startup_elapsed() -> float:
+    """距进程启动的秒数，包括解释器启动和模块导入"""
+    return time.monotonic() - PROCESS_STARTED
+
+
+def uvloop_enabled() -> bool:
+    """安装了 uvloop 且未通过 AIHUBMIX_UVLOOP=false 关闭"""
+    return env_bool('AIHUBMIX_UVLOOP', True) and importlib.util.find_spec("uvloop") is not None
+
+
+def event_loop_name() -> str:
+    """传给 uvicorn 的事件循环实现"""
+    return "uvloop" if uvloop_enabled() else "asyncio"
+
+
+def run(main: Coroutine[Any, Any, Any]) -> Any:
+    """与 asyncio.run 相同，可用时在 uvloop 事件循环中运行"""
+    if not uvloop_enabled():
+        return asyncio.run(main)
+    import uvloop
+
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
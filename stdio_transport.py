@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步 stdio 传输层
+基于管道的 StreamReader/StreamWriter 读写以换行分隔的 JSON-RPC 消息
+"""
+
+import asyncio
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional
+
+from config import env_int
+
+
+class MessageTooLargeError(Exception):
+    """单行消息超过 MCP_STDIO_LINE_LIMIT"""
+
+
+def _is_pipe(stream: BinaryIO) -> bool:
+    """判断文件对象是否为管道或套接字 (只有这些可以挂到事件循环上)"""
+    try:
+        mode = os.fstat(stream.fileno()).st_mode
+    except (OSError, ValueError, AttributeError):
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+class StdioTransport:
+    """stdin/stdout 异步传输
+
+    stdin/stdout 为管道时直接挂到事件循环上，写出时通过 drain 实现背压；
+    终端、普通文件或不支持管道的事件循环 (如 Windows) 回退到单线程阻塞读写。
+    """
+
+    def __init__(self, stdin: BinaryIO, stdout: BinaryIO):
+        self.stdin = stdin
+        self.stdout = stdout
+        # 单行消息的最大字节数，批量请求和大响应需要较大的上限
+        self.line_limit = env_int('MCP_STDIO_LINE_LIMIT', 64 * 1024 * 1024)
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def open(self):
+        """连接 stdin/stdout"""
+        loop = asyncio.get_running_loop()
+
+        if _is_pipe(self.stdin):
+            try:
+                reader = asyncio.StreamReader(limit=self.line_limit)
+                await loop.connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(reader), self.stdin
+                )
+                self._reader = reader
+            except (NotImplementedError, OSError, ValueError):
+                self._reader = None
+
+        if _is_pipe(self.stdout):
+            try:
+                transport, protocol = await loop.connect_write_pipe(
+                    asyncio.streams.FlowControlMixin, self.stdout
+                )
+                self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+            except (NotImplementedError, OSError, ValueError):
+                self._writer = None
+
+        if self._reader is None or self._writer is None:
+            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stdio")
+
+    async def read_line(self) -> Optional[bytes]:
+        """读取一行，EOF 时返回 None"""
+        if self._reader is not None:
+            try:
+                line = await self._reader.readline()
+            except ValueError:
+                # 单行超过上限，StreamReader 已丢弃缓冲的数据
+                raise MessageTooLargeError(f"消息超过 {self.line_limit} 字节上限")
+        else:
+            loop = asyncio.get_running_loop()
+            line = await loop.run_in_executor(self._executor, self.stdin.readline)
+        if not line:
+            return None
+        return line
+
+    async def write_line(self, data: bytes):
+        """写出一行并等待缓冲区排空"""
+        if self._writer is not None:
+            self._writer.write(data + b"\n")
+            await self._writer.drain()
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._write_blocking, data + b"\n")
+
+    def _write_blocking(self, data: bytes):
+        self.stdout.write(data)
+        self.stdout.flush()
+
+    async def close(self):
+        """关闭传输"""
+        if self._writer is not None:
+            try:
+                await self._writer.drain()
+            except (ConnectionError, BrokenPipeError):
+                pass
+            self._writer.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
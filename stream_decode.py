@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+b64_json 响应流式解码
+增量扫描图像生成响应，把每个 b64_json 字段边读边解码，
+其余 JSON 结构 (created、revised_prompt 等) 保留为体积很小的骨架
+"""
+
+import binascii
+import json
+from typing import Any, Dict, List, Tuple
+
+_KEY = b'"b64_json"'
+_WHITESPACE = b" \t\r\n"
+
+_OUTSIDE = 0
+_AFTER_KEY = 1
+_IN_VALUE = 2
+
+
+class B64JsonStreamDecoder:
+    """b64_json 响应的增量解码器
+
+    feed() 返回 (图像序号, 解码后的字节, 是否结束) 列表；
+    finish() 返回去掉 base64 数据后的响应 JSON，其中 b64_json 字段为 null。
+    """
+
+    def __init__(self):
+        self._state = _OUTSIDE
+        self._skeleton = bytearray()
+        self._carry = b""
+        self._saw_colon = False
+        self._b64_rest = b""
+        self._escape = False
+        self._index = 0
+
+    @property
+    def images(self) -> int:
+        """已完整解码的图像数量"""
+        return self._index
+
+    def feed(self, chunk: bytes) -> List[Tuple[int, bytes, bool]]:
+        """处理一段响应数据"""
+        events: List[Tuple[int, bytes, bool]] = []
+        buf = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+        pos = 0
+        size = len(buf)
+
+        while pos < size:
+            if self._state == _OUTSIDE:
+                idx = buf.find(_KEY, pos)
+                if idx == -1:
+                    # 保留可能是键名开头的尾部，等待下一段数据
+                    cut = max(pos, size - (len(_KEY) - 1))
+                    self._skeleton += buf[pos:cut]
+                    self._carry = buf[cut:]
+                    break
+                end = idx + len(_KEY)
+                self._skeleton += buf[pos:end]
+                pos = end
+                self._state = _AFTER_KEY
+                self._saw_colon = False
+
+            elif self._state == _AFTER_KEY:
+                c = buf[pos:pos + 1]
+                if c in _WHITESPACE:
+                    self._skeleton += c
+                    pos += 1
+                elif c == b":" and not self._saw_colon:
+                    self._skeleton += c
+                    self._saw_colon = True
+                    pos += 1
+                elif c == b'"' and self._saw_colon:
+                    # 值以 null 占位，数据交给调用方
+                    self._skeleton += b"null"
+                    self._state = _IN_VALUE
+                    self._b64_rest = b""
+                    self._escape = False
+                    pos += 1
+                else:
+                    # 值不是字符串 (例如 null)，按普通 JSON 处理
+                    self._state = _OUTSIDE
+
+            else:
+                end = buf.find(b'"', pos)
+                if end == -1:
+                    segment = buf[pos:]
+                    pos = size
+                else:
+                    segment = buf[pos:end]
+                    pos = end + 1
+
+                data = self._feed_value(segment)
+                if end == -1:
+                    if data:
+                        events.append((self._index, data, False))
+                else:
+                    data += self._flush_value()
+                    events.append((self._index, data, True))
+                    self._index += 1
+                    self._state = _OUTSIDE
+
+        return events
+
+    def finish(self) -> Dict[str, Any]:
+        """结束解码并解析 JSON 骨架"""
+        if self._state != _OUTSIDE:
+            raise ValueError("响应在 b64_json 字段中途结束")
+        self._skeleton += self._carry
+        self._carry = b""
+        return json.loads(bytes(self._skeleton))
+
+    def _feed_value(self, segment: bytes) -> bytes:
+        """解码一段 base64 字符串，未对齐 4 字节的部分留到下次"""
+        if self._escape:
+            segment = b"\\" + segment
+            self._escape = False
+        if b"\\" in segment:
+            if segment.endswith(b"\\") and (len(segment) - len(segment.rstrip(b"\\"))) % 2 == 1:
+                self._escape = True
+                segment = segment[:-1]
+            segment = _unescape(segment)
+
+        data = self._b64_rest + segment if self._b64_rest else segment
+        usable = len(data) - len(data) % 4
+        self._b64_rest = data[usable:]
+        if not usable:
+            return b""
+        return binascii.a2b_base64(data[:usable])
+
+    def _flush_value(self) -> bytes:
+        rest = self._b64_rest
+        self._b64_rest = b""
+        self._escape = False
+        if not rest:
+            return b""
+        return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4))
+
+
+def _unescape(segment: bytes) -> bytes:
+    """处理 base64 字符串中可能出现的 JSON 转义"""
+    return (
+        segment.replace(b"\\/", b"/")
+        .replace(b"\\n", b"")
+        .replace(b"\\r", b"")
+    )
@@ -0,0 +1,91 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+
+import httpx
+import pytest
+
+# 模块位于仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("AIHUBMIX_API_KEY", "sk-test-0000000000")
+
+
+class FakeUpstream:
+    """基于 httpx.MockTransport 的假上游
+
+    生成请求按调用序号 (从 1 开始) 编号，errors 把序号映射到要返回的错误状态码；每张图像的内容各不相同。
+    gpt-image-1 返回 b64_json，其他模型返回图像 URL，下载请求也由本传输处理。
+    """
+
+    def __init__(self):
+        self.generations = []
+        self.downloads = []
+        self.errors = {}
+        self.delay = 0.0
+        self.models_status = 200
+
+    @staticmethod
+    def image_bytes(call: int, index: int) -> bytes:
+        return b"\x89PNG\r\n\x1a\n" + f"call={call} index={index}".encode()
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path.endswith("/models"):
+            return httpx.Response(self.models_status, json={"data": [{"id": "gpt-image-1"}]})
+        if path.startswith("/files/"):
+            self.downloads.append(path)
+            call, index = path[len("/files/"):-len(".png")].split("-")
+            return httpx.Response(200, content=self.image_bytes(int(call), int(index)))
+        if not path.endswith("/images/generations"):
+            return httpx.Response(404)
+
+        body = json.loads(request.content)
+        self.generations.append(body)
+        call = len(self.generations)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if call in self.errors:
+            return httpx.Response(
+                self.errors[call], json={"error": {"message": "invalid prompt"}}, headers={"Retry-After": "0"}
+            )
+        if body.get("stream"):
+            return httpx.Response(200, content=self._stream(body), headers={"Content-Type": "text/event-stream"})
+        if body.get("response_format") == "b64_json":
+            data = [{"b64_json": base64.b64encode(self.image_bytes(call, i)).decode()} for i in range(body["n"])]
+        else:
+            data = [{"url": f"http://files.test/files/{call}-{i}.png"} for i in range(body["n"])]
+        return httpx.Response(200, json={"created": 1700000000, "data": data})
+
+    def _stream(self, body) -> bytes:
+        call = len(self.generations)
+        events = [
+            {"type": "image_generation.partial_image", "partial_image_index": i, "b64_json": "AAAA"}
+            for i in range(body["partial_images"])
+        ]
+        events.append({
+            "type": "image_generation.completed",
+            "b64_json": base64.b64encode(self.image_bytes(call, 0)).decode(),
+        })
+        return b"".join(
+            f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode() for event in events
+        )
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler), timeout=httpx.Timeout(10.0))
+
+
+@pytest.fixture
+def upstream():
+    return FakeUpstream()
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    """把图像目录 (服务模块旁边的 images/) 指向临时目录"""
+    import image_service
+
+    monkeypatch.setattr(image_service, "__file__", str(tmp_path / "image_service.py"))
+    return tmp_path / "images"
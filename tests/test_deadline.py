@@ -0,0 +1,126 @@
+import asyncio
+
+import httpx
+import pytest
+
+import deadline
+from deadline import DeadlineExceededError, iter_with_deadline, parse_deadline, request_timeout, run_with_deadline
+from image_service import AIHubMixImageService
+
+
+@pytest.mark.parametrize("value, expected", [
+    (1, 1.0),
+    ("2.5", 2.5),
+    (deadline.MAX_DEADLINE, deadline.MAX_DEADLINE),
+    (0, None),
+    (-1, None),
+    (deadline.MAX_DEADLINE + 1, None),
+    (True, None),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_deadline(value, expected):
+    assert parse_deadline(value) == expected
+
+
+def test_request_timeout_clamped_to_remaining():
+    async def main():
+        async def inner():
+            return request_timeout(httpx.Timeout(60.0, connect=10.0))
+
+        return await run_with_deadline(inner(), 0.5)
+
+    timeout = asyncio.run(main())
+    assert 0 < timeout.read <= 0.5
+    assert 0 < timeout.connect <= 0.5
+
+
+def test_request_timeout_unchanged_without_deadline():
+    original = httpx.Timeout(60.0)
+    assert request_timeout(original) is original
+
+
+def test_run_with_deadline_raises_and_resets():
+    async def main():
+        with pytest.raises(DeadlineExceededError):
+            await run_with_deadline(asyncio.sleep(1), 0.05)
+        return deadline.remaining()
+
+    assert asyncio.run(main()) is None
+
+
+def test_nested_deadline_keeps_earlier():
+    async def main():
+        async def inner():
+            return await run_with_deadline(asyncio.sleep(0, result=deadline.remaining()), 10)
+
+        return await run_with_deadline(inner(), 0.5)
+
+    assert asyncio.run(main()) <= 0.5
+
+
+def test_iter_with_deadline_closes_source():
+    closed = []
+
+    async def source():
+        try:
+            yield 1
+            await asyncio.sleep(1)
+            yield 2
+        finally:
+            closed.append(True)
+
+    async def main():
+        received = []
+        with pytest.raises(DeadlineExceededError):
+            async for item in iter_with_deadline(source(), 0.1):
+                received.append(item)
+        return received
+
+    assert asyncio.run(main()) == [1]
+    assert closed == [True]
+
+
+def test_coalesced_follower_not_bound_by_leader_deadline():
+    service = AIHubMixImageService(default_base_url="http://127.0.0.1:9")
+    seen = []
+
+    async def fake_request_generation(prompt, model, size, n, filename, fanout):
+        seen.append(deadline.remaining())
+        await asyncio.sleep(0.3)
+        return {"message": "ok", "data": None, "saved_files": []}
+
+    service._request_generation = fake_request_generation
+
+    async def main():
+        kwargs = {"prompt": "p", "cache": "bypass"}
+        leader = asyncio.ensure_future(run_with_deadline(service._generate_image_with_aihubmix(**kwargs), 0.1))
+        # 确保带截止时间的调用先启动共享任务
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(service._generate_image_with_aihubmix(**kwargs))
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader_result, follower_result = asyncio.run(main())
+    assert isinstance(leader_result, DeadlineExceededError)
+    assert follower_result["coalesced"] is True
+    # 共享任务中没有截止时间
+    assert seen == [None]
+
+
+def test_tool_call_deadline_reported_and_counted():
+    service = AIHubMixImageService(default_base_url="http://127.0.0.1:9")
+
+    async def slow_request_generation(prompt, model, size, n, filename, fanout):
+        # 内层 (如收紧后的上游超时) 先报告超过截止时间
+        await asyncio.sleep(0.01)
+        raise DeadlineExceededError("已超过请求截止时间")
+
+    service._request_generation = slow_request_generation
+    request = {
+        "jsonrpc": "2.0", "id": 7, "method": "tools/call",
+        "params": {"name": "generate_image", "arguments": {"prompt": "p", "cache": "bypass", "deadline": 5}},
+    }
+
+    response = asyncio.run(service._handle_tool_call(request))
+    assert response["error"]["message"].startswith("已超过请求截止时间")
+    assert "aihubmix_cancelled_requests_total{reason=\"deadline\"} 1" in service.cancelled_requests.samples()
@@ -0,0 +1,35 @@
+import asyncio
+
+from hedging import Hedger
+from image_service import AIHubMixImageService
+
+
+def test_hedge_covers_upstream_request_only():
+    service = AIHubMixImageService(default_base_url="http://127.0.0.1:9")
+    service.hedger = Hedger(min_delay=0.0, min_samples=1, budget=1.0)
+    service.hedger.budget.tokens = service.hedger.budget.capacity
+    calls, saved = [], []
+
+    async def fake_post(request_data):
+        calls.append(len(calls))
+        # 第一次请求很慢，对冲请求很快返回
+        await asyncio.sleep(1.0 if len(calls) == 1 else 0.01)
+        return {"data": [{"b64_json": "AAAA"}], "attempt": len(calls)}
+
+    async def fake_save(result, filename, index_offset=0):
+        saved.append(result["attempt"])
+        return []
+
+    service._post_generation = fake_post
+    service._save_images = fake_save
+    key = ("gpt-image-1", "1024x1024", 1)
+    service.hedger.latency.record(key, 0.05)
+
+    async def main():
+        return await service._attempt_generation({"model": key[0], "size": key[1], "n": key[2]}, "f")
+
+    result, _ = asyncio.run(main())
+    assert len(calls) == 2
+    assert result["attempt"] == 2
+    # 只保存一次胜出的结果
+    assert saved == [2]
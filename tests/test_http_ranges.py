@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from http_server import _etag_matches, _parse_range
+from image_store import make_etag
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    (" bytes=0-0 ", (0, 0)),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,5-6", "bytes=-", "items=0-1", "bytes=a-b", ""])
+def test_unsupported_range_serves_full_file(header):
+    assert _parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [("bytes=1000-", 1000), ("bytes=-0", 1000), ("bytes=-1", 0)])
+def test_unsatisfiable_range(header, size):
+    with pytest.raises(ValueError):
+        _parse_range(header, size)
+
+
+def test_etag_matching(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"png")
+    etag = make_etag(os.stat(str(path)))
+    assert etag.startswith('"') and etag.endswith('"')
+    assert _etag_matches(etag, etag)
+    assert _etag_matches(f'"other", W/{etag}', etag)
+    assert _etag_matches("*", etag)
+    assert not _etag_matches('"other"', etag)
+    assert not _etag_matches("", etag)
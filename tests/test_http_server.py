@@ -0,0 +1,325 @@
+import asyncio
+import base64
+import io
+import json
+import os
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+
+from derivatives import pillow_available
+from http_server import AIHubMixImageHTTPMCPServer
+
+
+def _post(path, body, timeout=5.0):
+    """经 ASGI 直接调用 HTTP 应用，处理挂起时以超时失败"""
+    app = AIHubMixImageHTTPMCPServer().create_app()
+
+    async def call():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.wait_for(client.post(path, json=body), timeout)
+
+    return asyncio.run(call())
+
+
+def test_unknown_tool_returns_promptly():
+    response = _post("/mcp", {
+        "jsonrpc": "2.0", "id": 1, "method": "tools/call",
+        "params": {"name": "no_such_tool", "arguments": {}},
+    })
+    assert response.status_code == 200
+    assert response.json()["error"]["code"] == -32601
+
+
+def test_invalid_arguments_return_promptly():
+    response = _post("/mcp/tools/call", {
+        "jsonrpc": "2.0", "id": 2, "method": "tools/call",
+        "params": {"name": "generate_image", "arguments": {"prompt": "x", "n": 50}},
+    })
+    assert response.status_code == 200
+    assert response.json()["error"]["code"] == -32602
+
+
+def test_missing_params_return_promptly():
+    response = _post("/mcp/tools/call", {"jsonrpc": "2.0", "id": 3, "method": "tools/call"})
+    assert response.status_code == 200
+    assert "error" in response.json()
+
+
+def test_cache_only_miss_returns_promptly():
+    response = _post("/generate-image", {"prompt": "never generated", "cache": "only"})
+    assert response.status_code == 404
+
+
+def test_partial_images_with_multiple_images_is_invalid_params():
+    response = _post("/mcp/tools/call", {
+        "jsonrpc": "2.0", "id": 4, "method": "tools/call",
+        "params": {"name": "generate_image", "arguments": {"prompt": "x", "n": 2, "partial_images": 1}},
+    })
+    assert response.status_code == 200
+    assert response.json()["error"]["code"] == -32602
+
+
+@asynccontextmanager
+async def _running(upstream):
+    """启动带生命周期的应用 (共享资源、任务 worker、后台预热)，上游请求由假上游处理"""
+    server = AIHubMixImageHTTPMCPServer()
+    server.http_client = upstream.client()
+    app = server.create_app()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield server, client
+
+
+def _sse_events(text):
+    """把 SSE 响应体解析为 [(事件名, 数据)]"""
+    events = []
+    for frame in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_cache_modes(monkeypatch, image_dir, upstream):
+    monkeypatch.setenv("AIHUBMIX_CACHE_ENABLED", "true")
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            body = {"prompt": "a red fox"}
+            miss = await client.post("/generate-image", json={**body, "cache": "only"})
+            first = await client.post("/generate-image", json=body)
+            again = await client.post("/generate-image", json=body)
+            bypass = await client.post("/generate-image", json={**body, "cache": "bypass"})
+            only = await client.post("/generate-image", json={**body, "cache": "only"})
+            return miss, first.json(), again.json(), bypass.json(), only
+
+    miss, first, again, bypass, only = asyncio.run(main())
+    assert miss.status_code == 404
+    assert "cached" not in first
+    # prefer (默认) 命中缓存，bypass 重新生成
+    assert again["cached"] is True and again["saved_files"] == first["saved_files"]
+    assert "cached" not in bypass
+    assert len(upstream.generations) == 2
+    assert only.status_code == 200 and only.json()["cached"] is True
+
+
+def test_identical_concurrent_requests_share_one_upstream_call(image_dir, upstream):
+    upstream.delay = 0.2
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            body = {"prompt": "same prompt", "cache": "bypass"}
+            return await asyncio.gather(
+                client.post("/generate-image", json=body), client.post("/generate-image", json=body)
+            )
+
+    responses = asyncio.run(main())
+    assert len(upstream.generations) == 1
+    results = [response.json() for response in responses]
+    assert sorted(bool(result.get("coalesced")) for result in results) == [False, True]
+    assert results[0]["saved_files"] == results[1]["saved_files"]
+
+
+def test_fan_out_returns_partial_results(image_dir, upstream):
+    upstream.errors = {2: 400}
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            return await client.post("/generate-image", json={"prompt": "four cats", "n": 4, "fanout": 2})
+
+    response = asyncio.run(main())
+    assert response.status_code == 200
+    result = response.json()
+    assert [body["n"] for body in upstream.generations] == [2, 2]
+    statuses = [image["status"] for image in result["images"]]
+    assert sorted(statuses) == ["failed", "failed", "saved", "saved"]
+    assert [image["index"] for image in result["images"]] == [0, 1, 2, 3]
+    assert len(result["saved_files"]) == 2
+    assert "2 张图像失败" in result["message"]
+
+
+def test_fan_out_fails_when_every_chunk_fails(image_dir, upstream):
+    upstream.errors = {1: 400, 2: 400}
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            return await client.post("/generate-image", json={"prompt": "four cats", "n": 4, "fanout": 2})
+
+    response = asyncio.run(main())
+    assert response.status_code == 500
+    assert "invalid prompt" in response.json()["detail"]
+
+
+def test_url_images_downloaded_and_served_by_id(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (_, client):
+            response = await client.post("/generate-image", json={
+                "prompt": "two dogs", "model": "dall-e-3", "n": 2, "response": "refs"
+            })
+            refs = response.json()
+            images = [await client.get(image["url"]) for image in refs["images"]]
+            return refs, images
+
+    refs, images = asyncio.run(main())
+    # 下载与生成请求经同一个共享客户端
+    assert sorted(upstream.downloads) == ["/files/1-0.png", "/files/1-1.png"]
+    assert "data" not in refs
+    assert [image["status"] for image in refs["images"]] == ["saved", "saved"]
+    assert [response.content for response in images] == [upstream.image_bytes(1, 0), upstream.image_bytes(1, 1)]
+    assert images[0].headers["content-type"] == "image/png"
+    # 文件按内容寻址保存在对象目录中
+    assert all(os.path.dirname(image["path"]).startswith(str(image_dir / "objects")) for image in refs["images"])
+
+
+def test_jobs_api(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (_, client):
+            submitted = await client.post("/jobs", json={"prompt": "a lighthouse"})
+            status_url = submitted.json()["status_url"]
+            for _ in range(100):
+                job = (await client.get(status_url)).json()
+                if job["status"] in ("succeeded", "failed"):
+                    break
+                await asyncio.sleep(0.02)
+            missing = await client.get("/jobs/does-not-exist")
+            return submitted, job, missing
+
+    submitted, job, missing = asyncio.run(main())
+    assert submitted.status_code == 202
+    assert submitted.json()["status"] == "queued"
+    assert job["status"] == "succeeded"
+    assert len(job["result"]["saved_files"]) == 1
+    assert "data" not in job["result"]
+    assert missing.status_code == 404
+
+
+def test_jobs_queue_full_returns_503(monkeypatch, image_dir, upstream):
+    monkeypatch.setenv("AIHUBMIX_JOB_WORKERS", "1")
+    monkeypatch.setenv("AIHUBMIX_JOB_QUEUE_SIZE", "1")
+    monkeypatch.setenv("AIHUBMIX_JOB_RETRY_AFTER", "7")
+    upstream.delay = 0.5
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            running = await client.post("/jobs", json={"prompt": "first"})
+            # 等 worker 取走第一个任务，第二个任务占满队列
+            await asyncio.sleep(0.1)
+            queued = await client.post("/jobs", json={"prompt": "second"})
+            rejected = await client.post("/jobs", json={"prompt": "third"})
+            return running, queued, rejected
+
+    running, queued, rejected = asyncio.run(main())
+    assert (running.status_code, queued.status_code) == (202, 202)
+    assert rejected.status_code == 503
+    assert rejected.headers["retry-after"] == "7"
+
+
+def test_batch_tool_reports_each_item(image_dir, upstream):
+    upstream.errors = {2: 400}
+
+    async def main():
+        async with _running(upstream) as (_, client):
+            return await client.post("/mcp/tools/call", json={
+                "jsonrpc": "2.0", "id": 5, "method": "tools/call",
+                "params": {
+                    "name": "generate_images_batch",
+                    "arguments": {"items": [{"prompt": "one"}, {"prompt": "two"}, {"prompt": "three"}]},
+                },
+            })
+
+    result = asyncio.run(main()).json()["result"]
+    lines = result["content"][0]["text"].splitlines()
+    # 单个条目失败不影响其他条目，只有全部失败才是错误
+    assert lines[0] == "批量生成完成: 成功 2 个，失败 1 个"
+    assert result["isError"] is False
+    assert sorted(line[:3] for line in lines[1:]) == ["[0]", "[1]", "[2]"]
+    assert sum("❌" in line for line in lines[1:]) == 1
+
+
+def test_batch_endpoint_streams_items_then_done(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (_, client):
+            return await client.post("/generate-images/batch", json={
+                "items": [{"prompt": "one", "filename": "first"}, {"prompt": "two"}]
+            })
+
+    events = _sse_events(asyncio.run(main()).text)
+    assert [event for event, _ in events] == ["item", "item", "done"]
+    assert sorted(data["filename"] for _, data in events[:2]) == ["batch_1", "first"]
+    assert events[-1][1] == {"total": 2, "succeeded": 2, "failed": 0}
+
+
+def test_stream_endpoint_relays_partial_images(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (_, client):
+            return await client.post("/generate-image/stream", json={"prompt": "a bridge", "partial_images": 2})
+
+    events = _sse_events(asyncio.run(main()).text)
+    assert [event for event, _ in events] == ["partial_image", "partial_image", "completed"]
+    assert [data["index"] for _, data in events[:2]] == [0, 1]
+    assert upstream.generations[0]["stream"] is True
+    completed = events[-1][1]
+    assert completed["images"][0]["status"] == "saved"
+
+
+def test_ready_after_warmup(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (server, client):
+            for _ in range(100):
+                if server.readiness != "starting":
+                    break
+                await asyncio.sleep(0.01)
+            return await client.get("/ready")
+
+    response = asyncio.run(main())
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+
+
+def test_not_ready_when_upstream_unreachable(image_dir, upstream):
+    upstream.models_status = 503
+
+    async def main():
+        async with _running(upstream) as (server, client):
+            for _ in range(100):
+                if server.readiness != "starting":
+                    break
+                await asyncio.sleep(0.01)
+            return await client.get("/ready")
+
+    response = asyncio.run(main())
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
+
+
+@pytest.mark.skipif(pillow_available(), reason="Pillow 已安装")
+def test_derivative_without_pillow_returns_501(image_dir, upstream):
+    async def main():
+        async with _running(upstream) as (_, client):
+            refs = (await client.post("/generate-image", json={"prompt": "x", "response": "refs"})).json()
+            url = refs["images"][0]["url"]
+            return await client.get(url, params={"width": 64}), await client.get(url, params={"width": 0})
+
+    unavailable, invalid = asyncio.run(main())
+    assert unavailable.status_code == 501
+    assert invalid.status_code == 400
+
+
+def test_thumbnail_served_as_webp(image_dir, upstream):
+    image_module = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    image_module.new("RGB", (32, 16), (200, 30, 30)).save(buffer, format="PNG")
+
+    async def main():
+        async with _running(upstream) as (server, client):
+            path, _, _, _ = await server.image_store.put_base64(base64.b64encode(buffer.getvalue()).decode(), "red.png")
+            return await client.get(f"/images/{server.image_store.image_id(path)}", params={"width": 8, "format": "webp"})
+
+    response = asyncio.run(main())
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    with image_module.open(io.BytesIO(response.content)) as thumbnail:
+        assert thumbnail.size == (8, 4)
@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import hashlib
+import os
+import time
+
+from file_io import FileIOExecutor
+from image_store import RECONCILE_GRACE, ImageStore
+from janitor import LEASE_NAME, StorageJanitor
+from shared_state import SharedStateStore
+
+
+def test_list_reports_image_mime_type(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+
+    async def main():
+        await store.put_base64(base64.b64encode(b"\x89PNG fake").decode(), "cat")
+        return await store.list()
+
+    try:
+        entries, next_offset = asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    assert next_offset is None
+    assert [(entry["name"], entry["mime_type"]) for entry in entries] == [("cat", "image/png")]
+
+
+def test_reconcile_keeps_recently_indexed_objects(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+    fresh, stale = "ab" + "1" * 62, "ab" + "2" * 62
+
+    def index_without_files():
+        # 两个条目的文件都不在磁盘上：刚登记的可能是其他 worker 正在提交的对象
+        conn = store._db()
+        now = time.time()
+        for digest, created_at in ((fresh, now), (stale, now - 2 * RECONCILE_GRACE)):
+            conn.execute(
+                "INSERT INTO objects (sha256, ext, size, created_at, last_access) VALUES (?, '.png', 1, ?, ?)",
+                (digest, created_at, created_at),
+            )
+            conn.execute("INSERT INTO aliases (name, sha256, created_at) VALUES (?, ?, ?)", (digest, digest, created_at))
+        conn.commit()
+
+    async def main():
+        await store._run(index_without_files)
+        counts = await store.reconcile_shard("ab", 0.0)
+        entries, _ = await store.list()
+        return counts, [entry["id"] for entry in entries]
+
+    try:
+        counts, remaining = asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    assert counts == (0, 1)
+    assert remaining == [fresh]
+
+
+def _legacy_file(root, name, data, age):
+    path = os.path.join(str(root), name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_janitor_evicts_legacy_files_over_size_limit(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+    legacy = _legacy_file(tmp_path, "old_image.png", b"x" * 1000, age=3600)
+    janitor = StorageJanitor(store, max_bytes=500)
+
+    async def main():
+        await store.put_base64(base64.b64encode(b"y" * 400).decode(), "new")
+        await janitor.run_once()
+
+    try:
+        asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    # 旧文件计入总大小，且最久未访问，先被淘汰；刚保存的图像保留
+    assert not os.path.exists(legacy)
+    assert janitor.migrated == 1
+    assert janitor.evicted == 1
+    assert (janitor.objects, janitor.total_bytes) == (1, 400)
+
+
+def test_migrated_legacy_file_readable_by_old_name(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+    legacy = _legacy_file(tmp_path, "sub/old_image.png", b"legacy", age=3600)
+    janitor = StorageJanitor(store, max_age=86400)
+
+    async def main():
+        await janitor.run_once()
+        return await store.read("sub/old_image.png")
+
+    try:
+        data, mime = asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    assert not os.path.exists(legacy)
+    assert (data, mime) == (b"legacy", "image/png")
+    assert (janitor.migrated, janitor.expired, janitor.objects) == (1, 0, 1)
+
+
+def test_same_content_stored_once_and_alias_points_to_newest(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+    same, other = base64.b64encode(b"same bytes").decode(), base64.b64encode(b"other bytes").decode()
+
+    async def main():
+        first, _, _, _ = await store.put_base64(same, "cat.png")
+        second, _, _, _ = await store.put_base64(same, "dog.png")
+        await asyncio.sleep(0.01)
+        third, _, _, _ = await store.put_base64(other, "cat.png")
+        return first, second, third, await store.read("cat.png"), await store.read("dog.png"), await store.usage()
+
+    try:
+        first, second, third, cat, dog, usage = asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    # 相同内容只保存一份，同名别名互不覆盖文件，读取时指向最新保存的图像
+    assert first == second != third
+    assert cat == (b"other bytes", "image/png")
+    assert dog == (b"same bytes", "image/png")
+    assert usage == (2, len(b"same bytes") + len(b"other bytes"))
+
+
+def test_base64_decoded_in_process_pool(tmp_path):
+    file_io = FileIOExecutor(threads=1, processes=1, process_min_batch=2)
+    store = ImageStore(str(tmp_path), file_io)
+    data = b"\x89PNG decoded in a worker process"
+
+    async def main():
+        path, size, _, _ = await store.put_base64(base64.b64encode(data).decode(), "batch.png", batch_size=2)
+        return path, size, await store.read("batch.png")
+
+    try:
+        path, size, read_back = asyncio.run(main())
+        used_process_pool = file_io._process_pool is not None
+    finally:
+        store.close()
+        file_io.shutdown()
+    assert used_process_pool
+    assert size == len(data)
+    assert read_back == (data, "image/png")
+    assert os.path.basename(path) == hashlib.sha256(data).hexdigest() + ".png"
+
+
+def test_janitor_expires_objects_and_their_aliases(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path), file_io)
+    janitor = StorageJanitor(store, max_age=3600)
+
+    async def main():
+        old_path, _, _, _ = await store.put_base64(base64.b64encode(b"old").decode(), "old.png")
+        await store.put_base64(base64.b64encode(b"new").decode(), "new.png")
+
+        def backdate():
+            # 模拟两小时前保存且之后没有访问
+            conn = store._db()
+            conn.execute("UPDATE objects SET last_access = ? WHERE sha256 = ?",
+                         (time.time() - 7200, store.image_id(old_path)))
+            conn.commit()
+
+        await store._run(backdate)
+        await janitor.run_once()
+        entries, _ = await store.list()
+        return old_path, [entry["name"] for entry in entries]
+
+    try:
+        old_path, names = asyncio.run(main())
+    finally:
+        store.close()
+        file_io.shutdown()
+    assert not os.path.exists(old_path)
+    assert names == ["new.png"]
+    assert (janitor.expired, janitor.evicted, janitor.objects) == (1, 0, 1)
+
+
+def test_only_lease_holder_runs_janitor(tmp_path):
+    file_io = FileIOExecutor(threads=1)
+    store = ImageStore(str(tmp_path / "images"), file_io)
+    path = str(tmp_path / "state.sqlite3")
+    other_worker, shared_store = SharedStateStore(path), SharedStateStore(path)
+    janitor = StorageJanitor(store, max_age=3600)
+    janitor.shared_store = shared_store
+
+    async def one_round():
+        # 第一轮在启动后立即执行，间隔至少 1 秒，期间不会再执行
+        janitor.start()
+        await asyncio.sleep(0.2)
+        janitor._task.cancel()
+        await asyncio.gather(janitor._task, return_exceptions=True)
+        janitor._task = None
+
+    async def main():
+        old_path, _, _, _ = await store.put_base64(base64.b64encode(b"old").decode(), "old.png")
+
+        def backdate():
+            conn = store._db()
+            conn.execute("UPDATE objects SET last_access = ?", (time.time() - 7200,))
+            conn.commit()
+
+        await store._run(backdate)
+        other = os.getpid() + 1
+        await other_worker.run(other_worker.acquire_lease, LEASE_NAME, other, 60)
+        await one_round()
+        follower = (janitor.leader, janitor.expired, janitor.objects, os.path.exists(old_path))
+        # 持有者交出租约后由本 worker 接管
+        await other_worker.run(other_worker.release_lease, LEASE_NAME, other)
+        await one_round()
+        leader = (janitor.leader, janitor.expired, janitor.objects, os.path.exists(old_path))
+        await janitor.stop()
+        return follower, leader
+
+    try:
+        follower, leader = asyncio.run(main())
+    finally:
+        other_worker.close()
+        shared_store.close()
+        store.close()
+        file_io.shutdown()
+    # 未持有租约时只刷新统计，不淘汰
+    assert follower == (False, 0, 1, True)
+    assert leader == (True, 1, 0, False)
@@ -0,0 +1,34 @@
+import json
+import logging
+import queue
+
+import logs
+from logs import PromptRef, new_request_id
+
+
+def test_prompt_redacted_by_default():
+    text = str(PromptRef("a secret prompt"))
+    assert "secret" not in text
+    assert "长度=15" in text
+
+
+def test_record_carries_request_id_and_formats_as_json():
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("aihubmix.test_logs")
+    handler = logs._ContextQueueHandler(log_queue)
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        rid = new_request_id()
+        logger.warning("生成 %d 张图像: %s", 2, PromptRef("cat"))
+    finally:
+        logger.removeHandler(handler)
+
+    # 入队时只附加关联 id，格式化 (包括提示词脱敏) 在后台线程进行
+    record = log_queue.get_nowait()
+    assert record.request_id == rid
+    entry = json.loads(logs._JsonFormatter().format(record))
+    assert entry["request_id"] == rid
+    assert entry["level"] == "WARNING"
+    assert entry["logger"] == "aihubmix.test_logs"
+    assert entry["message"].startswith("生成 2 张图像: <已脱敏 长度=3")
@@ -0,0 +1,144 @@
+import asyncio
+import os
+
+from jobs import SharedJobManager
+from shared_state import SharedStateStore
+from upstream import create_limiter
+from upstream_pool import create_upstream_pool
+
+
+def test_lease_is_exclusive_until_released(tmp_path):
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    first, second = SharedStateStore(path), SharedStateStore(path)
+    try:
+        assert first.acquire_lease("janitor", 1, 60)
+        assert not second.acquire_lease("janitor", 2, 60)
+        # 持有者续期
+        assert first.acquire_lease("janitor", 1, 60)
+        first.release_lease("janitor", 1)
+        assert second.acquire_lease("janitor", 2, 60)
+    finally:
+        first._db_close()
+        second._db_close()
+
+
+def test_expired_lease_can_be_taken_over(tmp_path):
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    first, second = SharedStateStore(path), SharedStateStore(path)
+    try:
+        assert first.acquire_lease("janitor", 1, -1)
+        assert second.acquire_lease("janitor", 2, 60)
+        assert not first.acquire_lease("janitor", 1, 60)
+    finally:
+        first._db_close()
+        second._db_close()
+
+
+def test_key_budget_shared_between_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("AIHUBMIX_API_KEYS", "sk-test-aaaaaaaaaaaa")
+    monkeypatch.setenv("AIHUBMIX_KEY_RPM", "6")
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    stores = [SharedStateStore(path), SharedStateStore(path)]
+    pools = [create_upstream_pool("http://127.0.0.1:9") for _ in stores]
+    for pool, store in zip(pools, stores):
+        pool.use_shared_store(store)
+
+    async def take(pool):
+        bucket = pool.endpoints[0].budget.bucket
+        # 每分钟 6 次的桶容量为 1，第二个 worker 取令牌需要等待补充
+        await asyncio.wait_for(bucket.acquire(), 0.5)
+
+    async def main():
+        await take(pools[0])
+        try:
+            await take(pools[1])
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    try:
+        assert asyncio.run(main()) is False
+    finally:
+        for store in stores:
+            store.close()
+
+
+def test_idle_claim_does_not_take_write_lock(tmp_path):
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    worker, writer = SharedStateStore(path, busy_timeout=0.1), SharedStateStore(path)
+    try:
+        worker._db()
+        # 另一个进程持有写锁时，空闲 worker 的轮询不会等待写锁
+        writer._db().execute("BEGIN IMMEDIATE")
+        assert worker.claim_job(1) is None
+        writer._db().execute("ROLLBACK")
+
+        worker.submit_job("job-1", {"prompt": "p"}, 10)
+        job, params, remaining = worker.claim_job(1)
+        assert (job["id"], job["status"], params, remaining) == ("job-1", "running", {"prompt": "p"}, 0)
+        assert worker.claim_job(2) is None
+    finally:
+        worker._db_close()
+        writer._db_close()
+
+
+def test_global_rpm_and_split_concurrency_across_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("AIHUBMIX_RPM", "6")
+    monkeypatch.setenv("AIHUBMIX_UPSTREAM_CONCURRENCY", "16")
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    stores = [SharedStateStore(path), SharedStateStore(path)]
+    limiters = [create_limiter(store, workers=2) for store in stores]
+
+    async def take(limiter):
+        async with limiter.slot():
+            pass
+
+    async def main():
+        await take(limiters[0])
+        try:
+            # 每分钟 6 次的全局桶容量为 1，另一个 worker 需要等待补充
+            await asyncio.wait_for(take(limiters[1]), 0.5)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    try:
+        assert asyncio.run(main()) is False
+    finally:
+        for store in stores:
+            store.close()
+    # 总并发不随 worker 数增加
+    assert [limiter.concurrency for limiter in limiters] == [8, 8]
+
+
+def test_job_submitted_to_one_worker_runs_once_and_is_visible_to_all(tmp_path):
+    path = os.path.join(str(tmp_path), "state.sqlite3")
+    stores = [SharedStateStore(path), SharedStateStore(path)]
+    managers = [SharedJobManager(store, workers=2, poll_interval=0.05) for store in stores]
+    calls = []
+
+    async def handler(params):
+        calls.append(params["prompt"])
+        return {"message": f"done: {params['prompt']}"}
+
+    async def main():
+        for manager in managers:
+            await manager.start(handler)
+        job = await managers[0].submit({"prompt": "shared"})
+        for _ in range(100):
+            seen = await managers[1].get(job["id"])
+            if seen["status"] == "succeeded":
+                break
+            await asyncio.sleep(0.02)
+        for manager in managers:
+            await manager.stop()
+        return seen
+
+    try:
+        seen = asyncio.run(main())
+    finally:
+        for store in stores:
+            store.close()
+    assert seen["status"] == "succeeded"
+    assert seen["result"] == {"message": "done: shared"}
+    assert calls == ["shared"]
@@ -0,0 +1,72 @@
+import asyncio
+import io
+import json
+
+from server import AIHubMixImageMCPServer
+from startup import event_loop_name, run, startup_elapsed
+from stdio_transport import StdioTransport
+
+
+def test_metrics_dump_never_touches_stdout(capsys):
+    transport = StdioTransport(io.BytesIO(), io.BytesIO())
+    server = AIHubMixImageMCPServer(transport)
+    server.metrics_file = None
+    try:
+        asyncio.run(server._dump_metrics())
+    finally:
+        server.file_io.shutdown()
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "aihubmix_" in captured.err
+
+
+def _serve_lines(messages, upstream):
+    """把消息逐行写入 stdin，运行服务器直到 EOF，返回按写出顺序解析的响应"""
+    stdin = io.BytesIO(b"".join(json.dumps(message).encode() + b"\n" for message in messages))
+    stdout = io.BytesIO()
+    server = AIHubMixImageMCPServer(StdioTransport(stdin, stdout))
+    server.http_client = upstream.client()
+    asyncio.run(server.start())
+    return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+
+def test_slow_tool_call_does_not_block_other_requests(image_dir, upstream):
+    upstream.delay = 0.3
+    responses = _serve_lines([
+        {"jsonrpc": "2.0", "id": 1, "method": "tools/call",
+         "params": {"name": "generate_image", "arguments": {"prompt": "slow"}}},
+        {"jsonrpc": "2.0", "id": 2, "method": "tools/list"},
+    ], upstream)
+    # 后到的请求先完成并先写出
+    assert [response["id"] for response in responses] == [2, 1]
+    assert responses[1]["result"]["isError"] is False
+
+
+def test_batch_array_gets_one_array_response(image_dir, upstream):
+    responses = _serve_lines([
+        [
+            {"jsonrpc": "2.0", "id": 1, "method": "initialize"},
+            {"jsonrpc": "2.0", "method": "notifications/initialized"},
+            {"jsonrpc": "2.0", "id": 2, "method": "no/such/method"},
+        ],
+        [],
+        [{"jsonrpc": "2.0", "method": "notifications/initialized"}],
+    ], upstream)
+    batch, empty = sorted(responses, key=lambda response: isinstance(response, dict))
+    # 通知不产生响应，只含通知的批量请求不写出任何内容
+    assert [response["id"] for response in batch] == [1, 2]
+    assert "result" in batch[0]
+    assert batch[1]["error"]["code"] == -32601
+    assert empty["error"]["code"] == -32600
+
+
+def test_startup_run_without_uvloop(monkeypatch):
+    monkeypatch.setenv("AIHUBMIX_UVLOOP", "false")
+
+    async def loop_type():
+        return type(asyncio.get_running_loop()).__module__
+
+    assert event_loop_name() == "asyncio"
+    assert run(loop_type()).startswith("asyncio")
+    # 从进程启动开始计时，包括解释器启动和模块导入
+    assert startup_elapsed() > 0
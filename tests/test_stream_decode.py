@@ -0,0 +1,93 @@
+import base64
+import binascii
+import json
+
+import pytest
+
+from stream_decode import B64JsonStreamDecoder
+
+IMAGES = [bytes(range(256)) * 3 + b"\x00", b"second image \xff\xfe", b"x"]
+
+
+def _response(images, escape_slashes=False):
+    data = [{"b64_json": base64.b64encode(image).decode(), "revised_prompt": 'a "b64_json" cat'} for image in images]
+    body = json.dumps({"created": 1, "data": data})
+    if escape_slashes:
+        body = body.replace("/", "\\/")
+    return body.encode()
+
+
+def _decode(body, chunk_size):
+    decoder = B64JsonStreamDecoder()
+    parts = {}
+    finished = []
+    for start in range(0, len(body), chunk_size):
+        for index, data, done in decoder.feed(body[start:start + chunk_size]):
+            assert index not in finished
+            parts[index] = parts.get(index, b"") + data
+            if done:
+                finished.append(index)
+    return decoder, parts, finished, decoder.finish()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 7, 10, 64, 4096])
+def test_chunk_boundaries(chunk_size):
+    decoder, parts, finished, skeleton = _decode(_response(IMAGES), chunk_size)
+    assert finished == [0, 1, 2]
+    assert [parts[i] for i in finished] == IMAGES
+    assert decoder.images == 3
+    assert skeleton["created"] == 1
+    assert [item["b64_json"] for item in skeleton["data"]] == [None, None, None]
+    # 其他字段中的键名文本不受影响
+    assert skeleton["data"][0]["revised_prompt"] == 'a "b64_json" cat'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 4096])
+def test_escaped_slashes(chunk_size):
+    # 包含 "/" 的 base64 在某些服务端会被转义为 "\/"
+    image = b"\xff" * 30
+    assert b"/" in base64.b64encode(image)
+    _, parts, finished, _ = _decode(_response([image], escape_slashes=True), chunk_size)
+    assert finished == [0]
+    assert parts[0] == image
+
+
+def test_split_key_preserved_in_skeleton():
+    body = b'{"data": [{"url": "http://x/1.png"}], "note": "b64_js'
+    decoder = B64JsonStreamDecoder()
+    assert decoder.feed(body) == []
+    assert decoder.feed(b'on"}') == []
+    assert decoder.finish()["note"] == 'b64_json'
+
+
+def test_null_value_is_not_decoded():
+    decoder, parts, finished, skeleton = _decode(b'{"data": [{"b64_json": null, "url": "u"}]}', 3)
+    assert finished == [] and parts == {}
+    assert skeleton["data"][0] == {"b64_json": None, "url": "u"}
+
+
+def test_unpadded_value():
+    _, parts, _, _ = _decode(b'{"data": [{"b64_json": "eHk"}]}', 2)
+    assert parts[0] == b"xy"
+
+
+def test_truncated_inside_value():
+    decoder = B64JsonStreamDecoder()
+    body = _response(IMAGES[:1])
+    decoder.feed(body[:body.index(b"b64_json") + 30])
+    with pytest.raises(ValueError):
+        decoder.finish()
+
+
+def test_truncated_skeleton():
+    decoder = B64JsonStreamDecoder()
+    body = _response(IMAGES[:1])
+    decoder.feed(body[:-3])
+    with pytest.raises(ValueError):
+        decoder.finish()
+
+
+def test_invalid_base64():
+    decoder = B64JsonStreamDecoder()
+    with pytest.raises(binascii.Error):
+        decoder.feed(b'{"data": [{"b64_json": "A"}]}')
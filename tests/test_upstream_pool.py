@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from image_service import AIHubMixImageService
+from upstream import UpstreamError, UpstreamLimiter
+
+
+def test_auth_errors_switch_each_entry_at_most_once(monkeypatch):
+    monkeypatch.setenv("AIHUBMIX_API_KEYS", "sk-test-aaaaaaaaaaaa,sk-test-bbbbbbbbbbbb")
+    # 不摘除出错的条目：可用条目数始终大于 0
+    monkeypatch.setenv("AIHUBMIX_AUTH_EJECT_SECONDS", "0")
+    service = AIHubMixImageService(default_base_url="http://127.0.0.1:9")
+    calls = []
+
+    async def fake_attempt(request_data, filename, index_offset=0):
+        calls.append(len(calls))
+        # 让出事件循环，出现无限循环时由 wait_for 超时失败而不是挂起
+        await asyncio.sleep(0)
+        raise UpstreamError("密钥无效", 401)
+
+    service._attempt_generation = fake_attempt
+
+    async def main():
+        return await asyncio.wait_for(service._call_generation_with_retry({"n": 1}, "f"), 5)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(main())
+    # 第一次尝试加上每个条目各换用一次
+    assert len(calls) == 1 + len(service.upstream.endpoints)
+
+
+def test_rate_limited_and_server_errors_are_retried(monkeypatch, image_dir, upstream):
+    monkeypatch.setenv("AIHUBMIX_RETRY_BASE_DELAY", "0.01")
+    upstream.errors = {1: 429, 2: 503}
+    service = AIHubMixImageService(default_base_url="http://upstream.test/v1")
+    service.http_client = upstream.client()
+
+    async def main():
+        try:
+            return await service._generate_image_with_aihubmix(prompt="retry me", cache="bypass")
+        finally:
+            await service.http_client.aclose()
+
+    result = asyncio.run(main())
+    assert len(upstream.generations) == 3
+    assert len(result["saved_files"]) == 1
+
+
+def test_client_errors_are_not_retried(monkeypatch, image_dir, upstream):
+    monkeypatch.setenv("AIHUBMIX_RETRY_BASE_DELAY", "0.01")
+    upstream.errors = {1: 400}
+    service = AIHubMixImageService(default_base_url="http://upstream.test/v1")
+    service.http_client = upstream.client()
+
+    async def main():
+        try:
+            return await service._generate_image_with_aihubmix(prompt="bad", cache="bypass")
+        finally:
+            await service.http_client.aclose()
+
+    with pytest.raises(Exception, match="状态码: 400"):
+        asyncio.run(main())
+    assert len(upstream.generations) == 1
+
+
+def test_token_bucket_spaces_requests():
+    limiter = UpstreamLimiter(rpm=600, burst=1)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(3):
+            async with limiter.slot():
+                pass
+        return loop.time() - start
+
+    # 容量为 1、每秒 10 个令牌：第一个立即取得，之后每个等待约 0.1 秒
+    assert 0.15 <= asyncio.run(main()) < 1.0
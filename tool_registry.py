@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCP 工具注册表
+两个服务器共用的 initialize / tools/list 响应和工具参数校验；
+响应在启动时构建一次并缓存序列化结果
+"""
+
+import json
+from typing import Any, Dict, List
+
+from deadline import MAX_DEADLINE
+
+PROTOCOL_VERSION = "2024-11-05"
+SERVER_VERSION = "1.0.0"
+
+CAPABILITIES = {
+    "tools": {},
+    "resources": {},
+    "prompts": {},
+    "sampling": {}
+}
+
+# size 在调用上游之前按此列表严格校验；默认模型 gpt-image-1 额外支持 1024x1536、1536x1024 和 auto，
+# 不列出会拒绝校验之前可以直接传给上游的合法尺寸
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792", "1024x1536", "1536x1024", "auto"]
+MAX_IMAGES = 10
+
+# 批量生成的条目数和并发上限
+MAX_BATCH_ITEMS = 500
+MAX_BATCH_CONCURRENCY = 16
+
+_JSON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+}
+
+
+class ToolArgumentError(ValueError):
+    """工具参数不符合 inputSchema"""
+
+
+def _generate_image_tool(default_model: str) -> Dict[str, Any]:
+    return {
+        "name": "generate_image",
+        "description": "使用 AIHubMix API 生成图像",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "prompt": {
+                    "type": "string",
+                    "description": "图像描述提示词"
+                },
+                "model": {
+                    "type": "string",
+                    "description": "使用的模型 (gpt-image-1)",
+                    "default": default_model
+                },
+                "size": {
+                    "type": "string",
+                    "description": "图像尺寸",
+                    "enum": IMAGE_SIZES,
+                    "default": "1024x1024"
+                },
+                "n": {
+                    "type": "integer",
+                    "description": f"生成图像数量 (1-{MAX_IMAGES})",
+                    "minimum": 1,
+                    "maximum": MAX_IMAGES,
+                    "default": 1
+                },
+                "filename": {
+                    "type": "string",
+                    "description": "输出文件名 (不含扩展名)",
+                    "default": "generated_image"
+                },
+                "cache": {
+                    "type": "string",
+                    "description": "结果缓存模式: bypass 跳过缓存, prefer 优先使用缓存, only 只返回缓存",
+                    "enum": ["bypass", "prefer", "only"]
+                },
+                "fanout": {
+                    "type": "integer",
+                    "description": "n>1 时拆分为并行上游请求，每个请求的图像数量 (0 表示不拆分)，部分失败时返回成功的图像",
+                    "minimum": 0,
+                    "maximum": MAX_IMAGES
+                },
+                "partial_images": {
+                    "type": "integer",
+                    "description": "流式生成并在渲染过程中接收的预览图数量 (0-3，仅支持 n=1)，设置后通过进度通知报告预览图",
+                    "minimum": 0,
+                    "maximum": 3
+                },
+                "preview": {
+                    "type": "integer",
+                    "description": "在结果中附带缩略图，指定缩略图的最大边长 (像素)",
+                    "minimum": 16,
+                    "maximum": 1024
+                },
+                "preview_format": {
+                    "type": "string",
+                    "description": "缩略图格式",
+                    "enum": ["webp", "jpeg", "png"],
+                    "default": "webp"
+                },
+                "deadline": {
+                    "type": "number",
+                    "description": "愿意等待的最长秒数，超过后取消生成并返回错误",
+                    "exclusiveMinimum": 0,
+                    "maximum": MAX_DEADLINE
+                }
+            },
+            "required": ["prompt"]
+        }
+    }
+
+
+def _generate_images_batch_tool(default_model: str) -> Dict[str, Any]:
+    return {
+        "name": "generate_images_batch",
+        "description": "批量生成图像，条目并发执行，单个条目失败不影响其他条目",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "description": f"生成条目列表 (1-{MAX_BATCH_ITEMS} 个)",
+                    "minItems": 1,
+                    "maxItems": MAX_BATCH_ITEMS,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "prompt": {
+                                "type": "string",
+                                "description": "图像描述提示词"
+                            },
+                            "size": {
+                                "type": "string",
+                                "description": "图像尺寸",
+                                "enum": IMAGE_SIZES,
+                                "default": "1024x1024"
+                            },
+                            "n": {
+                                "type": "integer",
+                                "description": f"生成图像数量 (1-{MAX_IMAGES})",
+                                "minimum": 1,
+                                "maximum": MAX_IMAGES,
+                                "default": 1
+                            },
+                            "filename": {
+                                "type": "string",
+                                "description": "输出文件名 (不含扩展名)，默认为 batch_<序号>"
+                            }
+                        },
+                        "required": ["prompt"]
+                    }
+                },
+                "model": {
+                    "type": "string",
+                    "description": "使用的模型 (gpt-image-1)",
+                    "default": default_model
+                },
+                "cache": {
+                    "type": "string",
+                    "description": "结果缓存模式: bypass 跳过缓存, prefer 优先使用缓存, only 只返回缓存",
+                    "enum": ["bypass", "prefer", "only"]
+                },
+                "concurrency": {
+                    "type": "integer",
+                    "description": f"同时执行的条目数 (1-{MAX_BATCH_CONCURRENCY})",
+                    "minimum": 1,
+                    "maximum": MAX_BATCH_CONCURRENCY
+                },
+                "deadline": {
+                    "type": "number",
+                    "description": "愿意等待的最长秒数，超过后取消尚未完成的条目",
+                    "exclusiveMinimum": 0,
+                    "maximum": MAX_DEADLINE
+                }
+            },
+            "required": ["items"]
+        }
+    }
+
+
+def _serialize(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ToolRegistry:
+    """服务器提供的工具及其不变的协议响应"""
+
+    def __init__(self, server_name: str, default_model: str):
+        self.tools: Dict[str, Dict[str, Any]] = {}
+        for tool in (_generate_image_tool(default_model), _generate_images_batch_tool(default_model)):
+            self.tools[tool["name"]] = tool
+
+        self.initialize_result = {
+            "protocolVersion": PROTOCOL_VERSION,
+            "capabilities": CAPABILITIES,
+            "serverInfo": {
+                "name": server_name,
+                "version": SERVER_VERSION
+            }
+        }
+        self.tools_list_result = {"tools": list(self.tools.values())}
+
+        # 响应中只有 id 随请求变化，result 部分预先序列化
+        self._initialize_bytes = _serialize(self.initialize_result)
+        self._tools_list_bytes = _serialize(self.tools_list_result)
+
+    def has_tool(self, name: Any) -> bool:
+        return name in self.tools
+
+    def initialize_response(self, request_id: Any) -> bytes:
+        """序列化好的 initialize 响应"""
+        return self._response(request_id, self._initialize_bytes)
+
+    def tools_list_response(self, request_id: Any) -> bytes:
+        """序列化好的 tools/list 响应"""
+        return self._response(request_id, self._tools_list_bytes)
+
+    def _response(self, request_id: Any, result: bytes) -> bytes:
+        return b'{"jsonrpc":"2.0","id":' + _serialize(request_id) + b',"result":' + result + b"}"
+
+    def validate_arguments(self, name: str, arguments: Any):
+        """按 inputSchema 校验工具参数，不符合时抛出 ToolArgumentError
+
+        只检查声明过的属性；未声明的参数保持向后兼容，直接忽略。
+        """
+        if not isinstance(arguments, dict):
+            raise ToolArgumentError("参数必须是 JSON 对象")
+        schema = self.tools[name]["inputSchema"]
+
+        for key in schema.get("required", []):
+            if arguments.get(key) in (None, ""):
+                raise ToolArgumentError(f"缺少必需参数: {key}")
+
+        for key, spec in schema["properties"].items():
+            value = arguments.get(key)
+            if value is None:
+                continue
+            errors = _check_value(value, spec)
+            if errors:
+                raise ToolArgumentError(f"无效参数 {key}: {'; '.join(errors)}")
+
+
+def _check_value(value: Any, spec: Dict[str, Any]) -> List[str]:
+    """检查单个参数值，返回错误描述"""
+    expected = spec.get("type")
+    types = _JSON_TYPES.get(expected)
+    # bool 是 int 的子类，不能当作数值
+    if types is not None and (not isinstance(value, types) or
+                              (expected in ("integer", "number") and isinstance(value, bool))):
+        return [f"应为 {expected} 类型"]
+
+    if expected == "array":
+        return _check_array(value, spec)
+    if expected == "object":
+        return _check_object(value, spec)
+
+    errors = []
+    if "enum" in spec and value not in spec["enum"]:
+        errors.append(f"可选值: {', '.join(map(str, spec['enum']))}")
+    if "exclusiveMinimum" in spec and value <= spec["exclusiveMinimum"]:
+        errors.append(f"必须大于 {spec['exclusiveMinimum']}")
+    if "minimum" in spec and value < spec["minimum"]:
+        errors.append(f"不能小于 {spec['minimum']}")
+    if "maximum" in spec and value > spec["maximum"]:
+        errors.append(f"不能大于 {spec['maximum']}")
+    return errors
+
+
+def _check_array(value: List[Any], spec: Dict[str, Any]) -> List[str]:
+    """检查数组长度和元素，只报告第一个不符合的元素"""
+    if "minItems" in spec and len(value) < spec["minItems"]:
+        return [f"至少需要 {spec['minItems']} 个元素"]
+    if "maxItems" in spec and len(value) > spec["maxItems"]:
+        return [f"最多 {spec['maxItems']} 个元素"]
+    item_spec = spec.get("items")
+    if item_spec is not None:
+        for i, item in enumerate(value):
+            errors = _check_value(item, item_spec)
+            if errors:
+                return [f"[{i}] {error}" for error in errors]
+    return []
+
+
+def _check_object(value: Dict[str, Any], spec: Dict[str, Any]) -> List[str]:
+    """检查嵌套对象的必需属性和已声明的属性"""
+    errors = [f"缺少 {key}" for key in spec.get("required", []) if value.get(key) in (None, "")]
+    for key, prop in spec.get("properties", {}).items():
+        if value.get(key) is not None:
+            errors.extend(f"{key} {error}" for error in _check_value(value[key], prop))
+    return errors
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AIHubMix 上游连接
+服务器实例共享的长连接 httpx 客户端，以及生成接口的限流与重试策略
+"""
+
+import asyncio
+import importlib.util
+import math
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import httpx
+
+from config import env_bool, env_float, env_int
+from logs import get_logger
+from shared_state import SharedStateStore, SharedTokenBucket
+
+logger = get_logger("upstream")
+
+
+def http2_available() -> bool:
+    """检查是否安装了 HTTP/2 所需的 h2 包"""
+    return importlib.util.find_spec("h2") is not None
+
+
+def build_timeout(read: Optional[float] = None) -> httpx.Timeout:
+    """按阶段构建超时配置，read 可覆盖默认读取超时"""
+    return httpx.Timeout(
+        connect=env_float('AIHUBMIX_CONNECT_TIMEOUT', 10.0),
+        read=read if read is not None else env_float('AIHUBMIX_READ_TIMEOUT', 60.0),
+        write=env_float('AIHUBMIX_WRITE_TIMEOUT', 30.0),
+        pool=env_float('AIHUBMIX_POOL_TIMEOUT', 10.0),
+    )
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """创建带连接池的上游客户端，整个服务器生命周期内复用"""
+    limits = httpx.Limits(
+        max_connections=env_int('AIHUBMIX_MAX_CONNECTIONS', 100),
+        max_keepalive_connections=env_int('AIHUBMIX_MAX_KEEPALIVE_CONNECTIONS', 20),
+        keepalive_expiry=env_float('AIHUBMIX_KEEPALIVE_EXPIRY', 30.0),
+    )
+
+    http2 = env_bool('AIHUBMIX_HTTP2', False)
+    if http2 and not http2_available():
+        logger.warning("⚠️ 已启用 AIHUBMIX_HTTP2，但未安装 h2 (pip install 'httpx[http2]')，回退到 HTTP/1.1")
+        http2 = False
+
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=build_timeout(),
+        http2=http2,
+    )
+
+
+class UpstreamError(Exception):
+    """上游返回错误状态码"""
+
+    def __init__(self, message: str, status_code: int, retryable: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+# 可以安全重试的网络错误：请求尚未发出，不会重复计费
+RETRYABLE_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头 (秒数或 HTTP 日期)"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """令牌桶限流器，rpm 为 0 时不限流"""
+
+    def __init__(self, rpm: float, burst: int = 0):
+        self.rate = rpm / 60.0
+        self.capacity = float(burst if burst > 0 else max(1, int(rpm // 6)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self):
+        """取得一个令牌，必要时等待"""
+        if self.rate <= 0:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 串行等待，保证先到先得
+        async with self._lock:
+            while True:
+                if self.available() >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def available(self) -> float:
+        """补充令牌后返回当前可用的令牌数，不消耗令牌"""
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rpm": self.rate * 60.0, "tokens": round(self.tokens, 2)}
+
+
+class UpstreamLimiter:
+    """生成接口前的客户端限流：每分钟请求数 + 并发上限"""
+
+    def __init__(self, rpm: float = 0, burst: int = 0, concurrency: int = 0, bucket=None):
+        # bucket 可替换为跨进程共享的令牌桶
+        self.bucket = bucket if bucket is not None else TokenBucket(rpm, burst)
+        self.concurrency = concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.active = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个上游请求名额"""
+        if self.concurrency > 0 and self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+        self.waiting += 1
+        try:
+            if self._slots is not None:
+                await self._slots.acquire()
+            try:
+                await self.bucket.acquire()
+            except BaseException:
+                if self._slots is not None:
+                    self._slots.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "concurrency": self.concurrency,
+            **self.bucket.stats(),
+        }
+
+
+class RetryPolicy:
+    """指数退避 + 全抖动重试策略，带总截止时间"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 20.0, deadline: float = 120.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """第 attempt 次失败后的等待时间，Retry-After 优先"""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+def create_retry_policy() -> RetryPolicy:
+    """按环境变量创建重试策略"""
+    return RetryPolicy(
+        max_attempts=env_int('AIHUBMIX_RETRY_MAX_ATTEMPTS', 3),
+        base_delay=env_float('AIHUBMIX_RETRY_BASE_DELAY', 1.0),
+        max_delay=env_float('AIHUBMIX_RETRY_MAX_DELAY', 20.0),
+        deadline=env_float('AIHUBMIX_RETRY_DEADLINE', 120.0),
+    )
+
+
+def create_limiter(shared_store: Optional[SharedStateStore] = None, workers: int = 1) -> UpstreamLimiter:
+    """按环境变量创建上游限流器
+
+    多 worker 部署时传入共享存储：每分钟请求数由所有 worker 共用一个令牌桶，
+    并发上限按 worker 数平分，总并发不随 worker 数增加。
+    """
+    rpm = env_float('AIHUBMIX_RPM', 0.0)
+    burst = env_int('AIHUBMIX_RPM_BURST', 0)
+    concurrency = env_int('AIHUBMIX_UPSTREAM_CONCURRENCY', 16)
+
+    bucket = None
+    if shared_store is not None:
+        bucket = SharedTokenBucket(shared_store, rpm, burst)
+    if workers > 1 and concurrency > 0:
+        concurrency = max(1, math.ceil(concurrency / workers))
+
+    return UpstreamLimiter(rpm=rpm, burst=burst, concurrency=concurrency, bucket=bucket)
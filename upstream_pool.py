@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游地址池
+多个 API 密钥与基础 URL 组成的条目池，每个请求发往未完成请求最少、剩余限流额度最多的条目；
+认证失败或连续超时的条目暂时摘除，到期后重新参与选择
+"""
+
+import hashlib
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional
+
+import httpx
+
+from config import env_float, env_int, env_list, env_str
+from logs import get_logger
+from shared_state import SharedStateStore, SharedTokenBucket
+from upstream import TokenBucket, UpstreamError
+
+logger = get_logger("upstream_pool")
+
+# 返回这些状态码的条目按认证失败处理：密钥无效或余额不足，换用其他条目
+AUTH_EJECT_STATUS = (401, 402)
+
+# 计为条目故障的网络错误：超时和连接失败
+FAILURE_ERRORS = (httpx.TimeoutException, httpx.NetworkError)
+
+# 上游 429 未带 Retry-After 时，该密钥暂停分配的秒数
+DEFAULT_COOLDOWN = 5.0
+
+# 响应头中报告的剩余额度的有效期 (秒)
+RATE_HEADER_TTL = 60.0
+
+
+def mask_key(key: str) -> str:
+    """日志和统计中只显示密钥的首尾几位"""
+    if len(key) <= 10:
+        return "***"
+    return f"{key[:3]}...{key[-4:]}"
+
+
+class _KeyBudget:
+    """单个 API 密钥的剩余限流额度，同一密钥的所有条目共用"""
+
+    def __init__(self, key: str, rpm: float = 0.0):
+        # 共享存储中令牌桶的名称，不保存密钥原文
+        self.name = "key:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        self.rpm = rpm
+        self.bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.cooldown_until = 0.0
+        # 上游响应头报告的剩余比例及记录时间
+        self.reported: Optional[float] = None
+        self.reported_at = 0.0
+
+    def fraction(self, now: float) -> float:
+        """剩余额度比例 (0-1)，未知时为 1"""
+        if now < self.cooldown_until:
+            return 0.0
+        fraction = 1.0
+        if self.bucket is not None:
+            fraction = min(fraction, self.bucket.available() / self.bucket.capacity)
+        if self.reported is not None and now - self.reported_at < RATE_HEADER_TTL:
+            fraction = min(fraction, self.reported)
+        return fraction
+
+    def record_headers(self, headers: Mapping[str, str], now: float):
+        """记录 OpenAI 兼容的 x-ratelimit-* 响应头"""
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        limit = headers.get("x-ratelimit-limit-requests")
+        if remaining is None or limit is None:
+            return
+        try:
+            remaining_value, limit_value = float(remaining), float(limit)
+        except ValueError:
+            return
+        if limit_value > 0:
+            self.reported = max(0.0, min(1.0, remaining_value / limit_value))
+            self.reported_at = now
+
+
+class UpstreamEndpoint:
+    """地址池中的一个条目：一个 API 密钥 + 一个基础 URL"""
+
+    def __init__(self, base_url: str, api_key: str, api_prefix: str, budget: _KeyBudget):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.api_prefix = api_prefix
+        self.budget = budget
+        self.name = f"{mask_key(api_key)}@{self.base_url}"
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.last_used = 0.0
+        self.last_error: Optional[str] = None
+
+    def url(self, path: str) -> str:
+        """拼接上游 API 地址"""
+        return f"{self.base_url}{self.api_prefix}{path}"
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "ejected": self.ejected_until > now,
+            "ejected_for": round(max(0.0, self.ejected_until - now), 1),
+            "budget": round(self.budget.fraction(now), 3),
+            "last_error": self.last_error,
+        }
+
+
+class UpstreamPool:
+    """按负载和剩余额度分配上游条目"""
+
+    def __init__(
+        self,
+        endpoints: List[UpstreamEndpoint],
+        eject_failures: int = 3,
+        eject_seconds: float = 30.0,
+        auth_eject_seconds: float = 600.0,
+    ):
+        if not endpoints:
+            raise ValueError("上游地址池至少需要一个条目")
+        self.endpoints = endpoints
+        self.eject_failures = max(1, eject_failures)
+        self.eject_seconds = eject_seconds
+        self.auth_eject_seconds = auth_eject_seconds
+
+    def use_shared_store(self, store: SharedStateStore):
+        """多进程部署时改用跨进程共享的密钥令牌桶，每个密钥的速率由所有 worker 共用"""
+        budgets = {id(entry.budget): entry.budget for entry in self.endpoints}
+        for budget in budgets.values():
+            if budget.bucket is not None:
+                budget.bucket = SharedTokenBucket(store, budget.rpm, name=budget.name)
+
+    @property
+    def base_urls(self) -> List[str]:
+        """去重后的基础 URL"""
+        return list(dict.fromkeys(entry.base_url for entry in self.endpoints))
+
+    def available(self) -> int:
+        """未被摘除的条目数"""
+        now = time.monotonic()
+        return sum(1 for entry in self.endpoints if entry.ejected_until <= now)
+
+    def choose(self) -> UpstreamEndpoint:
+        """选择条目：先排除被摘除和额度耗尽的条目，再取未完成请求最少、剩余额度最多的"""
+        now = time.monotonic()
+        live = [entry for entry in self.endpoints if entry.ejected_until <= now]
+        if not live:
+            # 全部被摘除时选择最早恢复的条目，而不是直接失败
+            return min(self.endpoints, key=lambda entry: entry.ejected_until)
+
+        def load(entry: UpstreamEndpoint):
+            budget = entry.budget.fraction(now)
+            # 负载相同时轮流使用最久未用的条目
+            return budget <= 0, entry.outstanding, -budget, entry.last_used
+
+        return min(live, key=load)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[UpstreamEndpoint]:
+        """占用一个条目发送请求，按请求结果更新条目的健康状态"""
+        entry = self.choose()
+        entry.outstanding += 1
+        entry.requests += 1
+        entry.last_used = time.monotonic()
+        try:
+            if entry.budget.bucket is not None:
+                await entry.budget.bucket.acquire()
+            yield entry
+        except UpstreamError as e:
+            self._record_error(entry, e)
+            raise
+        except FAILURE_ERRORS as e:
+            self._record_failure(entry, repr(e))
+            raise
+        else:
+            entry.consecutive_failures = 0
+        finally:
+            entry.outstanding -= 1
+
+    def record_headers(self, entry: UpstreamEndpoint, headers: Mapping[str, str]):
+        """记录响应头中的剩余限流额度"""
+        entry.budget.record_headers(headers, time.monotonic())
+
+    def eject(self, entry: UpstreamEndpoint, seconds: float, reason: str):
+        """暂时摘除条目，已被摘除时只延长摘除时间 (摘除前发出的请求陆续失败)"""
+        now = time.monotonic()
+        if entry.ejected_until <= now:
+            entry.ejections += 1
+            logger.warning("🚫 上游条目 %s 已摘除 %.0f 秒: %s", entry.name, seconds, reason)
+        entry.ejected_until = max(entry.ejected_until, now + seconds)
+        entry.last_error = reason
+
+    def _record_error(self, entry: UpstreamEndpoint, error: UpstreamError):
+        if error.status_code in AUTH_EJECT_STATUS:
+            entry.failures += 1
+            self.eject(entry, self.auth_eject_seconds, str(error))
+        elif error.status_code == 429:
+            # 该密钥的额度暂时用尽，其他条目优先
+            cooldown = error.retry_after if error.retry_after is not None else DEFAULT_COOLDOWN
+            entry.budget.cooldown_until = max(entry.budget.cooldown_until, time.monotonic() + cooldown)
+        elif error.status_code >= 500:
+            self._record_failure(entry, str(error))
+        else:
+            # 请求本身的错误 (参数等) 与条目健康无关
+            entry.consecutive_failures = 0
+
+    def _record_failure(self, entry: UpstreamEndpoint, reason: str):
+        entry.failures += 1
+        entry.consecutive_failures += 1
+        entry.last_error = reason
+        # 摘除到期后仍然失败的条目会立即再次被摘除
+        if entry.consecutive_failures >= self.eject_failures:
+            self.eject(entry, self.eject_seconds, f"连续 {entry.consecutive_failures} 次失败: {reason}")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """每个条目的负载与健康状态"""
+        now = time.monotonic()
+        return [entry.stats(now) for entry in self.endpoints]
+
+
+def create_upstream_pool(default_base_url: str, api_prefix: str = "") -> UpstreamPool:
+    """按环境变量创建上游地址池
+
+    AIHUBMIX_API_KEYS / AIHUBMIX_BASE_URLS 为逗号分隔的列表，未设置时使用
+    AIHUBMIX_API_KEY / AIHUBMIX_BASE_URL；每个密钥与每个基础 URL 组合为一个条目。
+    """
+    keys = env_list('AIHUBMIX_API_KEYS') or env_list('AIHUBMIX_API_KEY')
+    base_urls = env_list('AIHUBMIX_BASE_URLS') or [env_str('AIHUBMIX_BASE_URL', default_base_url)]
+    if not keys:
+        raise ValueError("AIHUBMIX_API_KEY 环境变量未设置")
+
+    # 限流额度按密钥计算，同一密钥经不同基础 URL 发出的请求共用额度
+    key_rpm = env_float('AIHUBMIX_KEY_RPM', 0.0)
+    budgets = {key: _KeyBudget(key, key_rpm) for key in keys}
+    endpoints = [
+        UpstreamEndpoint(base_url, key, api_prefix, budgets[key])
+        for key in dict.fromkeys(keys)
+        for base_url in dict.fromkeys(base_urls)
+    ]
+    return UpstreamPool(
+        endpoints,
+        eject_failures=env_int('AIHUBMIX_EJECT_FAILURES', 3),
+        eject_seconds=env_float('AIHUBMIX_EJECT_SECONDS', 30.0),
+        auth_eject_seconds=env_float('AIHUBMIX_AUTH_EJECT_SECONDS', 600.0),
+    )